@@ -18,7 +18,28 @@ app.conf.beat_schedule = {
     },
     "sync-unprocessed-webhook-queue": {
         "task": "watch_sdk.utils.celery_utils.sync_unprocessed_webhook_queue",
-        "schedule": crontab(minute=0, hour="*/2"),
+        # rows are only picked up once they are due, see UnprocessedData
+        "schedule": crontab(minute="*"),
+    },
+    "drain-webhook-outbox": {
+        "task": "watch_sdk.utils.webhook_outbox.drain_webhook_outbox_cron",
+        "schedule": crontab(minute="*"),
+    },
+    "flush-delivery-metrics": {
+        "task": "watch_sdk.utils.metrics.flush_delivery_metrics",
+        "schedule": crontab(minute="*"),
+    },
+    "persist-user-activity-sketches": {
+        "task": "watch_sdk.utils.metrics.persist_user_activity_sketches",
+        "schedule": crontab(minute="*/5"),
+    },
+    "create-health-data-partitions": {
+        "task": "watch_sdk.utils.health_data_partitions.create_health_data_partitions",
+        "schedule": crontab(minute=0, hour=1),
+    },
+    "drop-expired-health-data-partitions": {
+        "task": "watch_sdk.utils.health_data_partitions.drop_expired_health_data_partitions",
+        "schedule": crontab(minute=30, hour=1),
     },
     "delete-ios-data-hash-logs": {
         "task": "watch_sdk.utils.celery_utils.delete_ios_data_hash_logs",
@@ -159,6 +159,82 @@ CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL")
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND")
 CELERY_REDIS_BACKEND_USE_SSL = {"ssl_cert_reqs": ssl.CERT_REQUIRED}
 CELERY_BROKER_URL_USE_SSL = {"ssl_cert_reqs": ssl.CERT_REQUIRED}
+# webhook delivery runs on its own workers, see start-server.sh
+CELERY_TASK_ROUTES = {
+    "watch_sdk.utils.webhook_outbox.*": {"queue": "webhook_delivery"},
+    "watch_sdk.utils.celery_utils.sync_unprocessed_webhook_queue": {
+        "queue": "webhook_delivery"
+    },
+    "watch_sdk.utils.celery_utils._replay_unprocessed_data_for_app": {
+        "queue": "webhook_delivery"
+    },
+}
+# task modules which are not imported by the views
+CELERY_IMPORTS = ("watch_sdk.utils.health_data_partitions",)
+
+# Keep-alive connection pool used for webhook delivery, per worker process.
+# Connections kept open per customer host, seconds after which an unused host's
+# connections are closed, and max number of hosts to keep connections for.
+WEBHOOK_POOL_SIZE = int(os.environ.get("WEBHOOK_POOL_SIZE", 10))
+WEBHOOK_POOL_IDLE_TIMEOUT = int(os.environ.get("WEBHOOK_POOL_IDLE_TIMEOUT", 60))
+WEBHOOK_POOL_MAX_HOSTS = int(os.environ.get("WEBHOOK_POOL_MAX_HOSTS", 100))
+
+# Limits for concurrent webhook delivery, chunks posted at once in a worker
+# process and per app, and deliveries queued before the producer is blocked.
+WEBHOOK_MAX_CONCURRENCY = int(os.environ.get("WEBHOOK_MAX_CONCURRENCY", 50))
+WEBHOOK_MAX_CONCURRENCY_PER_APP = int(
+    os.environ.get("WEBHOOK_MAX_CONCURRENCY_PER_APP", 10)
+)
+WEBHOOK_MAX_PENDING_DELIVERIES = int(
+    os.environ.get("WEBHOOK_MAX_PENDING_DELIVERIES", 500)
+)
+# Number of partitions of the webhook outbox, each one is drained by a single
+# delivery task at a time
+WEBHOOK_OUTBOX_PARTITIONS = int(os.environ.get("WEBHOOK_OUTBOX_PARTITIONS", 8))
+
+# Retries of webhook deliveries that failed, in seconds. The delay doubles with
+# every attempt up to the max delay, and data is given up on (marked dead)
+# after the max number of attempts, about 3 days with the defaults.
+WEBHOOK_RETRY_BASE_DELAY = int(os.environ.get("WEBHOOK_RETRY_BASE_DELAY", 60))
+WEBHOOK_RETRY_MAX_DELAY = int(os.environ.get("WEBHOOK_RETRY_MAX_DELAY", 6 * 60 * 60))
+WEBHOOK_RETRY_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_RETRY_MAX_ATTEMPTS", 20))
+
+# Default max webhook calls per second for each payment plan, apps can have
+# their own limit in UserApp.webhook_rate_limit. Calls can burst up to the
+# limit times WEBHOOK_RATE_LIMIT_BURST.
+WEBHOOK_RATE_LIMITS = {
+    "free": 5,
+    "startup": 20,
+    "business": 50,
+    "enterprise": 100,
+}
+WEBHOOK_RATE_LIMIT_BURST = 2
+# Seconds a chunk waits for the rate limit before it is stored for a retry
+WEBHOOK_RATE_LIMIT_MAX_WAIT = int(os.environ.get("WEBHOOK_RATE_LIMIT_MAX_WAIT", 60))
+# Seconds to pause calls after a 429 without a Retry-After header, and the max
+# pause we honor for a Retry-After header
+WEBHOOK_DEFAULT_RETRY_AFTER = 30
+WEBHOOK_MAX_RETRY_AFTER = 60 * 60
+
+# Circuit breaker of webhooks, calls to an app are paused for the open period
+# once the given number of calls failed within the window, in seconds.
+WEBHOOK_CIRCUIT_FAILURE_THRESHOLD = 5
+WEBHOOK_CIRCUIT_WINDOW = 60
+WEBHOOK_CIRCUIT_OPEN_SECONDS = int(os.environ.get("WEBHOOK_CIRCUIT_OPEN_SECONDS", 60))
+
+# Default max size of a webhook request body in bytes, apps can set their own
+# in UserApp.webhook_max_request_bytes
+WEBHOOK_MAX_REQUEST_BYTES = int(os.environ.get("WEBHOOK_MAX_REQUEST_BYTES", 256 * 1024))
+
+# HealthDataEntry is partitioned by month of start_time. Partitions are
+# created this many months ahead, and the ones older than the retention are
+# dropped. Stored health data is kept forever when no retention is set.
+HEALTH_DATA_PARTITIONS_AHEAD = 3
+HEALTH_DATA_RETENTION_MONTHS = (
+    int(os.environ["HEALTH_DATA_RETENTION_MONTHS"])
+    if os.environ.get("HEALTH_DATA_RETENTION_MONTHS")
+    else None
+)
 
 
 CACHES = {
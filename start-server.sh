@@ -2,5 +2,6 @@
 # start-server.sh
 python manage.py migrate
 python -m celery -A core worker --beat -l info &
+python -m celery -A core worker -Q webhook_delivery -n webhook@%h -l info &
 (gunicorn core.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:5000) &
 nginx -g "daemon off;"
\ No newline at end of file
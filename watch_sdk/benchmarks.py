@@ -0,0 +1,668 @@
+# Benchmarks of the health data ingestion and delivery paths.
+#
+# They are not collected by the test runner, run them explicitly against a
+# development database, eg.
+#
+#   python manage.py test watch_sdk.benchmarks
+#   python manage.py test watch_sdk.benchmarks.HealthkitUploadMemoryBenchmark
+#
+# Results are printed, only the sample counts are checked.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import types
+
+from django.conf import settings
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+import numpy as np
+import requests
+
+from watch_sdk.constants import apple_healthkit
+from watch_sdk.dataclasses import (
+    HeartRate,
+    Sleep,
+    Steps,
+    StravaCycling,
+    StravaRun,
+    StravaWalk,
+    batch_to_dict,
+)
+from watch_sdk.models import (
+    DataType,
+    HealthDataEntry,
+    Platform,
+    User,
+    UserApp,
+    WatchConnection,
+)
+from watch_sdk.utils.apple_healthkit import (
+    PROCESS_BATCH_SIZE,
+    _iter_columnar_batches,
+    _iter_json_batches,
+)
+from watch_sdk.utils.compression import ENCODINGS, compress, open_decompressed
+from watch_sdk.utils.data_process import store_health_data
+from watch_sdk.utils.health_data_partitions import _month_start
+from watch_sdk.utils.http_pool import get_session
+from watch_sdk.utils.webhook import MAX_CHUNK_SAMPLES, _split_data_into_chunks
+
+MB = 1024 * 1024
+
+
+def _read_status(field):
+    """
+    Returns a memory field of /proc/self/status in bytes
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) * 1024
+
+
+def _measure_in_child(func, memory_limit=4 * 1024 * MB):
+    """
+    Runs `func` in a forked child and returns a dict with its result, the time
+    it took and the peak RSS it added to the child, or the error it raised.
+    The address space of the child is limited to `memory_limit` more than it
+    starts with, so that a run which doesn't fit fails with a MemoryError.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            limit = _read_status("VmSize") + memory_limit
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            # resets the peak RSS of the child to its current RSS
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            start_rss = _read_status("VmRSS")
+            started = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - started
+            report = {
+                "result": result,
+                "seconds": elapsed,
+                "peak_rss": _read_status("VmHWM") - start_rss,
+            }
+        except BaseException as e:
+            report = {"error": repr(e)}
+        with os.fdopen(write_fd, "w") as f:
+            f.write(json.dumps(report))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        report = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(report) if report else {"error": "killed"}
+
+
+def _healthkit_sample(i):
+    start = 1672531200000 + i * 5000
+    return {
+        "date_from": start,
+        "date_to": start + 5000,
+        "value": 60 + i % 40,
+        "source_name": "Apple Watch",
+        "source_id": "com.apple.health.4C9F1D2E-7A44-4E49-9B51-1F4A1D7C2B3E",
+    }
+
+
+def _write_healthkit_upload(f, size=None, samples=None):
+    """
+    Writes a json upload of heart rate samples to the file, either of about
+    `size` bytes or of `samples` samples. Returns the number of samples written.
+    """
+    f.write(b'{"heart_rate": [')
+    written, count = 0, 0
+    while written < size if size is not None else count < samples:
+        sample = json.dumps(_healthkit_sample(count)).encode("utf-8")
+        if count:
+            sample = b", " + sample
+        f.write(sample)
+        written += len(sample)
+        count += 1
+    f.write(b"]}")
+    return count
+
+
+def _write_columnar_upload(f, count):
+    """
+    Writes the same heart rate samples as `_write_healthkit_upload` as a
+    columnar npz upload, see `_iter_columnar_batches`
+    """
+    samples = [_healthkit_sample(i) for i in range(count)]
+    source_names = sorted({sample["source_name"] for sample in samples})
+    source_ids = sorted({sample["source_id"] for sample in samples})
+    start_times = np.array([sample["date_from"] for sample in samples], np.int64)
+    np.savez(
+        f,
+        source_names=np.array(source_names),
+        source_ids=np.array(source_ids),
+        **{
+            "heart_rate.date_from": np.diff(start_times, prepend=0),
+            "heart_rate.duration": np.array(
+                [sample["date_to"] - sample["date_from"] for sample in samples],
+                np.int64,
+            ),
+            "heart_rate.value": np.array([sample["value"] for sample in samples]),
+            "heart_rate.source_name": np.array(
+                [source_names.index(sample["source_name"]) for sample in samples],
+                np.int32,
+            ),
+            "heart_rate.source_id": np.array(
+                [source_ids.index(sample["source_id"]) for sample in samples],
+                np.int32,
+            ),
+        },
+    )
+
+
+def _count_json_samples(data_file):
+    """
+    Parses and normalizes an upload as `process_healthkit_upload` does,
+    without processing the batches
+    """
+    batches = _iter_json_batches(
+        data_file,
+        {"heart_rate": apple_healthkit.DATATYPE_NAME_CLASS_MAP["heart_rate"]},
+        types.SimpleNamespace(sync_manual_entries=False),
+        {},
+    )
+    return sum(len(batch["heart_rate"]) for batch in batches)
+
+
+def _count_columnar_samples(data_file):
+    """
+    Same as `_count_json_samples` for a columnar upload
+    """
+    batches = _iter_columnar_batches(
+        data_file,
+        {"heart_rate": apple_healthkit.DATATYPE_NAME_CLASS_MAP["heart_rate"]},
+        types.SimpleNamespace(sync_manual_entries=False),
+        {},
+    )
+    return sum(len(batch["heart_rate"]) for batch in batches)
+
+
+class HealthkitUploadMemoryBenchmark(SimpleTestCase):
+    """
+    Peak memory of parsing json uploads incrementally, compared to loading
+    them at once with json.loads as the upload api used to. The sizes in MB
+    are read from `BENCHMARK_UPLOAD_SIZES`.
+    """
+
+    def test_peak_rss(self):
+        sizes = os.environ.get("BENCHMARK_UPLOAD_SIZES", "10,100,500")
+        print()
+        print("upload   samples    streaming: peak RSS, time   json.loads: peak RSS")
+        for size in [int(size) for size in sizes.split(",")]:
+            with tempfile.NamedTemporaryFile() as f:
+                samples = _write_healthkit_upload(f, size * MB)
+                f.flush()
+
+                def _stream():
+                    with open(f.name, "rb") as data_file:
+                        return _count_json_samples(data_file)
+
+                def _load():
+                    with open(f.name, "rb") as data_file:
+                        return len(json.loads(data_file.read())["heart_rate"])
+
+                streamed = _measure_in_child(_stream)
+                loaded = _measure_in_child(_load)
+
+            print(
+                f"{size:>4} MB {samples:>10}"
+                f"    {self._format(streamed)}"
+                f"   {self._format(loaded, seconds=False)}"
+            )
+
+    def _format(self, report, seconds=True):
+        if "error" in report:
+            return f"{report['error']:>20}"
+        text = f"{report['peak_rss'] / MB:>8.1f} MB"
+        if seconds:
+            text += f", {report['seconds']:>6.1f}s"
+        return text
+
+
+class CompressionBenchmark(SimpleTestCase):
+    """
+    Bytes on the wire and CPU time of the gzip and zstd encodings, for a
+    HealthKit upload of `BENCHMARK_COMPRESSED_UPLOAD_SIZE` MB and for the
+    webhook chunks we send
+    """
+
+    def test_upload(self):
+        size = int(os.environ.get("BENCHMARK_COMPRESSED_UPLOAD_SIZE", "100"))
+        with tempfile.TemporaryFile() as f:
+            samples = _write_healthkit_upload(f, size * MB)
+            f.seek(0)
+            data = f.read()
+
+        print()
+        print(f"{size} MB upload, {samples} samples")
+        print("encoding        bytes   ratio   compress   decompress + parse")
+        for encoding in (None,) + ENCODINGS:
+            started = time.process_time()
+            body = compress(data, encoding) if encoding else data
+            compressed = time.process_time() - started
+
+            started = time.process_time()
+            parsed = _count_json_samples(open_decompressed(io.BytesIO(body)))
+            parse = time.process_time() - started
+            self.assertEqual(parsed, samples)
+
+            print(
+                f"{encoding or 'none':<8} {len(body):>12} {len(data) / len(body):>7.1f}"
+                f" {compressed:>9.2f}s {parse:>19.2f}s"
+            )
+
+    def test_webhook_chunk(self):
+        chunk = {
+            "heart_rate": [
+                HeartRate(
+                    start_time=sample["date_from"],
+                    end_time=sample["date_to"],
+                    manual_entry=False,
+                    value=sample["value"],
+                    source="apple_healthkit",
+                    source_device=sample["source_name"],
+                ).to_dict()
+                for sample in map(_healthkit_sample, range(MAX_CHUNK_SAMPLES))
+            ]
+        }
+        data = json.dumps({"data": chunk, "uuid": "benchmark"}).encode("utf-8")
+        rounds = 200
+
+        print()
+        print(f"webhook chunk of {MAX_CHUNK_SAMPLES} samples, {rounds} rounds")
+        print("encoding   bytes   ratio   compress/chunk")
+        for encoding in ENCODINGS:
+            started = time.process_time()
+            for _ in range(rounds):
+                body = compress(data, encoding)
+            compressed = (time.process_time() - started) / rounds
+
+            print(
+                f"{encoding:<8} {len(body):>7} {len(data) / len(body):>7.1f}"
+                f" {compressed * 1000:>13.2f}ms"
+            )
+        print(f"none     {len(data):>7}")
+
+
+class ColumnarUploadBenchmark(SimpleTestCase):
+    """
+    Parse and normalize time of the json and columnar npz upload formats for
+    `BENCHMARK_SAMPLES` heart rate samples
+    """
+
+    def test_parse(self):
+        count = int(os.environ.get("BENCHMARK_SAMPLES", "1000000"))
+        with tempfile.TemporaryFile() as json_file, tempfile.TemporaryFile() as npz:
+            _write_healthkit_upload(json_file, samples=count)
+            _write_columnar_upload(npz, count)
+            json_file.flush()
+            npz.flush()
+
+            print()
+            print(f"{count} samples")
+            print("format        bytes   parse + normalize")
+            for name, data_file, parse in (
+                ("json", json_file, _count_json_samples),
+                ("npz", npz, _count_columnar_samples),
+            ):
+                size = os.fstat(data_file.fileno()).st_size
+                data_file.seek(0)
+                started = time.process_time()
+                parsed = parse(data_file)
+                elapsed = time.process_time() - started
+                self.assertEqual(parsed, count)
+                print(f"{name:<6} {size:>12} {elapsed:>18.2f}s")
+
+
+class BatchToDictBenchmark(SimpleTestCase):
+    """
+    Time to normalize `BENCHMARK_SAMPLES` samples with `batch_to_dict`,
+    compared to building a dataclass and calling `to_dict()` for every sample
+    """
+
+    def test_normalize(self):
+        count = int(os.environ.get("BENCHMARK_SAMPLES", "1000000"))
+        samples = [_healthkit_sample(i) for i in range(count)]
+        columns = {
+            "start_time": [sample["date_from"] for sample in samples],
+            "end_time": [sample["date_to"] for sample in samples],
+            "manual_entry": [False] * count,
+            "source_device": [sample["source_name"] for sample in samples],
+            "value": [sample["value"] for sample in samples],
+        }
+        constants = {"source": "apple_healthkit"}
+
+        print()
+        print(f"{count} samples")
+        print("dataclass    to_dict()   batch_to_dict   speedup")
+        for dclass, extra in (
+            (HeartRate, {}),
+            (Sleep, {"sleep_type": ["deep"] * count}),
+        ):
+            batch = {**columns, **extra}
+
+            started = time.process_time()
+            expected = [
+                dclass(**constants, **dict(zip(batch, row))).to_dict()
+                for row in zip(*batch.values())
+            ]
+            per_sample = time.process_time() - started
+
+            started = time.process_time()
+            normalized = batch_to_dict(dclass, batch, constants)
+            batched = time.process_time() - started
+
+            self.assertEqual(len(normalized), len(expected))
+            print(
+                f"{dclass.__name__:<10} {per_sample:>10.2f}s {batched:>14.2f}s"
+                f" {per_sample / batched:>8.0f}x"
+            )
+
+
+class _StubReceiverHandler(BaseHTTPRequestHandler):
+    """
+    Webhook receiver which accepts every chunk, keeping connections alive
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _create_certificate(directory):
+    """
+    Creates a self signed certificate for localhost with the openssl cli,
+    returns the paths of the certificate and of its key
+    """
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+class WebhookDeliveryBenchmark(SimpleTestCase):
+    """
+    Chunks per second sent to a local stub receiver with a new connection for
+    every chunk, as `requests.post` does, compared to the pooled keep-alive
+    sessions of `get_session`. `BENCHMARK_REQUESTS` chunks are sent over http
+    and, if the openssl cli is available, over https.
+    """
+
+    def test_throughput(self):
+        count = int(os.environ.get("BENCHMARK_REQUESTS", "1000"))
+        chunk = {"heart_rate": [_healthkit_sample(i) for i in range(MAX_CHUNK_SAMPLES)]}
+        body = compress(
+            json.dumps({"data": chunk, "uuid": "benchmark"}).encode("utf-8"), "zstd"
+        )
+        headers = {"Content-Type": "application/json", "Content-Encoding": "zstd"}
+
+        print()
+        print(f"{count} chunks of {len(body)} bytes")
+        print("scheme   requests.post   get_session   speedup")
+        with tempfile.TemporaryDirectory() as directory:
+            for scheme in ("http", "https"):
+                if scheme == "https" and not shutil.which("openssl"):
+                    print("https    skipped, the openssl cli is not available")
+                    continue
+
+                server = ThreadingHTTPServer(("localhost", 0), _StubReceiverHandler)
+                verify = True
+                if scheme == "https":
+                    cert, key = _create_certificate(directory)
+                    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                    context.load_cert_chain(cert, key)
+                    server.socket = context.wrap_socket(server.socket, server_side=True)
+                    verify = cert
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                url = f"{scheme}://localhost:{server.server_port}/webhook"
+
+                try:
+                    rates = []
+                    for pooled in (False, True):
+                        started = time.perf_counter()
+                        for _ in range(count):
+                            post = get_session(url).post if pooled else requests.post
+                            response = post(
+                                url,
+                                headers=headers,
+                                data=body,
+                                timeout=10,
+                                verify=verify,
+                            )
+                            response.raise_for_status()
+                        rates.append(count / (time.perf_counter() - started))
+                finally:
+                    server.shutdown()
+                    server.server_close()
+
+                print(
+                    f"{scheme:<6} {rates[0]:>12.0f}/s {rates[1]:>11.0f}/s"
+                    f" {rates[1] / rates[0]:>8.1f}x"
+                )
+
+
+class StoreHealthDataBenchmark(TransactionTestCase):
+    """
+    Rows per second stored by `store_health_data` for `BENCHMARK_SAMPLES`
+    samples, in batches of PROCESS_BATCH_SIZE committed one at a time as the
+    upload jobs do: new samples, the same samples again which are no-ops, and
+    the same samples with changed values which are updates
+    """
+
+    def test_upsert(self):
+        count = int(os.environ.get("BENCHMARK_SAMPLES", "1000000"))
+        # bulk_create skips the signals which queue emails for new users
+        (user,) = User.objects.bulk_create(
+            [User(name="benchmark", email="benchmark@example.com")]
+        )
+        (app,) = UserApp.objects.bulk_create(
+            [UserApp(name="benchmark", user=user, key="benchmark")]
+        )
+        connection = WatchConnection.objects.create(app=app, user_uuid="benchmark")
+        Platform.objects.create(name="apple_healthkit")
+        DataType.objects.create(name="heart_rate")
+
+        # the samples start at the current month, which has a partition
+        start = int(_month_start(timezone.now()).timestamp() * 1000)
+        print()
+        print(f"{count} samples")
+        print("run        rows/s     time")
+        for run, offset in (("insert", 0), ("no-op", 0), ("update", 1)):
+            # only the time spent storing the batches is counted
+            elapsed = 0
+            for i in range(0, count, PROCESS_BATCH_SIZE):
+                batch = []
+                for j in range(i, min(i + PROCESS_BATCH_SIZE, count)):
+                    sample = _healthkit_sample(j)
+                    batch.append(
+                        {
+                            "source": "apple_healthkit",
+                            "start_time": start + j * 5000,
+                            "end_time": start + j * 5000 + 5000,
+                            "manual_entry": False,
+                            "source_device": sample["source_name"],
+                            "value": sample["value"] + offset,
+                        }
+                    )
+                started = time.perf_counter()
+                with transaction.atomic():
+                    store_health_data(
+                        {"heart_rate": batch}, connection, "apple_healthkit"
+                    )
+                elapsed += time.perf_counter() - started
+            print(f"{run:<8} {count / elapsed:>8.0f} {elapsed:>7.1f}s")
+
+        self.assertEqual(HealthDataEntry.objects.count(), count)
+
+
+DAY = 24 * 60 * 60 * 1000
+
+
+def _healthkit_day(day, rng):
+    """
+    Webhook data of a day of HealthKit: heart rate every 5 minutes, hourly
+    steps and a night of sleep stages
+    """
+    start = 1672531200000 + day * DAY
+    common = {"source": "apple_healthkit", "manual_entry": False}
+    heart_rate = [
+        HeartRate(
+            **common,
+            start_time=start + i * 300000,
+            end_time=start + i * 300000,
+            source_device="Apple Watch",
+            value=float(rng.randint(50, 140)),
+        ).to_dict()
+        for i in range(288)
+    ]
+    steps = [
+        Steps(
+            **common,
+            start_time=start + i * 3600000,
+            end_time=start + (i + 1) * 3600000,
+            source_device=rng.choice(["Apple Watch", "iPhone"]),
+            value=rng.randint(0, 2500),
+        ).to_dict()
+        for i in range(24)
+    ]
+    sleep, time_asleep = [], start - 2 * 3600000
+    for _ in range(20):
+        duration = rng.randint(5, 45) * 60000
+        sleep.append(
+            Sleep(
+                **common,
+                start_time=time_asleep,
+                end_time=time_asleep + duration,
+                source_device="Apple Watch",
+                sleep_type=rng.choice(["awake", "light", "deep", "rem"]),
+                value=duration,
+            ).to_dict()
+        )
+        time_asleep += duration
+    return {"heart_rate": heart_rate, "steps": steps, "sleep": sleep}
+
+
+def _strava_day(day, rng):
+    """
+    Webhook data of a day of Strava: one activity, with the activity fields
+    besides the value which are stored as extra_data
+    """
+    start = 1672531200000 + day * DAY + 7 * 3600000
+    key, dclass = rng.choice(
+        [
+            ("strava_run", StravaRun),
+            ("strava_cycling", StravaCycling),
+            ("strava_walk", StravaWalk),
+        ]
+    )
+    moving_time = rng.randint(900, 7200)
+    distance = round(moving_time * rng.uniform(1.2, 8.0), 1)
+    activity = dclass(
+        source="strava",
+        start_time=start,
+        end_time=start,
+        manual_entry=False,
+        source_device=None,
+        activity_id=rng.randint(10**9, 10**10),
+        distance=distance,
+        moving_time=moving_time,
+        max_speed=round(distance / moving_time * rng.uniform(1.2, 2.0), 3),
+        average_speed=round(distance / moving_time, 3),
+        total_elevation_gain=round(rng.uniform(0, 300), 1),
+    )
+    return {key: [activity.to_dict()]}
+
+
+class WebhookPayloadBenchmark(SimpleTestCase):
+    """
+    Bytes per webhook request of a first sync of `BENCHMARK_DAYS` days for
+    mixes of data types, packed in chunks as `_split_data_into_chunks` does
+    with the default max request size, for every encoding
+    """
+
+    def test_payload_sizes(self):
+        days = int(os.environ.get("BENCHMARK_DAYS", "30"))
+        rng = random.Random(0)
+        healthkit = [_healthkit_day(day, rng) for day in range(days)]
+        strava = [_strava_day(day, rng) for day in range(days)]
+        mixes = {
+            "heart_rate": [{"heart_rate": d["heart_rate"]} for d in healthkit],
+            "healthkit": healthkit,
+            "strava": strava,
+            "all": healthkit + strava,
+        }
+
+        print()
+        print(f"first sync of {days} days")
+        print("mix          requests   encoding   bytes/request   total bytes   ratio")
+        for name, mix in mixes.items():
+            fitness_data = {}
+            for data in mix:
+                for data_type, samples in data.items():
+                    fitness_data.setdefault(data_type, []).extend(samples)
+            chunks = _split_data_into_chunks(
+                fitness_data, settings.WEBHOOK_MAX_REQUEST_BYTES
+            )
+            # the bodies as `_send_chunk` builds them
+            bodies = [
+                json.dumps({"data": chunk, "uuid": "benchmark"}).encode("utf-8")
+                for chunk in chunks
+            ]
+            raw = sum(len(body) for body in bodies)
+            for encoding in (None,) + ENCODINGS:
+                total = sum(
+                    len(compress(body, encoding) if encoding else body)
+                    for body in bodies
+                )
+                print(
+                    f"{name:<12} {len(bodies):>8}   {encoding or 'none':<8}"
+                    f" {total / len(bodies):>15.0f} {total:>13} {raw / total:>7.1f}"
+                )
@@ -1,5 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from dataclasses_json import dataclass_json
+from itertools import repeat
 from typing import Optional
 
 
@@ -120,3 +121,30 @@ class StravaWalk(FitnessDatatype):
     max_speed: float
     average_speed: float
     total_elevation_gain: float
+
+
+def batch_to_dict(dclass, columns, constants=None):
+    """
+    Normalizes a batch of samples into the same dicts as `dclass(...).to_dict()`
+    without building a dataclass object for every sample.
+
+    :param dclass: one of the fitness dataclasses above
+    :param columns: dict of field name -> list (or numpy array) of values, all
+        of the same length
+    :param constants: dict of field name -> value shared by all the samples
+    """
+    constants = constants or {}
+    names = [f.name for f in fields(dclass)]
+    missing = [name for name in names if name not in columns and name not in constants]
+    if missing:
+        raise TypeError(f"{dclass.__name__} is missing fields {missing}")
+
+    values = []
+    for name in names:
+        if name in columns:
+            column = columns[name]
+            values.append(column.tolist() if hasattr(column, "tolist") else column)
+        else:
+            values.append(repeat(constants[name]))
+
+    return [dict(zip(names, row)) for row in zip(*values)]
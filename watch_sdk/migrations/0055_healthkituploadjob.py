@@ -0,0 +1,32 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0054_healthdataentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HealthkitUploadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('file_path', models.CharField(max_length=500)),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('processing', 'processing'), ('completed', 'completed'), ('failed', 'failed')], default='queued', max_length=100)),
+                ('records_processed', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='watch_sdk.watchconnection')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
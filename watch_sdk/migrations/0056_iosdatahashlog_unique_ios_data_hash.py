@@ -0,0 +1,29 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0055_healthkituploadjob'),
+    ]
+
+    operations = [
+        # concurrent uploads could have logged the same hash twice, keep only
+        # the oldest entry before adding the constraint
+        migrations.RunSQL(
+            """
+            DELETE FROM watch_sdk_iosdatahashlog a
+            USING watch_sdk_iosdatahashlog b
+            WHERE a.connection_id = b.connection_id
+              AND a.hash = b.hash
+              AND a.id > b.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='iosdatahashlog',
+            constraint=models.UniqueConstraint(fields=('connection', 'hash'), name='unique_ios_data_hash'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0056_iosdatahashlog_unique_ios_data_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HealthkitUploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('total_parts', models.IntegerField(blank=True, null=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='watch_sdk.watchconnection')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='HealthkitUploadPart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('number', models.IntegerField()),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='watch_sdk.healthkituploadjob')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='watch_sdk.healthkituploadsession')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='healthkituploadpart',
+            constraint=models.UniqueConstraint(fields=('session', 'number'), name='unique_healthkit_upload_part'),
+        ),
+    ]
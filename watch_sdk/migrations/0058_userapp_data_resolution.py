@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0057_healthkituploadsession_healthkituploadpart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userapp',
+            name='data_resolution',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0058_userapp_data_resolution'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('data', models.JSONField()),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='watch_sdk.watchconnection')),
+                ('platform', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='watch_sdk.platform')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0059_webhookoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unprocesseddata',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='unprocesseddata',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unprocesseddata',
+            name='status',
+            field=models.CharField(choices=[('pending', 'pending'), ('dead', 'dead')], default='pending', max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='unprocesseddata',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='unprocessed_data_due_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0060_unprocesseddata_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userapp',
+            name='webhook_rate_limit',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0061_userapp_webhook_rate_limit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userapp',
+            name='webhook_compression',
+            field=models.CharField(choices=[('none', 'none'), ('gzip', 'gzip'), ('zstd', 'zstd')], default='none', max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0062_userapp_webhook_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userapp',
+            name='webhook_max_request_bytes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
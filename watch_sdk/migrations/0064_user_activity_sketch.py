@@ -0,0 +1,29 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0063_userapp_webhook_max_request_bytes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserActivitySketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('date', models.DateField()),
+                ('sketch', models.BinaryField()),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='watch_sdk.userapp')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='useractivitysketch',
+            constraint=models.UniqueConstraint(fields=('app', 'date'), name='unique_user_activity_sketch'),
+        ),
+    ]
@@ -0,0 +1,232 @@
+# Generated by Django 4.1.4 on 2026-10-17 10:45
+
+from django.db import migrations
+
+# rows copied per statement by copy_rows
+COPY_BATCH_SIZE = 10000
+
+
+def copy_rows(apps, schema_editor):
+    """
+    Copies the existing rows to the partitioned table in batches of ids. The
+    rows of a batch are locked for share while they are copied, so that a
+    concurrent update or delete of one of them waits for the copy and is then
+    mirrored by the trigger. Rows written after the max id was read are
+    mirrored by the trigger only.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT coalesce(max(id), 0) FROM watch_sdk_healthdataentry')
+        (max_id,) = cursor.fetchone()
+        for start in range(0, max_id + 1, COPY_BATCH_SIZE):
+            cursor.execute(
+                """
+                INSERT INTO watch_sdk_healthdataentry_new
+                SELECT * FROM (
+                    SELECT * FROM watch_sdk_healthdataentry
+                    WHERE id >= %s AND id < %s
+                    FOR SHARE
+                ) batch
+                ON CONFLICT DO NOTHING
+                """,
+                [start, start + COPY_BATCH_SIZE],
+            )
+
+
+class Migration(migrations.Migration):
+
+    # the rows are copied in many short transactions while the table is
+    # written to, writes are only blocked for the final swap
+    atomic = False
+
+    dependencies = [
+        ('watch_sdk', '0064_user_activity_sketch'),
+    ]
+
+    operations = [
+        # The partitioned table, with a partition for every month (UTC) which
+        # has data and for the next months. Rows of other months go to the
+        # default partition. See utils/health_data_partitions.py.
+        migrations.RunSQL(
+            [
+                """
+                CREATE TABLE watch_sdk_healthdataentry_new (
+                    LIKE watch_sdk_healthdataentry INCLUDING DEFAULTS
+                ) PARTITION BY RANGE (start_time)
+                """,
+                """
+                ALTER TABLE watch_sdk_healthdataentry_new
+                ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY
+                """,
+                # the primary key of a partitioned table has to include
+                # start_time
+                """
+                ALTER TABLE watch_sdk_healthdataentry_new
+                ADD CONSTRAINT watch_sdk_healthdataentry_new_pkey
+                PRIMARY KEY (id, start_time)
+                """,
+                """
+                ALTER TABLE watch_sdk_healthdataentry_new
+                ADD CONSTRAINT watch_sdk_healthdataentry_user_connection_id_fkey
+                FOREIGN KEY (user_connection_id)
+                REFERENCES watch_sdk_watchconnection (id)
+                DEFERRABLE INITIALLY DEFERRED,
+                ADD CONSTRAINT watch_sdk_healthdataentry_source_platform_id_fkey
+                FOREIGN KEY (source_platform_id)
+                REFERENCES watch_sdk_platform (id)
+                DEFERRABLE INITIALLY DEFERRED,
+                ADD CONSTRAINT watch_sdk_healthdataentry_data_type_id_fkey
+                FOREIGN KEY (data_type_id)
+                REFERENCES watch_sdk_datatype (id)
+                DEFERRABLE INITIALLY DEFERRED
+                """,
+                """
+                CREATE INDEX watch_sdk_healthdataentry_user_connection_id_idx
+                ON watch_sdk_healthdataentry_new (user_connection_id)
+                """,
+                """
+                CREATE INDEX watch_sdk_healthdataentry_source_platform_id_idx
+                ON watch_sdk_healthdataentry_new (source_platform_id)
+                """,
+                """
+                CREATE INDEX watch_sdk_healthdataentry_data_type_id_idx
+                ON watch_sdk_healthdataentry_new (data_type_id)
+                """,
+                """
+                CREATE TABLE watch_sdk_healthdataentry_default
+                PARTITION OF watch_sdk_healthdataentry_new DEFAULT
+                """,
+                """
+                DO $$
+                DECLARE
+                    month_start timestamptz;
+                BEGIN
+                    FOR month_start IN
+                        SELECT DISTINCT date_trunc('month', start_time, 'UTC')
+                        FROM watch_sdk_healthdataentry
+                        UNION
+                        SELECT date_trunc('month', now(), 'UTC') + make_interval(months => i)
+                        FROM generate_series(0, 3) i
+                    LOOP
+                        EXECUTE format(
+                            'CREATE TABLE watch_sdk_healthdataentry_p%s
+                             PARTITION OF watch_sdk_healthdataentry_new
+                             FOR VALUES FROM (%L) TO (%L)',
+                            to_char(month_start AT TIME ZONE 'UTC', 'YYYY_MM'),
+                            month_start,
+                            month_start + interval '1 month'
+                        );
+                    END LOOP;
+                END
+                $$
+                """,
+            ],
+            ['DROP TABLE IF EXISTS watch_sdk_healthdataentry_new'],
+        ),
+        # mirrors the writes to the table into the partitioned table while the
+        # existing rows are copied
+        migrations.RunSQL(
+            [
+                """
+                CREATE FUNCTION watch_sdk_healthdataentry_mirror() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                        DELETE FROM watch_sdk_healthdataentry_new
+                        WHERE id = OLD.id AND start_time = OLD.start_time;
+                    END IF;
+                    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                        INSERT INTO watch_sdk_healthdataentry_new
+                        SELECT (NEW).*
+                        ON CONFLICT DO NOTHING;
+                    END IF;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE TRIGGER watch_sdk_healthdataentry_mirror
+                AFTER INSERT OR UPDATE OR DELETE ON watch_sdk_healthdataentry
+                FOR EACH ROW EXECUTE FUNCTION watch_sdk_healthdataentry_mirror()
+                """,
+            ],
+            [
+                'DROP TRIGGER IF EXISTS watch_sdk_healthdataentry_mirror ON watch_sdk_healthdataentry',
+                'DROP FUNCTION IF EXISTS watch_sdk_healthdataentry_mirror()',
+            ],
+        ),
+        migrations.RunPython(copy_rows, migrations.RunPython.noop),
+        # Swaps in the partitioned table, which has all the rows by now. The
+        # reverse copies the rows back to a plain table, with writes blocked.
+        migrations.RunSQL(
+            [
+                """
+                DO $$
+                DECLARE
+                    next_id bigint;
+                BEGIN
+                    PERFORM set_config('lock_timeout', '10s', true);
+                    LOCK TABLE watch_sdk_healthdataentry IN ACCESS EXCLUSIVE MODE;
+                    SELECT coalesce(max(id), 0) + 1 INTO next_id
+                    FROM watch_sdk_healthdataentry;
+
+                    DROP TABLE watch_sdk_healthdataentry;
+                    DROP FUNCTION watch_sdk_healthdataentry_mirror();
+                    ALTER TABLE watch_sdk_healthdataentry_new
+                    RENAME TO watch_sdk_healthdataentry;
+                    ALTER INDEX watch_sdk_healthdataentry_new_pkey
+                    RENAME TO watch_sdk_healthdataentry_pkey;
+                    ALTER SEQUENCE watch_sdk_healthdataentry_new_id_seq
+                    RENAME TO watch_sdk_healthdataentry_id_seq;
+                    EXECUTE format(
+                        'ALTER TABLE watch_sdk_healthdataentry ALTER COLUMN id RESTART WITH %s',
+                        next_id
+                    );
+                END
+                $$
+                """
+            ],
+            [
+                """
+                DO $$
+                DECLARE
+                    next_id bigint;
+                BEGIN
+                    LOCK TABLE watch_sdk_healthdataentry IN ACCESS EXCLUSIVE MODE;
+                    SELECT coalesce(max(id), 0) + 1 INTO next_id
+                    FROM watch_sdk_healthdataentry;
+
+                    CREATE TABLE watch_sdk_healthdataentry_plain (
+                        LIKE watch_sdk_healthdataentry INCLUDING DEFAULTS
+                    );
+                    INSERT INTO watch_sdk_healthdataentry_plain
+                    SELECT * FROM watch_sdk_healthdataentry;
+                    ALTER TABLE watch_sdk_healthdataentry_plain
+                    ADD CONSTRAINT watch_sdk_healthdataentry_plain_pkey PRIMARY KEY (id),
+                    ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY,
+                    ADD FOREIGN KEY (user_connection_id)
+                    REFERENCES watch_sdk_watchconnection (id)
+                    DEFERRABLE INITIALLY DEFERRED,
+                    ADD FOREIGN KEY (source_platform_id)
+                    REFERENCES watch_sdk_platform (id)
+                    DEFERRABLE INITIALLY DEFERRED,
+                    ADD FOREIGN KEY (data_type_id)
+                    REFERENCES watch_sdk_datatype (id)
+                    DEFERRABLE INITIALLY DEFERRED;
+                    CREATE INDEX ON watch_sdk_healthdataentry_plain (user_connection_id);
+                    CREATE INDEX ON watch_sdk_healthdataentry_plain (source_platform_id);
+                    CREATE INDEX ON watch_sdk_healthdataentry_plain (data_type_id);
+
+                    DROP TABLE watch_sdk_healthdataentry;
+                    ALTER TABLE watch_sdk_healthdataentry_plain
+                    RENAME TO watch_sdk_healthdataentry;
+                    ALTER INDEX watch_sdk_healthdataentry_plain_pkey
+                    RENAME TO watch_sdk_healthdataentry_pkey;
+                    EXECUTE format(
+                        'ALTER TABLE watch_sdk_healthdataentry ALTER COLUMN id RESTART WITH %s',
+                        next_id
+                    );
+                END
+                $$
+                """
+            ],
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.1.4 on 2026-10-17 11:05
+
+from django.db import migrations, models
+
+INDEX = 'healthdataentry_lookup_idx'
+COLUMNS = 'user_connection_id, source_platform_id, data_type_id, start_time'
+INCLUDE = 'end_time, value'
+
+
+def create_index(apps, schema_editor):
+    """
+    Indexes on partitioned tables can't be built concurrently. The index is
+    created on the parent only, then built concurrently on every partition and
+    attached to it, it becomes valid once all partitions are attached.
+    Partitions created later get the index when they are attached.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {INDEX} ON ONLY watch_sdk_healthdataentry ({COLUMNS}) INCLUDE ({INCLUDE})'
+        )
+        cursor.execute(
+            """
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'watch_sdk_healthdataentry'::regclass
+            """
+        )
+        for (partition,) in cursor.fetchall():
+            name = f'{partition}_lookup_idx'
+            # left behind by an interrupted build
+            cursor.execute(
+                """
+                SELECT 1 FROM pg_index
+                WHERE indexrelid = to_regclass(%s) AND NOT indisvalid
+                """,
+                [name],
+            )
+            if cursor.fetchone():
+                cursor.execute(f'DROP INDEX CONCURRENTLY {name}')
+            cursor.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {partition} ({COLUMNS}) INCLUDE ({INCLUDE})'
+            )
+            cursor.execute(f'ALTER INDEX {INDEX} ATTACH PARTITION {name}')
+
+
+def drop_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP INDEX IF EXISTS {INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('watch_sdk', '0065_partition_healthdataentry'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_index, drop_index),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='healthdataentry',
+                    index=models.Index(fields=['user_connection', 'source_platform', 'data_type', 'start_time'], include=('end_time', 'value'), name='healthdataentry_lookup_idx'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 4.1.4 on 2026-10-17 11:20
+
+from django.db import migrations, models
+import django.db.models.functions.comparison
+
+INDEX = 'unique_health_data_entry'
+COLUMNS = "user_connection_id, source_platform_id, data_type_id, start_time, end_time, (COALESCE(source_device, ''))"
+
+
+def _get_partitions(cursor):
+    cursor.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'watch_sdk_healthdataentry'::regclass
+        """
+    )
+    return [partition for (partition,) in cursor.fetchall()]
+
+
+def delete_duplicates(apps, schema_editor):
+    """
+    Keeps the latest copy of every sample, one partition at a time. Copies of
+    a sample have the same start_time, so they are in the same partition.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        for partition in _get_partitions(cursor):
+            cursor.execute(
+                f"""
+                DELETE FROM {partition} a
+                USING {partition} b
+                WHERE a.user_connection_id = b.user_connection_id
+                  AND a.source_platform_id = b.source_platform_id
+                  AND a.data_type_id = b.data_type_id
+                  AND a.start_time = b.start_time
+                  AND a.end_time = b.end_time
+                  AND COALESCE(a.source_device, '') = COALESCE(b.source_device, '')
+                  AND a.id < b.id
+                """
+            )
+
+
+def create_index(apps, schema_editor):
+    """
+    Same as healthdataentry_lookup_idx, the unique index is built concurrently
+    on every partition and attached to the index of the partitioned table
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS {INDEX} ON ONLY watch_sdk_healthdataentry ({COLUMNS})'
+        )
+        for partition in _get_partitions(cursor):
+            name = f'{partition}_natural_key'
+            # left behind by an interrupted build, eg. on a duplicate written
+            # after they were deleted
+            cursor.execute(
+                """
+                SELECT 1 FROM pg_index
+                WHERE indexrelid = to_regclass(%s) AND NOT indisvalid
+                """,
+                [name],
+            )
+            if cursor.fetchone():
+                cursor.execute(f'DROP INDEX CONCURRENTLY {name}')
+            cursor.execute(
+                f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {partition} ({COLUMNS})'
+            )
+            cursor.execute(f'ALTER INDEX {INDEX} ATTACH PARTITION {name}')
+
+
+def drop_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP INDEX IF EXISTS {INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('watch_sdk', '0066_healthdataentry_lookup_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_index, drop_index),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='healthdataentry',
+                    constraint=models.UniqueConstraint(models.F('user_connection'), models.F('source_platform'), models.F('data_type'), models.F('start_time'), models.F('end_time'), django.db.models.functions.comparison.Coalesce('source_device', models.Value('')), name='unique_health_data_entry'),
+                ),
+            ],
+        ),
+    ]
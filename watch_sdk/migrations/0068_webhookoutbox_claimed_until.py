@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-17 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0067_healthdataentry_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookoutbox',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
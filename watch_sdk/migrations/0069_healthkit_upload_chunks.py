@@ -0,0 +1,38 @@
+# Generated by Django 4.1.4 on 2026-10-17 11:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('watch_sdk', '0068_webhookoutbox_claimed_until'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='healthkituploadjob',
+            name='file_path',
+        ),
+        migrations.AddField(
+            model_name='healthkituploadjob',
+            name='hash',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.CreateModel(
+            name='HealthkitUploadChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('number', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='watch_sdk.healthkituploadjob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='healthkituploadchunk',
+            constraint=models.UniqueConstraint(fields=('job', 'number'), name='unique_healthkit_upload_chunk'),
+        ),
+    ]
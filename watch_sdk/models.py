@@ -1,6 +1,9 @@
 import copy
 from typing import Any
+import uuid
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Coalesce
 from django.contrib.postgres.fields import ArrayField
 
 from core.models import BaseModel
@@ -89,6 +92,26 @@ class UserApp(BaseModel):
         ),
         default="deny",
     )
+    # resolution at which data is delivered over webhook for each data type,
+    # eg. {"heart_rate": "1m"}. Data types not listed are delivered raw.
+    # See watch_sdk.utils.downsample for the supported resolutions.
+    data_resolution = models.JSONField(blank=True, null=True)
+    # max webhook calls per second, overrides the default of the payment plan
+    # (see WEBHOOK_RATE_LIMITS in settings)
+    webhook_rate_limit = models.FloatField(blank=True, null=True)
+    # compression of the webhook request bodies, sent as Content-Encoding
+    webhook_compression = models.CharField(
+        max_length=100,
+        choices=(
+            ("none", "none"),
+            ("gzip", "gzip"),
+            ("zstd", "zstd"),
+        ),
+        default="none",
+    )
+    # max size of the webhook request bodies before compression, in bytes.
+    # Defaults to WEBHOOK_MAX_REQUEST_BYTES in settings
+    webhook_max_request_bytes = models.PositiveIntegerField(blank=True, null=True)
 
     def __str__(self) -> str:
         return f"{self.name} - {self.user.name} ({self.id})"
@@ -104,6 +127,8 @@ class ConnectedPlatformMetadata(BaseModel):
     gfit_access_exp = models.DateTimeField(blank=True, null=True)
     # to track whether the refresh token is valid or not
     logged_in = models.BooleanField(default=True)
+    # data type wise sync state, the last modified time for google fit and the
+    # end time of the latest uploaded sample for apple healthkit
     last_modified_for_data_types = models.JSONField(blank=True, null=True)
     # useful when syncing is done from local device and hence the connection
     # depends on which device the user is checking from
@@ -176,6 +201,13 @@ class IOSDataHashLog(BaseModel):
     hash = models.CharField(max_length=100)
     connection = models.ForeignKey(WatchConnection, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["connection", "hash"], name="unique_ios_data_hash"
+            )
+        ]
+
 
 class DebugWebhookLogs(BaseModel):
     app = models.ForeignKey(UserApp, on_delete=models.CASCADE)
@@ -192,6 +224,41 @@ class UnprocessedData(BaseModel):
     data = models.JSONField()
     connection = models.ForeignKey(WatchConnection, on_delete=models.CASCADE)
     platform = models.ForeignKey(Platform, on_delete=models.CASCADE)
+    # number of times the delivery of the data was retried, the row is moved
+    # to dead once the max number of attempts is reached
+    attempts = models.IntegerField(default=0)
+    # null when the data can be retried right away
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    status = models.CharField(
+        max_length=100,
+        choices=(
+            ("pending", "pending"),
+            ("dead", "dead"),
+        ),
+        default="pending",
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "next_attempt_at"], name="unprocessed_data_due_idx"
+            )
+        ]
+
+
+class WebhookOutbox(BaseModel):
+    """
+    Data waiting to be delivered to the webhook of the app. Rows are written
+    in the same transaction as the data is stored and are drained by the
+    webhook delivery workers.
+    """
+
+    data = models.JSONField()
+    connection = models.ForeignKey(WatchConnection, on_delete=models.CASCADE)
+    platform = models.ForeignKey(Platform, on_delete=models.CASCADE)
+    # set while a drain task is delivering the row, so that another drain
+    # doesn't deliver it again. The claim expires in case the task dies.
+    claimed_until = models.DateTimeField(blank=True, null=True)
 
 
 class PendingUserInvitation(BaseModel):
@@ -212,13 +279,40 @@ class UserActivityMetric(BaseModel):
     """
     This model is used to store the user activity metric. This is used to
     calculate DAU, WAU, MAU, and other user stats.
+
+    Not written anymore, the activity is counted in UserActivitySketch.
     """
 
     connection = models.ForeignKey(WatchConnection, on_delete=models.CASCADE)
     app = models.ForeignKey(UserApp, on_delete=models.CASCADE)
 
 
+class UserActivitySketch(BaseModel):
+    """
+    HyperLogLog sketch of the connections of an app which received data on a
+    day (UTC). The sketches are counted in redis and persisted here, they are
+    merged to get the DAU, WAU and MAU of the app, see utils/metrics.py.
+    """
+
+    app = models.ForeignKey(UserApp, on_delete=models.CASCADE)
+    date = models.DateField()
+    sketch = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["app", "date"], name="unique_user_activity_sketch"
+            )
+        ]
+
+
 class HealthDataEntry(BaseModel):
+    """
+    Health data stored on our servers. The table is partitioned by month of
+    start_time, see utils/health_data_partitions.py, so filter on start_time
+    to only read the partitions of that range.
+    """
+
     user_connection = models.ForeignKey(WatchConnection, on_delete=models.CASCADE)
     source_platform = models.ForeignKey(Platform, on_delete=models.CASCADE)
     data_type = models.ForeignKey(DataType, on_delete=models.CASCADE)
@@ -228,3 +322,106 @@ class HealthDataEntry(BaseModel):
     value = models.FloatField()
     extra_data = models.JSONField(blank=True, null=True)
     source_device = models.CharField(max_length=200, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # the stored health data APIs filter on all of these and sum
+            # value, which they can read from the index alone
+            models.Index(
+                fields=[
+                    "user_connection",
+                    "source_platform",
+                    "data_type",
+                    "start_time",
+                ],
+                include=["end_time", "value"],
+                name="healthdataentry_lookup_idx",
+            )
+        ]
+        constraints = [
+            # samples delivered again are updated in place instead of being
+            # stored twice, see store_health_data
+            models.UniqueConstraint(
+                "user_connection",
+                "source_platform",
+                "data_type",
+                "start_time",
+                "end_time",
+                Coalesce("source_device", Value("")),
+                name="unique_health_data_entry",
+            )
+        ]
+
+
+class HealthkitUploadJob(BaseModel):
+    """
+    Tracks an apple healthkit upload that is processed asynchronously. The raw
+    upload is stored in the database as HealthkitUploadChunk rows until a
+    celery task processes it, so that any worker can process it.
+    """
+
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    connection = models.ForeignKey(WatchConnection, on_delete=models.CASCADE)
+    # hash of the upload, see IOSDataHashLog
+    hash = models.CharField(max_length=100, blank=True, null=True)
+    status = models.CharField(
+        max_length=100,
+        choices=(
+            ("queued", "queued"),
+            ("processing", "processing"),
+            ("completed", "completed"),
+            ("failed", "failed"),
+        ),
+        default="queued",
+    )
+    records_processed = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+
+
+class HealthkitUploadChunk(BaseModel):
+    """
+    A chunk of the raw upload of a HealthkitUploadJob, deleted once the job is
+    processed
+    """
+
+    job = models.ForeignKey(
+        HealthkitUploadJob, on_delete=models.CASCADE, related_name="chunks"
+    )
+    number = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["job", "number"], name="unique_healthkit_upload_chunk"
+            )
+        ]
+
+
+class HealthkitUploadSession(BaseModel):
+    """
+    A resumable apple healthkit upload which is sent in numbered parts. Each
+    part is processed as a separate upload job as soon as it is received.
+    """
+
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    connection = models.ForeignKey(WatchConnection, on_delete=models.CASCADE)
+    total_parts = models.IntegerField(blank=True, null=True)
+
+
+class HealthkitUploadPart(BaseModel):
+    session = models.ForeignKey(
+        HealthkitUploadSession, on_delete=models.CASCADE, related_name="parts"
+    )
+    number = models.IntegerField()
+    # null when the part was a duplicate of already processed data
+    job = models.ForeignKey(
+        HealthkitUploadJob, on_delete=models.SET_NULL, blank=True, null=True
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["session", "number"], name="unique_healthkit_upload_part"
+            )
+        ]
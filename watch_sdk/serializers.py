@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from .models import *
+from .utils.downsample import DOWNSAMPLE_DATA_TYPES, RESOLUTIONS
+from .utils.webhook import MIN_WEBHOOK_REQUEST_BYTES
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -46,9 +48,36 @@ class UserAppSerializer(serializers.ModelSerializer):
         enabled_platforms = EnabledPlatform.objects.filter(user_app=obj)
         return EnabledPlatformSerializer(enabled_platforms, many=True).data
 
+    def validate_data_resolution(self, value):
+        if value is None:
+            return value
+        if not isinstance(value, dict):
+            raise serializers.ValidationError(
+                "must be a map of data type to resolution"
+            )
+        for data_type, resolution in value.items():
+            if data_type not in DOWNSAMPLE_DATA_TYPES:
+                raise serializers.ValidationError(
+                    f"{data_type} can only be delivered raw"
+                )
+            if resolution not in RESOLUTIONS:
+                raise serializers.ValidationError(
+                    f"invalid resolution {resolution} for {data_type}"
+                )
+        return value
+
+    def validate_webhook_max_request_bytes(self, value):
+        if value is not None and value < MIN_WEBHOOK_REQUEST_BYTES:
+            raise serializers.ValidationError(
+                f"must be at least {MIN_WEBHOOK_REQUEST_BYTES} bytes"
+            )
+        return value
+
     class Meta:
         model = UserApp
         fields = "__all__"
+        # set by us as per the agreement with the customer
+        read_only_fields = ["webhook_rate_limit"]
 
 
 class UserAppMinimalSerializer(serializers.ModelSerializer):
@@ -132,3 +161,40 @@ class PendingUserInvitationSerializer(serializers.ModelSerializer):
     class Meta:
         model = PendingUserInvitation
         fields = "__all__"
+
+
+class HealthkitUploadJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.UUIDField(source="uuid")
+
+    class Meta:
+        model = HealthkitUploadJob
+        fields = ["job_id", "status", "records_processed", "error", "created_at"]
+
+
+class HealthkitUploadSessionSerializer(serializers.ModelSerializer):
+    session_id = serializers.UUIDField(source="uuid")
+    parts = serializers.SerializerMethodField()
+    missing_parts = serializers.SerializerMethodField()
+
+    def get_parts(self, obj):
+        return [
+            {
+                "number": part.number,
+                "status": part.job.status if part.job else "completed",
+                "records_processed": part.job.records_processed if part.job else 0,
+            }
+            for part in obj.parts.select_related("job").order_by("number")
+        ]
+
+    def get_missing_parts(self, obj):
+        if obj.total_parts is None:
+            return None
+        # failed parts have to be sent again
+        received = set(
+            obj.parts.exclude(job__status="failed").values_list("number", flat=True)
+        )
+        return [n for n in range(1, obj.total_parts + 1) if n not in received]
+
+    class Meta:
+        model = HealthkitUploadSession
+        fields = ["session_id", "total_parts", "parts", "missing_parts", "created_at"]
@@ -1,3 +1,718 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import re
+import types
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import numpy as np
+
+from watch_sdk.dataclasses import (
+    BloodOxygen,
+    CaloriesBurned,
+    HeartRate,
+    Sleep,
+    Steps,
+    StravaRun,
+    batch_to_dict,
+)
+from watch_sdk.data_providers.google_fit import GoogleFitPoint
+from watch_sdk.models import (
+    ConnectedPlatformMetadata,
+    DataSyncMetric,
+    DataType,
+    EnabledPlatform,
+    HealthDataEntry,
+    HealthkitUploadChunk,
+    HealthkitUploadSession,
+    IOSDataHashLog,
+    Platform,
+    User,
+    UserApp,
+    WatchConnection,
+    WebhookOutbox,
+)
+from watch_sdk.utils.apple_healthkit import (
+    ZIP_MAGIC,
+    _iter_columnar_batches,
+    _process_batch,
+    forget_upload_hash,
+    open_stored_upload,
+    process_healthkit_upload_job,
+    record_upload_hash,
+    store_upload_for_processing,
+)
+from watch_sdk.utils.celery_utils import _iter_coalesced_unprocessed_data
+from watch_sdk.utils.data_process import store_health_data
+from watch_sdk.utils.dedup import _sample_fingerprint
+from watch_sdk.utils.downsample import Downsampler, downsample_health_data
+from watch_sdk.utils.google_fit import _perform_sync_connection
+from watch_sdk.utils.health_data_partitions import _get_partitions, _month_start
+from watch_sdk.utils.http_pool import get_session
+from watch_sdk.utils.metrics import flush_delivery_metrics
+from watch_sdk.utils.webhook_outbox import (
+    _claim_entries,
+    _get_partition,
+    _release_entries,
+)
+
+
+class BatchToDictTestCase(SimpleTestCase):
+    def _assert_same_as_to_dict(self, dclass, samples, constants):
+        columns = {name: [s[name] for s in samples] for name in samples[0]}
+        expected = [dclass(**constants, **sample).to_dict() for sample in samples]
+        self.assertEqual(batch_to_dict(dclass, columns, constants), expected)
+        # key order is part of the webhook payload, keep it the same too
+        self.assertEqual(
+            [list(d) for d in batch_to_dict(dclass, columns, constants)],
+            [list(d) for d in expected],
+        )
+
+    def test_value_types(self):
+        for dclass, values in (
+            (Steps, [10, 0, 1500]),
+            (HeartRate, [61.5, 72.0, 180.25]),
+            (CaloriesBurned, [0.1, 12.0, 3.3]),
+            (BloodOxygen, [0.97, 0.99, 1.0]),
+        ):
+            samples = [
+                {
+                    "start_time": 1696703400000 + i * 60000,
+                    "end_time": 1696703460000 + i * 60000,
+                    "manual_entry": i == 1,
+                    "source_device": "Apple Watch" if i else None,
+                    "value": value,
+                }
+                for i, value in enumerate(values)
+            ]
+            self._assert_same_as_to_dict(dclass, samples, {"source": "apple_healthkit"})
+
+    def test_sleep(self):
+        samples = [
+            {
+                "start_time": 1696703400000,
+                "end_time": 1696707000000,
+                "manual_entry": False,
+                "value": 3600000,
+                "sleep_type": sleep_type,
+            }
+            for sleep_type in ("awake", "light", "deep", "rem")
+        ]
+        self._assert_same_as_to_dict(
+            Sleep, samples, {"source": "google_fit", "source_device": None}
+        )
+
+    def test_extra_fields(self):
+        samples = [
+            {
+                "start_time": 1696703400000,
+                "end_time": 1696703400000,
+                "manual_entry": False,
+                "source_device": None,
+                "activity_id": 12,
+                "distance": 5000.0,
+                "moving_time": 1800,
+                "max_speed": 4.2,
+                "average_speed": 2.7,
+                "total_elevation_gain": 12.0,
+            }
+        ]
+        self._assert_same_as_to_dict(StravaRun, samples, {"source": "strava"})
+
+    def test_missing_field(self):
+        with self.assertRaises(TypeError):
+            batch_to_dict(Steps, {"value": [1]}, {"source": "google_fit"})
+
+
+class DownsampleTestCase(SimpleTestCase):
+    def _samples(self, values, interval=10 * 1000):
+        return [
+            {
+                "source": "apple_healthkit",
+                "start_time": i * interval,
+                "end_time": (i + 1) * interval,
+                "manual_entry": False,
+                "source_device": "watch",
+                "value": value,
+            }
+            for i, value in enumerate(values)
+        ]
+
+    def test_bucket_values(self):
+        # 6 samples of 10s per minute bucket
+        values = [60, 70, 80, 90, 100, 110, 120]
+        downsampled = downsample_health_data(
+            {"heart_rate": self._samples(values), "steps": self._samples(values)},
+            {"heart_rate": "1m", "steps": "1m"},
+        )
+        self.assertEqual([s["value"] for s in downsampled["heart_rate"]], [85.0, 120.0])
+        self.assertEqual([s["value"] for s in downsampled["steps"]], [510.0, 120.0])
+        self.assertEqual([s["count"] for s in downsampled["steps"]], [6, 1])
+
+    def test_raw_data_types(self):
+        fitness_data = {"heart_rate": self._samples([60]), "sleep": [{}]}
+        self.assertEqual(
+            downsample_health_data(fitness_data, {"steps": "1m"}), fitness_data
+        )
+
+    def test_merge_across_batches(self):
+        samples = self._samples(range(20))
+        expected = downsample_health_data({"heart_rate": samples}, {"heart_rate": "1m"})
+
+        downsampler = Downsampler({"heart_rate": "1m"})
+        # the batches split the second bucket
+        for batch in (samples[:8], samples[8:15], samples[15:]):
+            raw, buckets = downsampler.split({"heart_rate": batch})
+            self.assertEqual(raw, {})
+            downsampler.merge(buckets)
+        self.assertEqual(downsampler.flush(), expected)
+        self.assertEqual(downsampler.flush(), {})
+
+
+@mock.patch("watch_sdk.utils.google_fit.process_health_data")
+@mock.patch("watch_sdk.utils.google_fit.GoogleFitConnection")
+class GoogleFitSyncTestCase(SimpleTestCase):
+    def _sync(self, fit_connection_class, data):
+        fit_connection = fit_connection_class.return_value.__enter__.return_value
+        fit_connection._access_token = "token"
+        fit_connection.get_data_since_last_sync.return_value = data
+        _perform_sync_connection(mock.MagicMock())
+
+    def test_no_new_points(self, fit_connection_class, process_health_data):
+        self._sync(
+            fit_connection_class,
+            {
+                "com.google.step_count.delta": [],
+                "com.google.weight": [],
+            },
+        )
+        process_health_data.assert_not_called()
+
+    def test_new_points(self, fit_connection_class, process_health_data):
+        self._sync(
+            fit_connection_class,
+            {
+                "com.google.step_count.delta": [
+                    GoogleFitPoint(
+                        start_time="1000000000000",
+                        end_time="1060000000000",
+                        value=12,
+                        manual_entry=False,
+                    )
+                ],
+                "com.google.weight": [],
+            },
+        )
+        process_health_data.assert_called_once()
+        fitness_data = process_health_data.call_args.args[0]
+        self.assertEqual(list(fitness_data), ["steps"])
+        self.assertEqual(fitness_data["steps"][0]["value"], 12)
+
+
+@mock.patch("watch_sdk.utils.apple_healthkit.forget_samples")
+@mock.patch("watch_sdk.utils.apple_healthkit.drop_seen_samples")
+@mock.patch("watch_sdk.utils.apple_healthkit.process_health_data")
+class HealthKitBatchDedupTestCase(SimpleTestCase):
+    fitness_data = {"steps": [{"start_time": 0, "end_time": 1, "value": 10}]}
+
+    def test_processed(self, process_health_data, drop_seen_samples, forget_samples):
+        drop_seen_samples.return_value = self.fitness_data
+        _process_batch(self.fitness_data, mock.MagicMock(), mock.MagicMock())
+        process_health_data.assert_called_once()
+        forget_samples.assert_not_called()
+
+    def test_failed(self, process_health_data, drop_seen_samples, forget_samples):
+        # samples of a failed batch are processed again when re-uploaded
+        drop_seen_samples.return_value = self.fitness_data
+        process_health_data.side_effect = RuntimeError
+        connection = mock.MagicMock()
+        with self.assertRaises(RuntimeError):
+            _process_batch(self.fitness_data, connection, mock.MagicMock())
+        forget_samples.assert_called_once_with(
+            self.fitness_data, connection, "apple_healthkit"
+        )
+
+
+class SampleFingerprintTestCase(SimpleTestCase):
+    def _fingerprint(self, start_time, value):
+        return _sample_fingerprint(
+            "steps",
+            {
+                "start_time": start_time,
+                "end_time": start_time + 60000,
+                "value": value,
+                "source_device": "Apple Watch",
+            },
+        )
+
+    def test_number_types(self):
+        # eg. the same sample uploaded as json and as a columnar upload
+        fingerprint = self._fingerprint(1696703400000, 10)
+        for start_time, value in (
+            (1696703400000.0, 10.0),
+            (np.int64(1696703400000), np.int64(10)),
+            (1696703400000, np.float64(10)),
+        ):
+            self.assertEqual(self._fingerprint(start_time, value), fingerprint)
+        self.assertNotEqual(self._fingerprint(1696703400000, 11), fingerprint)
+
+
+@override_settings(WEBHOOK_POOL_MAX_HOSTS=1)
+class HttpPoolTestCase(SimpleTestCase):
+    @mock.patch("requests.Session.close")
+    def test_evicted_session_is_not_closed(self, close):
+        session = get_session("https://a.example.com/webhook")
+        # evicts the session of the first host, which a delivery thread could
+        # still be using
+        self.assertIsNot(get_session("https://b.example.com/webhook"), session)
+        self.assertIsNot(get_session("https://a.example.com/webhook"), session)
+        close.assert_not_called()
+
+
+@mock.patch("watch_sdk.utils.celery_utils.MAX_CHUNK_SAMPLES", 5)
+@mock.patch("watch_sdk.utils.celery_utils._iter_due_unprocessed_data")
+class CoalesceUnprocessedDataTestCase(SimpleTestCase):
+    def _entry(self, id, connection_id=1, platform_id=1, attempts=0, samples=1):
+        return types.SimpleNamespace(
+            id=id,
+            connection_id=connection_id,
+            platform_id=platform_id,
+            attempts=attempts,
+            data={"steps": [{"value": i} for i in range(samples)]},
+        )
+
+    def _coalesce(self, iter_due, entries):
+        iter_due.return_value = [entries]
+        return [[e.id for e in group] for group in _iter_coalesced_unprocessed_data(1)]
+
+    def test_groups(self, iter_due):
+        entries = [
+            self._entry(1),
+            self._entry(2, platform_id=2),
+            self._entry(3),
+            self._entry(4, connection_id=2),
+        ]
+        self.assertEqual(self._coalesce(iter_due, entries), [[1, 3], [2], [4]])
+
+    def test_attempts_are_not_merged(self, iter_due):
+        # fresh data is not rescheduled with the attempts of older data
+        entries = [self._entry(1, attempts=5), self._entry(2), self._entry(3)]
+        self.assertEqual(self._coalesce(iter_due, entries), [[1], [2, 3]])
+
+    def test_group_size(self, iter_due):
+        entries = [
+            self._entry(1, samples=2),
+            self._entry(2, samples=3),
+            self._entry(3, samples=1),
+            self._entry(4, samples=8),
+            self._entry(5, samples=1),
+        ]
+        self.assertEqual(self._coalesce(iter_due, entries), [[1, 2], [3], [4], [5]])
+
+
+class HealthDataQueryPlanTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create doesn't send post_save, whose receivers queue emails
+        (user,) = User.objects.bulk_create(
+            [User(name="test", email="test@example.com")]
+        )
+        (app,) = UserApp.objects.bulk_create(
+            [UserApp(name="test", user=user, key="test")]
+        )
+        connections = [
+            WatchConnection.objects.create(app=app, user_uuid=f"test{i}")
+            for i in range(10)
+        ]
+        platform = Platform.objects.create(name="apple_healthkit")
+        data_types = [
+            DataType.objects.create(name="steps"),
+            DataType.objects.create(name="heart_rate"),
+        ]
+
+        # the first monthly partition
+        with connection.cursor() as cursor:
+            end, cls.partition = min(
+                (bound, name)
+                for name, bound in _get_partitions(cursor)
+                if name.startswith("watch_sdk_healthdataentry_p")
+            )
+        cls.month_start = _month_start(end, -1)
+        HealthDataEntry.objects.bulk_create(
+            HealthDataEntry(
+                user_connection=user_connection,
+                source_platform=platform,
+                data_type=data_type,
+                start_time=cls.month_start + datetime.timedelta(minutes=i),
+                end_time=cls.month_start + datetime.timedelta(minutes=i + 1),
+                value=i,
+            )
+            for i in range(2000)
+            for data_type in data_types
+            for user_connection in connections
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE watch_sdk_healthdataentry")
+
+    def test_aggregate_for_timerange(self):
+        start_time = int(self.month_start.timestamp() * 1000)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.generic(
+                "GET",
+                "/watch_sdk/stored_health_data?user_uuid=test0",
+                json.dumps(
+                    {
+                        "platform": "apple_healthkit",
+                        "data_type": "steps",
+                        "start_time": start_time,
+                        "end_time": start_time + 24 * 60 * 60 * 1000,
+                    }
+                ),
+                content_type="application/json",
+                HTTP_KEY="test",
+            )
+        self.assertEqual(response.json(), {"total": sum(range(24 * 60))})
+
+        # the query made by the view
+        (sql,) = [
+            q["sql"] for q in queries if 'SUM("watch_sdk_healthdataentry"' in q["sql"]
+        ]
+        with connection.cursor() as cursor:
+            # the seeded data is too small for the planner to pick an index
+            # over a sequential scan on its own
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute(f"EXPLAIN {sql}")
+            plan = "\n".join(row for (row,) in cursor.fetchall())
+
+        self.assertIn(f"{self.partition}_lookup_idx", plan)
+        # other partitions are pruned
+        self.assertEqual(
+            set(re.findall(r"watch_sdk_healthdataentry_\w+", plan)),
+            {self.partition, f"{self.partition}_lookup_idx"},
+        )
+        self.assertNotIn("Join", plan)
+
+
+class StoreHealthDataTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        (user,) = User.objects.bulk_create(
+            [User(name="test", email="test@example.com")]
+        )
+        (app,) = UserApp.objects.bulk_create(
+            [UserApp(name="test", user=user, key="test")]
+        )
+        cls.connection = WatchConnection.objects.create(app=app, user_uuid="test")
+        Platform.objects.create(name="apple_healthkit")
+        DataType.objects.create(name="steps")
+        DataType.objects.create(name="sleep")
+
+    def _sample(self, value, source_device=None, **extra):
+        return {
+            "source": "apple_healthkit",
+            "start_time": 1696703400000,
+            "end_time": 1696703460000,
+            "manual_entry": False,
+            "source_device": source_device,
+            "value": value,
+            **extra,
+        }
+
+    def test_upsert(self):
+        store_health_data(
+            {
+                "steps": [self._sample(10)],
+                "sleep": [self._sample(60, sleep_type="rem")],
+            },
+            self.connection,
+            "apple_healthkit",
+        )
+        store_health_data(
+            {
+                # a sample delivered twice in a batch is stored once
+                "steps": [self._sample(12), self._sample(15)],
+                "sleep": [self._sample(60, sleep_type="deep")],
+            },
+            self.connection,
+            "apple_healthkit",
+        )
+        entries = HealthDataEntry.objects.order_by("data_type__name")
+        self.assertEqual(
+            [(e.data_type.name, e.value, e.extra_data) for e in entries],
+            [("sleep", 60, {"sleep_type": "deep"}), ("steps", 15, {})],
+        )
+
+    def test_source_device(self):
+        # a sample with no source device is a different sample than the same
+        # sample from a device
+        for source_device in (None, "watch", None, "watch"):
+            store_health_data(
+                {"steps": [self._sample(10, source_device)]},
+                self.connection,
+                "apple_healthkit",
+            )
+        self.assertEqual(
+            sorted(
+                HealthDataEntry.objects.values_list("source_device", flat=True),
+                key=str,
+            ),
+            [None, "watch"],
+        )
+
+
+class WebhookOutboxClaimTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        (user,) = User.objects.bulk_create(
+            [User(name="test", email="test@example.com")]
+        )
+        (app,) = UserApp.objects.bulk_create(
+            [UserApp(name="test", user=user, key="test")]
+        )
+        connection = WatchConnection.objects.create(app=app, user_uuid="test")
+        platform = Platform.objects.create(name="google_fit")
+        cls.partition = _get_partition(connection.id)
+        WebhookOutbox.objects.bulk_create(
+            WebhookOutbox(data={"steps": []}, connection=connection, platform=platform)
+            for _ in range(3)
+        )
+
+    def test_claimed_entries_are_not_read_again(self):
+        entries = _claim_entries(self.partition, 0)
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(_claim_entries(self.partition, 0), [])
+
+        _release_entries(entries[:1])
+        self.assertEqual(_claim_entries(self.partition, 0), entries[:1])
+
+    def test_expired_claims(self):
+        _claim_entries(self.partition, 0)
+        WebhookOutbox.objects.update(
+            claimed_until=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual(len(_claim_entries(self.partition, 0)), 3)
+
+
+@mock.patch("watch_sdk.views.apple_healthkit.process_healthkit_upload_job")
+class HealthkitUploadSessionTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        (user,) = User.objects.bulk_create(
+            [User(name="test", email="test@example.com")]
+        )
+        (app,) = UserApp.objects.bulk_create(
+            [UserApp(name="test", user=user, key="test")]
+        )
+        platform = Platform.objects.create(name="apple_healthkit")
+        EnabledPlatform.objects.create(platform=platform, user_app=app)
+        connection = WatchConnection.objects.create(app=app, user_uuid="test")
+        ConnectedPlatformMetadata.objects.create(
+            platform=platform, connection=connection
+        )
+        cls.session = HealthkitUploadSession.objects.create(
+            connection=connection, total_parts=2
+        )
+
+    def _send_part(self, number, body=b'{"steps": []}'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                f"/watch_sdk/healthkit_upload_session/{self.session.uuid}/part/{number}?user_uuid=test",
+                body,
+                content_type="application/json",
+                HTTP_KEY="test",
+            )
+
+    def test_failed_part_is_processed_again(self, process_job):
+        response = self._send_part(1)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["data"]["missing_parts"], [2])
+        part = self.session.parts.get(number=1)
+        # as done by the failed job
+        part.job.status = "failed"
+        part.job.save()
+        forget_upload_hash(part.job.connection, part.job.hash)
+
+        status = self.client.get(
+            f"/watch_sdk/healthkit_upload_session/{self.session.uuid}",
+            HTTP_KEY="test",
+        )
+        self.assertEqual(status.json()["data"]["missing_parts"], [1, 2])
+
+        response = self._send_part(1)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["data"]["missing_parts"], [2])
+        self.assertEqual(process_job.delay.call_count, 2)
+        self.assertNotEqual(self.session.parts.get(number=1).job_id, part.job_id)
+        # an identical upload is taken for a duplicate again
+        self.assertFalse(record_upload_hash(part.job.connection, part.job.hash))
+
+    def test_received_part_is_not_processed_again(self, process_job):
+        self._send_part(1)
+        response = self._send_part(1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(process_job.delay.call_count, 1)
+
+
+class HealthkitUploadJobTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        (user,) = User.objects.bulk_create(
+            [User(name="test", email="test@example.com")]
+        )
+        (app,) = UserApp.objects.bulk_create(
+            [UserApp(name="test", user=user, key="test")]
+        )
+        platform = Platform.objects.create(name="apple_healthkit")
+        cls.connection = WatchConnection.objects.create(app=app, user_uuid="test")
+        ConnectedPlatformMetadata.objects.create(
+            platform=platform, connection=cls.connection
+        )
+
+    @mock.patch("watch_sdk.utils.apple_healthkit.UPLOAD_CHUNK_SIZE", 10)
+    def test_stored_upload(self):
+        data = bytes(range(256)) * 3
+        job = store_upload_for_processing(io.BytesIO(data), self.connection, "hash")
+        self.assertEqual(job.chunks.count(), 77)
+
+        data_file = open_stored_upload(job)
+        self.assertEqual(data_file.read(), data)
+        data_file.seek(95)
+        self.assertEqual(data_file.read(20), data[95:115])
+        data_file.seek(-5, io.SEEK_END)
+        self.assertEqual(data_file.read(), data[-5:])
+
+    @mock.patch("watch_sdk.utils.apple_healthkit.process_healthkit_upload")
+    def test_failed_job(self, process_healthkit_upload):
+        process_healthkit_upload.side_effect = RuntimeError("boom")
+        record_upload_hash(self.connection, "hash")
+        job = store_upload_for_processing(io.BytesIO(b"{}"), self.connection, "hash")
+
+        process_healthkit_upload_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertFalse(HealthkitUploadChunk.objects.filter(job=job).exists())
+        # the upload is processed when the client sends it again
+        self.assertTrue(record_upload_hash(self.connection, "hash"))
+
+    @mock.patch("watch_sdk.utils.apple_healthkit.process_healthkit_upload")
+    def test_job_processed_once(self, process_healthkit_upload):
+        process_healthkit_upload.return_value = 1
+        job = store_upload_for_processing(io.BytesIO(b"{}"), self.connection, "hash")
+
+        # eg. the task is redelivered
+        process_healthkit_upload_job(job.id)
+        process_healthkit_upload_job(job.id)
+        process_healthkit_upload.assert_called_once()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.records_processed), ("completed", 1))
+
+
+class ColumnarUploadTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        (user,) = User.objects.bulk_create(
+            [User(name="test", email="test@example.com")]
+        )
+        (app,) = UserApp.objects.bulk_create(
+            [UserApp(name="test", user=user, key="test")]
+        )
+        platform = Platform.objects.create(name="apple_healthkit")
+        EnabledPlatform.objects.create(platform=platform, user_app=app)
+        cls.connection = WatchConnection.objects.create(app=app, user_uuid="test")
+        ConnectedPlatformMetadata.objects.create(
+            platform=platform, connection=cls.connection
+        )
+
+    def _archive(self, **overrides):
+        arrays = {
+            "source_names": np.array(["Apple Watch"]),
+            "source_ids": np.array(["com.apple.health"]),
+            "steps.date_from": np.array([1696703400000, 60000], np.int64),
+            "steps.duration": np.array([60000, 60000], np.int64),
+            "steps.value": np.array([10, 12]),
+            "steps.source_name": np.array([0, 0], np.int32),
+            "steps.source_id": np.array([0, 0], np.int32),
+        }
+        arrays.update(overrides)
+        data_file = io.BytesIO()
+        np.savez(
+            data_file,
+            **{name: array for name, array in arrays.items() if array is not None},
+        )
+        data_file.seek(0)
+        return data_file
+
+    def _read(self, data_file):
+        batches = _iter_columnar_batches(
+            data_file,
+            {"steps": ("steps", Steps)},
+            types.SimpleNamespace(sync_manual_entries=False),
+            {},
+        )
+        return list(batches)
+
+    def test_valid_archive(self):
+        (batch,) = self._read(self._archive())
+        self.assertEqual([s["value"] for s in batch["steps"]], [10, 12])
+        self.assertEqual(batch["steps"][1]["start_time"], 1696703460000)
+
+    def test_malformed_archive(self):
+        for data_file in (
+            self._archive(**{"steps.duration": None}),
+            self._archive(**{"steps.value": np.array([10])}),
+            self._archive(**{"steps.source_name": np.array([0, 1], np.int32)}),
+            self._archive(**{"steps.source_id": np.array([0, -1], np.int32)}),
+            self._archive(**{"steps.value": np.array(["10", "12"])}),
+            self._archive(source_ids=None),
+            io.BytesIO(ZIP_MAGIC + b"not an archive"),
+        ):
+            with self.assertRaises(ValidationError):
+                self._read(data_file)
+
+    def test_malformed_upload_is_rejected(self):
+        response = self.client.post(
+            "/watch_sdk/upload_health_data_as_json?user_uuid=test",
+            ZIP_MAGIC + b"not an archive",
+            content_type="application/octet-stream",
+            HTTP_KEY="test",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("invalid columnar upload", response.json()["error"])
+        # the upload is processed when the client sends a fixed one
+        self.assertFalse(IOSDataHashLog.objects.exists())
+
+
+@mock.patch("watch_sdk.utils.metrics._pop_bucket")
+@mock.patch("watch_sdk.utils.metrics.get_redis_connection")
+class FlushDeliveryMetricsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        (user,) = User.objects.bulk_create(
+            [User(name="test", email="test@example.com")]
+        )
+        (cls.app,) = UserApp.objects.bulk_create(
+            [UserApp(name="test", user=user, key="test")]
+        )
+        Platform.objects.create(name="google_fit")
+        DataType.objects.create(name="steps")
+
+    def test_unknown_data_type(self, get_redis_connection, pop_bucket):
+        get_redis_connection.return_value.smembers.return_value = [b"1", b"2"]
+        pop_bucket.side_effect = [
+            {
+                f"{self.app.id}|google_fit|steps".encode(): b"10",
+                f"{self.app.id}|google_fit|removed".encode(): b"5",
+                f"{self.app.id}|removed|steps".encode(): b"5",
+            },
+            {f"{self.app.id}|google_fit|steps".encode(): b"20"},
+        ]
+        flush_delivery_metrics()
+        self.assertEqual(
+            sorted(DataSyncMetric.objects.values_list("value", flat=True)),
+            [10.0, 20.0],
+        )
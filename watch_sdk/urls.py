@@ -16,7 +16,14 @@ Including another URLconf
 from django.urls import path, re_path
 
 from watch_sdk.views.shared import *
-from watch_sdk.views.apple_healthkit import upload_health_data_using_json_file
+from watch_sdk.views.apple_healthkit import (
+    create_healthkit_upload_session,
+    healthkit_upload_job_status,
+    healthkit_upload_manifest,
+    healthkit_upload_session_status,
+    upload_health_data_using_json_file,
+    upload_healthkit_session_part,
+)
 from watch_sdk.views.fitbit import *
 from watch_sdk.views.google_fit import *
 from watch_sdk.views.stored_health_data import (
@@ -26,12 +33,24 @@ from watch_sdk.views.stored_health_data import (
     get_workouts,
 )
 from watch_sdk.views.strava import *
+from watch_sdk.views.user_activity import active_users
 
 app_name = "watch_sdk"
 
 urlpatterns = [
     path("generate_key", generate_key),
     path("upload_health_data_as_json", upload_health_data_using_json_file),
+    path("healthkit_upload_job_status", healthkit_upload_job_status),
+    path("healthkit_upload_manifest", healthkit_upload_manifest),
+    path("healthkit_upload_session", create_healthkit_upload_session),
+    path(
+        "healthkit_upload_session/<uuid:session_id>",
+        healthkit_upload_session_status,
+    ),
+    path(
+        "healthkit_upload_session/<uuid:session_id>/part/<int:part_number>",
+        upload_healthkit_session_part,
+    ),
     path(
         "user",
         UserViewSet.as_view({"get": "list", "post": "create"}),
@@ -94,4 +113,5 @@ urlpatterns = [
     path("get_menstruation_data", get_menstruation_data),
     path("get_date_wise_data", get_date_wise_data),
     path("get_workouts", get_workouts),
+    path("active_users", active_users),
 ]
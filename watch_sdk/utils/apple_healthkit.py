@@ -0,0 +1,597 @@
+import collections
+from datetime import datetime
+import io
+import logging
+import zipfile
+
+from celery import shared_task
+from django.core.exceptions import ValidationError
+from django.db import connection as db_connection, transaction
+from django.db.models import Sum
+from django.db.models.functions import Length
+from django.utils import timezone
+import ijson
+import numpy as np
+
+from watch_sdk.constants import apple_healthkit
+from watch_sdk.dataclasses import batch_to_dict
+from watch_sdk.models import (
+    ConnectedPlatformMetadata,
+    EnabledPlatform,
+    HealthkitUploadChunk,
+    HealthkitUploadJob,
+    IOSDataHashLog,
+)
+from watch_sdk.utils.compression import open_decompressed
+from watch_sdk.utils.data_process import deliver_downsampled_data, process_health_data
+from watch_sdk.utils.dedup import drop_seen_samples, forget_samples
+from watch_sdk.utils.downsample import Downsampler
+
+
+logger = logging.getLogger(__name__)
+
+SYNC_SLEEP_TYPES = set(["awake", "light", "deep", "rem", "unspecified"])
+# sleep type for the sleep analysis values sent by healthkit, see `_get_sleep_type`
+SLEEP_TYPES_BY_VALUE = np.array(["in_bed", "asleep", "awake", "light", "deep", "rem"])
+
+ZIP_MAGIC = b"PK\x03\x04"
+
+# Number of normalized samples we keep in memory before handing them over for
+# processing. This keeps memory bounded irrespective of the upload size.
+PROCESS_BATCH_SIZE = 5000
+# Maximum number of samples we recommend the SDK to send in a single upload
+MAX_UPLOAD_BATCH_SIZE = 50000
+# size of the chunks uploads processed asynchronously are stored in
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _get_sleep_type(d):
+    if d["value"] == 0:
+        return "in_bed"
+    if d["value"] == 1:
+        return "asleep"
+    if d["value"] == 2:
+        return "awake"
+    if d["value"] == 3:
+        return "light"
+    if d["value"] == 4:
+        return "deep"
+    if d["value"] == 5:
+        return "rem"
+
+    return "unspecified"
+
+
+def get_enabled_data_types(app):
+    """
+    Returns a map of apple data type -> (our data type key, dataclass) for the
+    data types enabled by the app and supported on apple healthkit
+    """
+    enabled_data_types = {}
+    for enabled in app.enabled_data_types.all():
+        data_type = apple_healthkit.DB_DATA_TYPE_KEY_MAP.get(enabled.name)
+        if data_type is None:
+            # skip this data type as it's not supported on apple
+            continue
+        key, dclass = apple_healthkit.DATATYPE_NAME_CLASS_MAP.get(
+            data_type, (None, None)
+        )
+        if not key or not dclass:
+            continue
+        enabled_data_types[data_type] = (key, dclass)
+
+    return enabled_data_types
+
+
+def iter_healthkit_samples(data_file, data_types):
+    """
+    Incrementally parses an apple healthkit upload and yields (data_type, sample)
+    for every sample of the given data types.
+
+    The upload is a json object keyed by data type where each value is an array
+    of samples. Only one sample is held in memory at a time, so the memory used
+    does not depend on the size of the upload.
+
+    :param data_file: file like object containing the json upload
+    :param data_types: collection of apple data types to yield samples for
+    """
+    data_type = None
+    item_prefix = None
+    builder = None
+    for prefix, event, value in ijson.parse(data_file, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == item_prefix and event == "end_map":
+                yield data_type, builder.value
+                builder = None
+        elif prefix == "" and event == "map_key":
+            data_type = value
+            item_prefix = f"{value}.item"
+        elif prefix == item_prefix and event == "start_map" and data_type in data_types:
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+
+
+def record_upload_hash(connection, hash):
+    """
+    Records the hash of an upload for the connection in a single atomic upsert.
+    Returns False if the same upload was already recorded for the connection.
+    """
+    with db_connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {IOSDataHashLog._meta.db_table}
+                (hash, connection_id, created_at, updated_at)
+            VALUES (%s, %s, now(), now())
+            ON CONFLICT (connection_id, hash) DO NOTHING
+            RETURNING id
+            """,
+            [hash, connection.id],
+        )
+        return cursor.fetchone() is not None
+
+
+def get_sync_anchors(connected_metadata):
+    """
+    Returns the data type wise anchors (end time of the latest sample uploaded
+    in milliseconds) for an apple healthkit connection
+    """
+    if connected_metadata is None:
+        return {}
+    return connected_metadata.last_modified_for_data_types or {}
+
+
+def update_sync_anchors(connected_metadata, anchors):
+    """
+    Moves the data type wise anchors of the connection forward. Uploads can be
+    processed concurrently, hence the stored anchors are merged under a row lock.
+
+    :param connected_metadata: ConnectedPlatformMetadata for apple healthkit
+    :param anchors: dict of apple data type -> end time of latest sample in ms
+    """
+    if not anchors:
+        return
+
+    with transaction.atomic():
+        metadata = ConnectedPlatformMetadata.objects.select_for_update().get(
+            id=connected_metadata.id
+        )
+        stored = metadata.last_modified_for_data_types or {}
+        for data_type, anchor in anchors.items():
+            stored[data_type] = max(stored.get(data_type, 0), anchor)
+        metadata.last_modified_for_data_types = stored
+        metadata.last_sync = datetime.fromtimestamp(max(stored.values()) / 1000)
+        metadata.save(update_fields=["last_modified_for_data_types", "last_sync"])
+
+
+def _process_batch(fitness_data, connection, app, downsampler=None):
+    # iOS clients often upload overlapping windows, drop what we have already
+    # processed before it is sent to the webhook and stored again
+    fitness_data = drop_seen_samples(fitness_data, connection, "apple_healthkit")
+    if not fitness_data:
+        return
+    logger.info(
+        f"processing {len(fitness_data)} points from apple healthkit for {connection.user_uuid}"
+    )
+    try:
+        process_health_data(
+            fitness_data,
+            connection,
+            app,
+            "apple_healthkit",
+            downsampler,
+        )
+    except Exception:
+        # the samples were not stored, they must not be dropped when the
+        # upload is retried
+        forget_samples(fitness_data, connection, "apple_healthkit")
+        raise
+
+
+def _iter_json_batches(data_file, enabled_data_types, enabled_platform, anchors):
+    """
+    Yields batches of normalized samples from a json upload, updating the
+    data type wise anchors along the way
+    """
+    # samples are collected as columns and normalized together once a batch
+    # is complete, which is much cheaper than building a dataclass per sample
+    columns = _new_batch_columns()
+    pending = 0
+    for data_type, d in iter_healthkit_samples(data_file, enabled_data_types):
+        start_time = d["date_from"]
+        end_time = d["date_to"]
+        # the anchor tracks what the client has uploaded, hence it is updated
+        # even for samples we skip below
+        anchors[data_type] = max(anchors.get(data_type, 0), end_time)
+        manual_entry = (
+            d.get("source_name") == "Health" or d.get("source_id") == "com.apple.Health"
+        )
+        if manual_entry and not enabled_platform.sync_manual_entries:
+            continue
+        sample_columns = columns[data_type]
+        if data_type == "sleep_analysis":
+            sleep_type = _get_sleep_type(d)
+            if sleep_type not in SYNC_SLEEP_TYPES:
+                continue
+            sample_columns["value"].append(d["date_to"] - d["date_from"])
+            sample_columns["sleep_type"].append(sleep_type)
+        else:
+            sample_columns["value"].append(d["value"])
+        sample_columns["start_time"].append(start_time)
+        sample_columns["end_time"].append(end_time)
+        sample_columns["source_device"].append(d.get("source_name"))
+        sample_columns["manual_entry"].append(manual_entry)
+
+        pending += 1
+        if pending >= PROCESS_BATCH_SIZE:
+            yield _normalize_batch(columns, enabled_data_types)
+            columns = _new_batch_columns()
+            pending = 0
+
+    if pending:
+        yield _normalize_batch(columns, enabled_data_types)
+
+
+def _new_batch_columns():
+    return collections.defaultdict(lambda: collections.defaultdict(list))
+
+
+def _normalize_batch(columns, enabled_data_types):
+    """
+    Builds the fitness data for a batch from the data type wise sample columns
+    """
+    fitness_data = {}
+    for data_type, sample_columns in columns.items():
+        key, dclass = enabled_data_types[data_type]
+        fitness_data[key] = batch_to_dict(
+            dclass, sample_columns, {"source": "apple_healthkit"}
+        )
+    return fitness_data
+
+
+def is_columnar_upload(data_file):
+    """
+    Columnar uploads are npz archives, which are zip files
+    """
+    position = data_file.tell()
+    header = data_file.read(len(ZIP_MAGIC))
+    data_file.seek(position)
+    return header == ZIP_MAGIC
+
+
+# columns every data type of a columnar upload is stored as, with the kinds
+# of numpy dtypes they can have, see `_iter_columnar_batches`
+COLUMNAR_COLUMNS = {
+    "date_from": "iu",
+    "duration": "iu",
+    "value": "iuf",
+    "source_name": "iu",
+    "source_id": "iu",
+}
+
+
+def _read_columnar_upload(data_file, enabled_data_types):
+    """
+    Reads the source dictionaries of a columnar upload and the columns of the
+    enabled data types it has. Raises a ValidationError if the upload is not
+    an npz archive, if columns are missing, of the wrong type or of different
+    lengths, or if the source indices are out of range.
+    """
+    try:
+        with np.load(data_file, allow_pickle=False) as archive:
+            files = set(archive.files)
+            missing = [
+                name for name in ("source_names", "source_ids") if name not in files
+            ]
+            if missing:
+                raise ValidationError(f"columnar upload is missing {missing}")
+            source_names = archive["source_names"]
+            source_ids = archive["source_ids"]
+
+            data_type_columns = {}
+            for data_type in enabled_data_types:
+                if f"{data_type}.date_from" not in files:
+                    continue
+                names = [f"{data_type}.{column}" for column in COLUMNAR_COLUMNS]
+                missing = [name for name in names if name not in files]
+                if missing:
+                    raise ValidationError(f"columnar upload is missing {missing}")
+                data_type_columns[data_type] = {
+                    column: archive[name]
+                    for column, name in zip(COLUMNAR_COLUMNS, names)
+                }
+    except (OSError, EOFError, ValueError, zipfile.BadZipFile) as e:
+        raise ValidationError(f"invalid columnar upload: {e}")
+
+    for name, dictionary in (
+        ("source_names", source_names),
+        ("source_ids", source_ids),
+    ):
+        if dictionary.ndim != 1 or (dictionary.size and dictionary.dtype.kind != "U"):
+            raise ValidationError(f"{name} must be a 1-D array of strings")
+
+    for data_type, columns in data_type_columns.items():
+        for column, kinds in COLUMNAR_COLUMNS.items():
+            if columns[column].ndim != 1 or columns[column].dtype.kind not in kinds:
+                raise ValidationError(
+                    f"{data_type}.{column} must be a 1-D array of numbers"
+                )
+        lengths = {len(array) for array in columns.values()}
+        if len(lengths) > 1:
+            raise ValidationError(f"columns of {data_type} have different lengths")
+        for column, dictionary in (
+            ("source_name", source_names),
+            ("source_id", source_ids),
+        ):
+            indices = columns[column]
+            if len(indices) and (indices.min() < 0 or indices.max() >= len(dictionary)):
+                raise ValidationError(
+                    f"{data_type}.{column} has indices out of range of {column}s"
+                )
+
+    return source_names, source_ids, data_type_columns
+
+
+def _iter_columnar_batches(data_file, enabled_data_types, enabled_platform, anchors):
+    """
+    Yields batches of normalized samples from a columnar upload, updating the
+    data type wise anchors along the way.
+
+    A columnar upload is a numpy npz archive. Source names and ids are
+    dictionary encoded in the `source_names` and `source_ids` arrays, and every
+    data type is stored as a set of parallel columns:
+
+      - `<data_type>.date_from`: int64, start time in milliseconds, delta
+        encoded (the first value is absolute and the rest are differences
+        from the previous sample)
+      - `<data_type>.duration`: int64, `date_to - date_from` in milliseconds
+      - `<data_type>.value`: value of the sample
+      - `<data_type>.source_name`: int32, index into `source_names`
+      - `<data_type>.source_id`: int32, index into `source_ids`
+
+    Columns are decoded and filtered with vectorized operations, only the
+    final output dicts are built per sample.
+    """
+    # the whole upload is validated before the first batch is yielded, so
+    # that a malformed upload is rejected without being partially processed
+    source_names, source_ids, data_type_columns = _read_columnar_upload(
+        data_file, enabled_data_types
+    )
+    # missing source names are sent as empty strings
+    source_names = np.array(
+        [name or None for name in source_names.tolist()], dtype=object
+    )
+    for data_type, (key, dclass) in enabled_data_types.items():
+        if data_type not in data_type_columns:
+            continue
+
+        archive_columns = data_type_columns[data_type]
+        start_times = np.cumsum(archive_columns["date_from"], dtype=np.int64)
+        end_times = start_times + archive_columns["duration"]
+        values = archive_columns["value"]
+        names = source_names[archive_columns["source_name"]]
+        manual_entries = (names == "Health") | (
+            source_ids[archive_columns["source_id"]] == "com.apple.Health"
+        )
+        if len(end_times):
+            anchors[data_type] = max(anchors.get(data_type, 0), int(end_times.max()))
+
+        if enabled_platform.sync_manual_entries:
+            keep = np.ones(len(start_times), dtype=bool)
+        else:
+            keep = ~manual_entries
+
+        columns = {}
+        if data_type == "sleep_analysis":
+            codes = values.astype(np.int64)
+            known = (codes >= 0) & (codes < len(SLEEP_TYPES_BY_VALUE))
+            sleep_types = np.where(
+                known,
+                SLEEP_TYPES_BY_VALUE[np.clip(codes, 0, len(SLEEP_TYPES_BY_VALUE) - 1)],
+                "unspecified",
+            )
+            keep &= np.isin(sleep_types, list(SYNC_SLEEP_TYPES))
+            columns["sleep_type"] = sleep_types[keep]
+            columns["value"] = (end_times - start_times)[keep]
+        else:
+            columns["value"] = values[keep]
+        columns["start_time"] = start_times[keep]
+        columns["end_time"] = end_times[keep]
+        columns["manual_entry"] = manual_entries[keep]
+        columns["source_device"] = names[keep]
+
+        for i in range(0, len(columns["start_time"]), PROCESS_BATCH_SIZE):
+            yield {
+                key: batch_to_dict(
+                    dclass,
+                    {
+                        name: column[i : i + PROCESS_BATCH_SIZE]
+                        for name, column in columns.items()
+                    },
+                    {"source": "apple_healthkit"},
+                )
+            }
+
+
+def process_healthkit_upload(
+    data_file, app, connection, connected_metadata, on_progress=None
+):
+    """
+    Parses an apple healthkit upload and processes the samples in batches of
+    `PROCESS_BATCH_SIZE`. Returns the number of samples processed.
+
+    The upload can either be a json document, optionally compressed with gzip
+    or zstd, or a columnar npz archive.
+
+    :param data_file: seekable file like object containing the upload
+    :param app: UserApp
+    :param connection: WatchConnection
+    :param connected_metadata: ConnectedPlatformMetadata for apple healthkit
+    :param on_progress: optional callable, called with the number of samples
+        processed so far after every batch
+    """
+    enabled_platform = EnabledPlatform.objects.get(
+        user_app=app, platform__name="apple_healthkit"
+    )
+    enabled_data_types = get_enabled_data_types(app)
+    anchors = {}
+    if is_columnar_upload(data_file):
+        batches = _iter_columnar_batches(
+            data_file, enabled_data_types, enabled_platform, anchors
+        )
+    else:
+        # the json upload is parsed incrementally so that large uploads don't
+        # have to be loaded in memory at once
+        batches = _iter_json_batches(
+            open_decompressed(data_file), enabled_data_types, enabled_platform, anchors
+        )
+
+    # the buckets of the downsampled data types are merged across batches and
+    # delivered once all batches are processed
+    downsampler = Downsampler(app.data_resolution)
+    total = 0
+    try:
+        for fitness_data in batches:
+            _process_batch(fitness_data, connection, app, downsampler)
+            total += sum(len(samples) for samples in fitness_data.values())
+            if on_progress:
+                on_progress(total)
+    finally:
+        # buckets of the batches which were processed before a failure are
+        # delivered too, their samples are not processed again on a retry
+        deliver_downsampled_data(downsampler, connection, "apple_healthkit")
+
+    update_sync_anchors(connected_metadata, anchors)
+    return total
+
+
+def forget_upload_hash(connection, hash):
+    """
+    Removes the hash recorded by `record_upload_hash`, so that the upload is
+    processed if it is sent again, eg. when processing it failed
+    """
+    IOSDataHashLog.objects.filter(connection=connection, hash=hash).delete()
+
+
+def store_upload_for_processing(data_file, connection, hash):
+    """
+    Stores the raw upload in the database and creates a job for processing it
+    asynchronously. Returns the created HealthkitUploadJob.
+    """
+    data_file.seek(0)
+    with transaction.atomic():
+        job = HealthkitUploadJob.objects.create(connection=connection, hash=hash)
+        number = 0
+        while True:
+            data = data_file.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            HealthkitUploadChunk.objects.create(job=job, number=number, data=data)
+            number += 1
+    return job
+
+
+class _StoredUploadReader(io.RawIOBase):
+    """
+    Reads the upload stored for a job, a chunk at a time
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.size = (
+            HealthkitUploadChunk.objects.filter(job=job).aggregate(
+                size=Sum(Length("data"))
+            )["size"]
+            or 0
+        )
+        self.position = 0
+        self.chunk_number = None
+        self.chunk = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        number, offset = divmod(self.position, UPLOAD_CHUNK_SIZE)
+        if number != self.chunk_number:
+            self.chunk = bytes(
+                HealthkitUploadChunk.objects.values_list("data", flat=True).get(
+                    job=self.job, number=number
+                )
+            )
+            self.chunk_number = number
+        data = self.chunk[offset : offset + len(buffer)]
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def open_stored_upload(job):
+    """
+    Returns a seekable file like object reading the upload stored for the job
+    """
+    return io.BufferedReader(_StoredUploadReader(job))
+
+
+@shared_task
+def process_healthkit_upload_job(job_id):
+    # the job is claimed atomically, so that a redelivered task or a second
+    # call doesn't process the same upload twice
+    claimed = HealthkitUploadJob.objects.filter(id=job_id, status="queued").update(
+        status="processing", updated_at=timezone.now()
+    )
+    job = HealthkitUploadJob.objects.select_related("connection__app").get(id=job_id)
+    if not claimed:
+        logger.warn(f"healthkit upload job {job.uuid} is already {job.status}")
+        return
+
+    def _update_progress(total):
+        HealthkitUploadJob.objects.filter(id=job.id).update(records_processed=total)
+
+    connection = job.connection
+    try:
+        connected_metadata = ConnectedPlatformMetadata.objects.get(
+            connection=connection, platform__name="apple_healthkit"
+        )
+        with open_stored_upload(job) as data_file:
+            job.records_processed = process_healthkit_upload(
+                data_file,
+                connection.app,
+                connection,
+                connected_metadata,
+                on_progress=_update_progress,
+            )
+        job.status = "completed"
+    except Exception as e:
+        logger.error(
+            f"Unable to process healthkit upload job {job.uuid} for {connection.user_uuid}: {e}",
+            exc_info=True,
+        )
+        # keep the progress stored by the batches processed before failing
+        job.refresh_from_db(fields=["records_processed"])
+        job.status = "failed"
+        job.error = " ".join(e.messages) if isinstance(e, ValidationError) else str(e)
+        # the client has to send the upload again, it must not be taken for a
+        # duplicate of this one
+        if job.hash:
+            forget_upload_hash(connection, job.hash)
+    finally:
+        job.chunks.all().delete()
+
+    job.save(update_fields=["status", "records_processed", "error", "updated_at"])
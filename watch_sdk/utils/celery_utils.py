@@ -1,10 +1,23 @@
+import collections
 import datetime
 import functools
+import itertools
+import json
 import logging
+import random
+from django.conf import settings
 from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from celery import shared_task
 from watch_sdk.models import IOSDataHashLog, UnprocessedData
-from watch_sdk.utils.webhook import send_data_to_webhook
+from watch_sdk.utils.circuit_breaker import is_webhook_circuit_open
+from watch_sdk.utils.webhook import (
+    MAX_CHUNK_SAMPLES,
+    concurrent_webhook_delivery,
+    send_data_to_webhook,
+)
 import time
 
 logger = logging.getLogger(__name__)
@@ -35,31 +48,230 @@ def single_instance_task(timeout):
     return task_exc
 
 
+def _get_retry_delay(attempts):
+    """
+    Exponential backoff for the given number of attempts, in seconds. Jitter
+    of up to half the delay spreads out the retries of data that failed
+    together, eg. during an outage of the webhook.
+    """
+    delay = min(
+        settings.WEBHOOK_RETRY_MAX_DELAY,
+        settings.WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+    )
+    return random.uniform(delay / 2, delay)
+
+
+def _merge_data(datas):
+    """
+    Merges the given fitness data into one, samples which are in more than one
+    of them are only kept once
+    """
+    data = collections.defaultdict(list)
+    seen = set()
+    for fitness_data in datas:
+        for data_type, samples in fitness_data.items():
+            for sample in samples:
+                identity = (data_type, json.dumps(sample, sort_keys=True))
+                if identity in seen:
+                    continue
+                seen.add(identity)
+                data[data_type].append(sample)
+    return dict(data)
+
+
+def _reschedule_unprocessed_data(entries, unsent, attempted):
+    """
+    Deletes the entries once all of their data is delivered, otherwise keeps
+    what is left of it for the next attempt in the oldest entry. Entries are
+    marked dead after `WEBHOOK_RETRY_MAX_ATTEMPTS` attempts and are not
+    retried anymore.
+
+    :param entries: UnprocessedData of a connection and platform with the
+        same number of attempts that were replayed together, oldest first
+    """
+    entry = entries[0]
+    with transaction.atomic():
+        if not unsent:
+            UnprocessedData.objects.filter(id__in=[e.id for e in entries]).delete()
+            return
+
+        UnprocessedData.objects.filter(id__in=[e.id for e in entries[1:]]).delete()
+        entry.data = _merge_data(unsent)
+        # data which was not sent at all, because an earlier delivery of the
+        # user failed, doesn't count as an attempt
+        if attempted:
+            entry.attempts += 1
+        if entry.attempts >= settings.WEBHOOK_RETRY_MAX_ATTEMPTS:
+            logger.warning(
+                f"giving up on unprocessed data {entry.id} for {entry.connection.user_uuid} after {entry.attempts} attempts"
+            )
+            entry.status = "dead"
+            entry.next_attempt_at = None
+        else:
+            entry.next_attempt_at = timezone.now() + datetime.timedelta(
+                seconds=_get_retry_delay(max(entry.attempts, 1))
+            )
+        entry.save(
+            update_fields=[
+                "data",
+                "attempts",
+                "next_attempt_at",
+                "status",
+                "updated_at",
+            ]
+        )
+
+
+REPLAY_PAGE_SIZE = 200
+
+
+def _get_due_unprocessed_data():
+    return (
+        UnprocessedData.objects.filter(
+            status="pending", connection__app__webhook_url__isnull=False
+        )
+        .exclude(connection__app__webhook_url="")
+        .filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())
+        )
+    )
+
+
+def _iter_due_unprocessed_data(app_id):
+    """
+    Yields the due unprocessed data of the app page by page, ordered by
+    connection so that the data of a user is replayed in the order it was
+    saved. Pages are fetched with keyset pagination, hence only a page of
+    payloads is in memory at a time.
+    """
+    due = (
+        _get_due_unprocessed_data()
+        .filter(connection__app_id=app_id)
+        .select_related("connection__app", "platform")
+        .order_by("connection_id", "id")
+    )
+    last = None
+    while True:
+        page = due
+        if last is not None:
+            page = page.filter(
+                Q(connection_id__gt=last.connection_id)
+                | Q(connection_id=last.connection_id, id__gt=last.id)
+            )
+        entries = list(page[:REPLAY_PAGE_SIZE])
+        if not entries:
+            return
+        yield entries
+        last = entries[-1]
+
+
+def _iter_coalesced_unprocessed_data(app_id):
+    """
+    Yields the due unprocessed data of the app in groups of rows of the same
+    connection, platform and number of attempts, so that every group can be
+    delivered as a single payload and rescheduled as a single row. A group
+    holds at most `MAX_CHUNK_SAMPLES` samples, unless a single row has more,
+    which keeps the merged payloads as small as a webhook request.
+    """
+    entries = itertools.chain.from_iterable(_iter_due_unprocessed_data(app_id))
+    for _, connection_entries in itertools.groupby(
+        entries, key=lambda entry: entry.connection_id
+    ):
+        # (platform, attempts) -> [entries, number of samples]
+        groups = {}
+        for entry in connection_entries:
+            key = (entry.platform_id, entry.attempts)
+            samples = sum(len(data) for data in entry.data.values())
+            group = groups.get(key)
+            if group and group[1] + samples > MAX_CHUNK_SAMPLES:
+                yield group[0]
+                group = None
+            if group is None:
+                group = groups[key] = [[], 0]
+            group[0].append(entry)
+            group[1] += samples
+        for group_entries, _ in groups.values():
+            yield group_entries
+
+
 @shared_task
-@single_instance_task(timeout=60 * 60 * 3)
+@single_instance_task(timeout=60 * 5)
 def sync_unprocessed_webhook_queue():
+    """
+    Queues a replay of the due unprocessed data for every app, the apps are
+    replayed in parallel by the webhook delivery workers
+    """
     logger.info(f"[CRON] Syncing unprocessed")
-    synced = 0
-    total = UnprocessedData.objects.count()
-    # We will sync the most recent entries first
-    for entry in list(UnprocessedData.objects.all().order_by("-created_at")):
-        if not entry.connection.app.webhook_url:
-            continue
-
-        success = send_data_to_webhook(
-            entry.data,
-            entry.connection.app,
-            entry.platform.name,
-            entry.connection,
+    app_ids = list(
+        _get_due_unprocessed_data()
+        .order_by()
+        .values_list("connection__app_id", flat=True)
+        .distinct()
+    )
+    for app_id in app_ids:
+        _replay_unprocessed_data_for_app.delay(app_id)
+    logger.info(f"[CRON] Queued unprocessed replay for {len(app_ids)} apps")
+
+
+@shared_task
+def _replay_unprocessed_data_for_app(app_id):
+    if is_webhook_circuit_open(app_id):
+        logger.info(f"webhook circuit of app {app_id} is open, skipping replay")
+        return
+    lock_id = f"unprocessed_replay_{app_id}"
+    lock = cache.lock(lock_id, timeout=60 * 60 * 3)
+    if not lock.acquire(blocking=False):
+        logger.info(f"unprocessed replay for app {app_id} is already running")
+        return
+    try:
+        _replay_unprocessed_data(app_id)
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            logger.info(f"error while releasing lock for {lock_id}: {e}")
+
+
+def _replay_unprocessed_data(app_id):
+    total = _get_due_unprocessed_data().filter(connection__app_id=app_id).count()
+    progress = {"total": total, "processed": 0, "synced": 0, "payloads": 0}
+    started = time.monotonic()
+
+    def _on_complete(entries, unsent, attempted):
+        if not unsent:
+            progress["synced"] += len(entries)
+        _reschedule_unprocessed_data(entries, unsent, attempted)
+
+    def _report_progress():
+        elapsed = time.monotonic() - started
+        progress["rows_per_second"] = round(progress["processed"] / elapsed, 1)
+        # readable from other processes while the replay is running
+        cache.set(f"unprocessed_replay_progress_{app_id}", progress, 60 * 60 * 24)
+        logger.info(
+            f"[CRON] Replayed {progress['processed']}/{total} unprocessed for app {app_id} in {progress['payloads']} payloads, {progress['synced']} synced, {progress['rows_per_second']} rows/s"
         )
-        entry.delete()
-        if success:
-            synced += 1
 
-        # sleep for couple of seconds to avoid DDOSing the webhook
-        # time.sleep(0.1)
+    next_report = REPLAY_PAGE_SIZE
+    with concurrent_webhook_delivery():
+        # the rows of a connection and platform are merged and delivered
+        # together, the webhook splits the merged data in chunks
+        for entries in _iter_coalesced_unprocessed_data(app_id):
+            entry = entries[0]
+            send_data_to_webhook(
+                _merge_data(e.data for e in entries),
+                entry.connection.app,
+                entry.platform.name,
+                entry.connection,
+                on_complete=functools.partial(_on_complete, entries),
+            )
+            progress["processed"] += len(entries)
+            progress["payloads"] += 1
+            if progress["processed"] >= next_report:
+                _report_progress()
+                next_report = progress["processed"] + REPLAY_PAGE_SIZE
 
-    logger.info(f"[CRON] Synced unprocessed, {synced}/{total}")
+    # deliveries still in flight are complete once the context exits
+    _report_progress()
 
 
 @shared_task
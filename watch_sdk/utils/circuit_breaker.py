@@ -0,0 +1,128 @@
+# Per app circuit breaker for webhook calls.
+#
+# closed: calls are made, failures are counted in a sliding window of time
+#   buckets with atomic redis counters. Successful calls don't touch redis.
+# open: too many calls failed in the window, no calls are made for a while and
+#   the data is kept to be delivered later.
+# half open: once the open period is over a single probe call is let through,
+#   the circuit closes if it succeeds and opens again otherwise.
+
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# seconds covered by a failure counter, the window is made of multiple buckets
+BUCKET_SECONDS = 10
+# how long a probe call can take before another one is let through
+PROBE_TIMEOUT = 30
+# how long we remember that the circuit was opened, so that the next call is a
+# probe once the open period is over
+TRIPPED_TTL = 60 * 60 * 24 * 7
+
+
+def _keys(app_id):
+    return (
+        f"webhook_circuit_open_{app_id}",
+        f"webhook_circuit_tripped_{app_id}",
+        f"webhook_circuit_probe_{app_id}",
+    )
+
+
+def is_webhook_circuit_open(app_id):
+    """
+    Returns whether calls to the webhook of the app are paused, a half open
+    circuit is not considered open
+    """
+    try:
+        open_key, _, _ = _keys(app_id)
+        return bool(get_redis_connection("default").exists(open_key))
+    except Exception as e:
+        logger.warning(f"unable to get webhook circuit of app {app_id}: {e}")
+        return False
+
+
+def allow_webhook_call(app_id):
+    """
+    Returns whether a call can be made to the webhook of the app, and whether
+    that call is a probe whose result decides if the circuit closes. Calls are
+    allowed if redis is unavailable.
+    """
+    open_key, tripped_key, probe_key = _keys(app_id)
+    try:
+        redis = get_redis_connection("default")
+        is_open, tripped = redis.mget(open_key, tripped_key)
+        if is_open:
+            return False, False
+        if not tripped:
+            return True, False
+        # half open, only the call which gets to set the probe key is made
+        if redis.set(probe_key, 1, nx=True, ex=PROBE_TIMEOUT):
+            return True, True
+        return False, False
+    except Exception as e:
+        logger.warning(f"unable to get webhook circuit of app {app_id}: {e}")
+        return True, False
+
+
+def _open_circuit(redis, app_id):
+    """
+    Opens the circuit, returns True if it was closed before
+    """
+    open_key, tripped_key, probe_key = _keys(app_id)
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.set(open_key, 1, ex=settings.WEBHOOK_CIRCUIT_OPEN_SECONDS)
+    pipeline.set(tripped_key, 1, nx=True, ex=TRIPPED_TTL)
+    pipeline.expire(tripped_key, TRIPPED_TTL)
+    pipeline.delete(probe_key)
+    _, newly_tripped, _, _ = pipeline.execute()
+    return bool(newly_tripped)
+
+
+def record_webhook_result(app_id, success, probe):
+    """
+    Updates the circuit of the app with the result of a webhook call. Returns
+    True if the circuit was opened by this call after being closed.
+
+    :param probe: whether the call was a probe, see `allow_webhook_call`
+    """
+    open_key, tripped_key, probe_key = _keys(app_id)
+    if success and not probe:
+        return False
+
+    try:
+        redis = get_redis_connection("default")
+        if probe:
+            if success:
+                logger.info(f"webhook circuit of app {app_id} closed")
+                redis.delete(tripped_key, probe_key)
+            else:
+                _open_circuit(redis, app_id)
+            return False
+
+        bucket = int(time.time() // BUCKET_SECONDS)
+        buckets = range(
+            bucket - settings.WEBHOOK_CIRCUIT_WINDOW // BUCKET_SECONDS + 1, bucket + 1
+        )
+        key = f"webhook_circuit_failures_{app_id}_{bucket}"
+        pipeline = redis.pipeline(transaction=False)
+        pipeline.incr(key)
+        pipeline.expire(key, settings.WEBHOOK_CIRCUIT_WINDOW + BUCKET_SECONDS)
+        pipeline.mget([f"webhook_circuit_failures_{app_id}_{b}" for b in buckets])
+        _, _, counts = pipeline.execute()
+        failures = sum(int(count) for count in counts if count)
+        if failures < settings.WEBHOOK_CIRCUIT_FAILURE_THRESHOLD:
+            return False
+
+        # the failures that opened the circuit are not counted again
+        redis.delete(*[f"webhook_circuit_failures_{app_id}_{b}" for b in buckets])
+        logger.warning(
+            f"webhook circuit of app {app_id} opened after {failures} failures"
+        )
+        return _open_circuit(redis, app_id)
+    except Exception as e:
+        logger.warning(f"unable to update webhook circuit of app {app_id}: {e}")
+        return False
@@ -0,0 +1,50 @@
+import gzip
+
+import zstandard
+
+# encodings we can compress with, as used in Content-Encoding
+ENCODINGS = ("gzip", "zstd")
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def get_encoding(data_file):
+    """
+    Detects the compression of a seekable file from its magic bytes. Returns
+    "gzip", "zstd" or None when the file is not compressed.
+    """
+    position = data_file.tell()
+    header = data_file.read(len(ZSTD_MAGIC))
+    data_file.seek(position)
+    if header.startswith(GZIP_MAGIC):
+        return "gzip"
+    if header.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def open_decompressed(data_file):
+    """
+    Returns a file like object yielding the decompressed contents of a gzip or
+    zstd compressed file, decompressing as it is read. Uncompressed files are
+    returned as is.
+    """
+    encoding = get_encoding(data_file)
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=data_file, mode="rb")
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(
+            data_file, read_across_frames=True
+        )
+    return data_file
+
+
+def compress(data, encoding):
+    """
+    Compresses the bytes with the given encoding, "gzip" or "zstd"
+    """
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"unsupported encoding {encoding}")
@@ -4,12 +4,17 @@
 # - process for AI model
 
 
-from datetime import datetime
-from watch_sdk.models import DataType, HealthDataEntry, Platform
-from watch_sdk.utils.webhook import send_data_to_webhook
+from datetime import datetime, timezone
+from django.db import connection, transaction
+from psycopg2.extras import Json, execute_values
+from watch_sdk.models import DataType, Platform
+from watch_sdk.utils.downsample import downsample_health_data
+from watch_sdk.utils.webhook_outbox import enqueue_webhook_delivery
 
 
-def process_health_data(fitness_data, watch_connection, user_app, platform_name):
+def process_health_data(
+    fitness_data, watch_connection, user_app, platform_name, downsampler=None
+):
     """
     Process the health data
 
@@ -17,53 +22,137 @@ def process_health_data(fitness_data, watch_connection, user_app, platform_name)
     :param watch_connection: WatchConnection
     :param user_app: UserApp
     :param platform_name: str
+    :param downsampler: optional Downsampler, the downsampled data types are
+        added to it once the data is stored instead of being sent, see
+        `deliver_downsampled_data`
     """
-    if user_app.data_storage_option in set(["deny", "both"]):
-        send_data_to_webhook(
-            fitness_data,
-            user_app,
-            platform_name,
-            watch_connection,
-        )
+    # the data is queued for the webhook in the same transaction as it is
+    # stored, the delivery workers send it once the transaction commits
+    buckets = None
+    with transaction.atomic():
+        if user_app.data_storage_option in set(["deny", "both"]):
+            # we always store raw data but apps can choose to receive
+            # aggregated data over webhook
+            if downsampler is None:
+                webhook_data = downsample_health_data(
+                    fitness_data, user_app.data_resolution
+                )
+            else:
+                webhook_data, buckets = downsampler.split(fitness_data)
+            if webhook_data:
+                enqueue_webhook_delivery(webhook_data, platform_name, watch_connection)
+
+        if user_app.data_storage_option in set(["allow", "both"]):
+            # store data on our server
+            store_health_data(fitness_data, watch_connection, platform_name)
+
+    if buckets:
+        downsampler.merge(buckets)
+
+
+def deliver_downsampled_data(downsampler, watch_connection, platform_name):
+    """
+    Queues the buckets merged by the downsampler for the webhook
+
+    :param downsampler: Downsampler passed to `process_health_data`
+    :param watch_connection: WatchConnection
+    :param platform_name: str
+    """
+    downsampled = downsampler.flush()
+    if downsampled:
+        with transaction.atomic():
+            enqueue_webhook_delivery(downsampled, platform_name, watch_connection)
+
 
-    if user_app.data_storage_option in set(["allow", "both"]):
-        # store data on our server
-        store_health_data(fitness_data, watch_connection, platform_name)
+# Samples that are delivered again, eg. google fit data point changes or
+# overlapping healthkit uploads, update the stored sample if it changed and
+# are a no-op otherwise. The conflict target is the unique_health_data_entry
+# index of HealthDataEntry.
+UPSERT_HEALTH_DATA_SQL = """
+INSERT INTO watch_sdk_healthdataentry AS entry (
+    created_at,
+    updated_at,
+    user_connection_id,
+    source_platform_id,
+    data_type_id,
+    start_time,
+    end_time,
+    manual_entry,
+    value,
+    extra_data,
+    source_device
+)
+VALUES %s
+ON CONFLICT (
+    user_connection_id,
+    source_platform_id,
+    data_type_id,
+    start_time,
+    end_time,
+    (COALESCE(source_device, ''))
+) DO UPDATE SET
+    updated_at = EXCLUDED.updated_at,
+    manual_entry = EXCLUDED.manual_entry,
+    value = EXCLUDED.value,
+    extra_data = EXCLUDED.extra_data
+WHERE (entry.manual_entry, entry.value, entry.extra_data)
+    IS DISTINCT FROM (EXCLUDED.manual_entry, EXCLUDED.value, EXCLUDED.extra_data)
+"""
+UPSERT_PAGE_SIZE = 1000
 
 
 def store_health_data(fitness_data, watch_connection, platform_name):
     """
-    Store the health data on our server
+    Store the health data on our server, samples which are already stored are
+    updated instead of being stored again
 
     :param fitness_data: dict
     :param watch_connection: WatchConnection
     :param user_app: UserApp
     :param platform_name: str
     """
-    to_create = []
-    platform_obj = Platform.objects.get(name=platform_name)
+    now = datetime.now(tz=timezone.utc)
+    platform_id = Platform.objects.get(name=platform_name).id
+    data_type_ids = dict(
+        DataType.objects.filter(name__in=fitness_data.keys()).values_list("name", "id")
+    )
+    # a statement can't update the same row twice, so samples delivered more
+    # than once in the same batch are deduped, keeping the last one
+    rows = {}
     for data_type, entries in fitness_data.items():
-        data_type_obj = DataType.objects.get(name=data_type)
+        data_type_id = data_type_ids[data_type]
         for entry in entries:
             if not entry:
                 # skip empty entries
                 # TODO: we shouldn't get them in the first place
                 continue
+            entry = dict(entry)
             entry.pop("source")
-            to_create.append(
-                HealthDataEntry(
-                    user_connection=watch_connection,
-                    source_platform=platform_obj,
-                    data_type=data_type_obj,
-                    start_time=datetime.fromtimestamp(
-                        entry.pop("start_time") / 10**3
-                    ),
-                    end_time=datetime.fromtimestamp(entry.pop("end_time") / 10**3),
-                    manual_entry=entry.pop("manual_entry", False) or False,
-                    value=entry.pop("value"),
-                    source_device=entry.pop("source_device", None),
-                    extra_data=entry,
-                )
+            start_time = datetime.fromtimestamp(
+                entry.pop("start_time") / 10**3, tz=timezone.utc
+            )
+            end_time = datetime.fromtimestamp(
+                entry.pop("end_time") / 10**3, tz=timezone.utc
+            )
+            source_device = entry.pop("source_device", None)
+            key = (data_type_id, start_time, end_time, source_device or "")
+            rows[key] = (
+                now,
+                now,
+                watch_connection.id,
+                platform_id,
+                data_type_id,
+                start_time,
+                end_time,
+                entry.pop("manual_entry", False) or False,
+                entry.pop("value"),
+                Json(entry),
+                source_device,
             )
 
-    HealthDataEntry.objects.bulk_create(to_create)
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        execute_values(
+            cursor, UPSERT_HEALTH_DATA_SQL, rows.values(), page_size=UPSERT_PAGE_SIZE
+        )
@@ -0,0 +1,106 @@
+# Per connection store of the samples we have already processed, used to drop
+# samples that are uploaded again in overlapping windows.
+#
+# Fingerprints of samples are stored in redis sets, bucketed by the day the
+# sample started on so that every set stays small and expires on its own once
+# the connection stops uploading samples for that day.
+
+import collections
+import hashlib
+import logging
+import numbers
+
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# how long we remember the samples of a day after the last sample was added
+SAMPLE_FINGERPRINT_TTL = 60 * 60 * 24 * 14
+DAY_IN_MS = 24 * 60 * 60 * 1000
+
+
+def _sample_fingerprint(data_type, sample):
+    # the same sample can be parsed as a python int or float, or as a numpy
+    # scalar from a columnar upload, numbers are normalized so that its
+    # fingerprint doesn't depend on how it was uploaded
+    value = sample.get("value")
+    if isinstance(value, numbers.Number):
+        value = float(value)
+    identity = "|".join(
+        [
+            data_type,
+            str(int(sample["start_time"])),
+            str(int(sample["end_time"])),
+            repr(value),
+            str(sample.get("source_device")),
+        ]
+    )
+    return hashlib.blake2b(identity.encode("utf-8"), digest_size=8).digest()
+
+
+def _fingerprint_key(connection, platform_name, sample):
+    day = int(sample["start_time"] // DAY_IN_MS)
+    return f"sample_fingerprints:{connection.id}:{platform_name}:{day}"
+
+
+def drop_seen_samples(fitness_data, connection, platform_name):
+    """
+    Drops the samples which were already seen for the connection and marks the
+    remaining ones as seen. Returns the filtered fitness data, which has to be
+    passed to `forget_samples` if it could not be processed.
+
+    A sample is identified by its data type, start time, end time, value and
+    source device. If redis is unavailable the data is returned as is.
+
+    :param fitness_data: dict of data type -> list of samples
+    :param connection: WatchConnection
+    :param platform_name: str
+    """
+    entries = []
+    keys = set()
+    try:
+        redis = get_redis_connection("default")
+        pipeline = redis.pipeline(transaction=False)
+        for data_type, samples in fitness_data.items():
+            for sample in samples:
+                key = _fingerprint_key(connection, platform_name, sample)
+                pipeline.sadd(key, _sample_fingerprint(data_type, sample))
+                entries.append((data_type, sample))
+                keys.add(key)
+        for key in keys:
+            pipeline.expire(key, SAMPLE_FINGERPRINT_TTL)
+        added = pipeline.execute()
+    except Exception as e:
+        logger.warning(f"unable to dedup samples for {connection.user_uuid}: {e}")
+        return fitness_data
+
+    filtered = collections.defaultdict(list)
+    for (data_type, sample), is_new in zip(entries, added):
+        if is_new:
+            filtered[data_type].append(sample)
+
+    dropped = len(entries) - sum(len(samples) for samples in filtered.values())
+    if dropped:
+        logger.info(
+            f"dropped {dropped} already seen samples for {connection.user_uuid} on {platform_name}"
+        )
+    return filtered
+
+
+def forget_samples(fitness_data, connection, platform_name):
+    """
+    Unmarks samples marked as seen by `drop_seen_samples`, so that they are
+    processed again when they are uploaded again
+    """
+    try:
+        redis = get_redis_connection("default")
+        pipeline = redis.pipeline(transaction=False)
+        for data_type, samples in fitness_data.items():
+            for sample in samples:
+                pipeline.srem(
+                    _fingerprint_key(connection, platform_name, sample),
+                    _sample_fingerprint(data_type, sample),
+                )
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"unable to forget samples for {connection.user_uuid}: {e}")
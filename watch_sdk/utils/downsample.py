@@ -0,0 +1,200 @@
+# Aggregates high frequency samples into fixed size time buckets before they
+# are delivered, for apps that don't need every raw sample (mostly heart rate)
+
+import numpy as np
+
+# bucket size in milliseconds for each supported delivery resolution
+RESOLUTIONS = {
+    "raw": None,
+    "1m": 60 * 1000,
+    "5m": 5 * 60 * 1000,
+    "1h": 60 * 60 * 1000,
+}
+
+# data types whose samples are plain values that can be aggregated, sleep and
+# workouts carry more than a value and are always delivered raw
+DOWNSAMPLE_DATA_TYPES = set(
+    [
+        "heart_rate",
+        "blood_oxygen",
+        "steps",
+        "calories",
+        "calories_bmr",
+        "distance_moved",
+        "move_minutes",
+        "water_consumed",
+        "weight",
+        "height",
+    ]
+)
+
+# data types whose samples are amounts over their time range, the value of a
+# bucket is the total of its samples. The value of the other data types is the
+# mean of the bucket.
+CUMULATIVE_DATA_TYPES = set(
+    [
+        "steps",
+        "calories",
+        "calories_bmr",
+        "distance_moved",
+        "move_minutes",
+        "water_consumed",
+    ]
+)
+
+
+def _aggregate(samples, bucket_size):
+    """
+    Aggregates the samples into buckets of `bucket_size` milliseconds based on
+    their start time. Returns a dict of bucket -> [sum, count, min, max,
+    manual_entry].
+    """
+    start_times = np.array([s["start_time"] for s in samples], dtype=np.float64)
+    values = np.array([s["value"] for s in samples], dtype=np.float64)
+    manual_entries = np.array([bool(s.get("manual_entry")) for s in samples])
+
+    buckets, inverse, counts = np.unique(
+        (start_times // bucket_size).astype(np.int64),
+        return_inverse=True,
+        return_counts=True,
+    )
+    sums = np.bincount(inverse, weights=values)
+    mins = np.full(len(buckets), np.inf)
+    np.minimum.at(mins, inverse, values)
+    maxs = np.full(len(buckets), -np.inf)
+    np.maximum.at(maxs, inverse, values)
+    manual = np.zeros(len(buckets), dtype=bool)
+    np.logical_or.at(manual, inverse, manual_entries)
+
+    return {
+        bucket: list(aggregate)
+        for bucket, *aggregate in zip(
+            buckets.tolist(),
+            sums.tolist(),
+            counts.tolist(),
+            mins.tolist(),
+            maxs.tolist(),
+            manual.tolist(),
+        )
+    }
+
+
+def _merge_buckets(buckets, other):
+    for bucket, (total, count, minimum, maximum, is_manual) in other.items():
+        if bucket not in buckets:
+            buckets[bucket] = [total, count, minimum, maximum, is_manual]
+            continue
+        aggregate = buckets[bucket]
+        aggregate[0] += total
+        aggregate[1] += count
+        aggregate[2] = min(aggregate[2], minimum)
+        aggregate[3] = max(aggregate[3], maximum)
+        aggregate[4] = aggregate[4] or is_manual
+
+
+def _bucket_samples(data_type, source, buckets, bucket_size):
+    """
+    Every bucket is delivered as a single sample, along with the min, max, sum
+    and count of the bucket
+    """
+    cumulative = data_type in CUMULATIVE_DATA_TYPES
+    return [
+        {
+            "source": source,
+            "start_time": bucket * bucket_size,
+            "end_time": (bucket + 1) * bucket_size,
+            "manual_entry": is_manual,
+            "source_device": None,
+            "value": total if cumulative else total / count,
+            "min": minimum,
+            "max": maximum,
+            "sum": total,
+            "count": count,
+        }
+        for bucket, (total, count, minimum, maximum, is_manual) in sorted(
+            buckets.items()
+        )
+    ]
+
+
+class Downsampler:
+    """
+    Downsamples the data of several batches, eg. the batches of an upload, so
+    that a bucket spanning two batches is delivered as a single sample.
+
+    `split` returns the data which is delivered raw and the buckets of the
+    batch, which are added with `merge`. The merged buckets are delivered with
+    `flush`.
+    """
+
+    def __init__(self, data_resolution):
+        self.data_resolution = data_resolution or {}
+        # data type -> (source, bucket -> aggregate)
+        self.buckets = {}
+
+    def _get_bucket_size(self, data_type):
+        if data_type not in DOWNSAMPLE_DATA_TYPES:
+            return None
+        return RESOLUTIONS.get(self.data_resolution.get(data_type))
+
+    def split(self, fitness_data):
+        """
+        :param fitness_data: dict of data type -> list of samples
+        """
+        raw, buckets = {}, {}
+        for data_type, samples in fitness_data.items():
+            samples = [s for s in samples if s]
+            bucket_size = self._get_bucket_size(data_type)
+            if not bucket_size or not samples:
+                raw[data_type] = fitness_data[data_type]
+            else:
+                buckets[data_type] = (
+                    samples[0]["source"],
+                    _aggregate(samples, bucket_size),
+                )
+        return raw, buckets
+
+    def merge(self, buckets):
+        for data_type, (source, data_type_buckets) in buckets.items():
+            _, merged = self.buckets.setdefault(data_type, (source, {}))
+            _merge_buckets(merged, data_type_buckets)
+
+    def flush(self):
+        """
+        Returns the downsampled data of the merged buckets and clears them
+        """
+        downsampled = {
+            data_type: _bucket_samples(
+                data_type, source, buckets, self._get_bucket_size(data_type)
+            )
+            for data_type, (source, buckets) in self.buckets.items()
+        }
+        self.buckets = {}
+        return downsampled
+
+
+def downsample_health_data(fitness_data, data_resolution):
+    """
+    Downsamples the fitness data as per the delivery resolution of the app.
+    Data types without a resolution, or with `raw`, are returned as is.
+
+    Buckets are computed for this data only, so a bucket spanning two syncs is
+    delivered as two aggregated samples. Use a `Downsampler` to merge the
+    buckets of several batches.
+
+    :param fitness_data: dict of data type -> list of samples
+    :param data_resolution: dict of data type -> resolution (see RESOLUTIONS)
+    """
+    if not data_resolution:
+        return fitness_data
+
+    downsampler = Downsampler(data_resolution)
+    raw, buckets = downsampler.split(fitness_data)
+    downsampler.merge(buckets)
+    downsampled = downsampler.flush()
+    return {
+        data_type: downsampled[data_type]
+        if data_type in downsampled
+        else raw[data_type]
+        for data_type in fitness_data
+    }
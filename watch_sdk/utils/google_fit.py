@@ -1,6 +1,7 @@
 import collections
 import logging
 from watch_sdk.data_providers.google_fit import GoogleFitConnection
+from watch_sdk.dataclasses import batch_to_dict
 
 from watch_sdk.models import (
     ConnectedPlatformMetadata,
@@ -127,34 +128,33 @@ def _perform_sync_connection(google_fit_connection: ConnectedPlatformMetadata):
                 data_type,
                 data,
             ) in fit_connection.get_data_since_last_sync().items():
+                # data types without new points are skipped, to not send
+                # empty data when nothing changed
+                if not data:
+                    continue
                 data_key, dclass = google_fit.RANGE_DATA_TYPES[data_type]
-                for d in data:
-                    if data_key == "sleep":
-                        sleep_type = _get_sleep_type(d.value)
-                        start_time = int(d.start_time) / 10**6
-                        end_time = int(d.end_time) / 10**6
-                        fitness_data[data_key].append(
-                            dclass(
-                                source="google_fit",
-                                start_time=start_time,
-                                end_time=end_time,
-                                manual_entry=d.manual_entry,
-                                source_device=None,
-                                value=end_time - start_time,
-                                sleep_type=sleep_type,
-                            ).to_dict()
-                        )
-                    else:
-                        fitness_data[data_key].append(
-                            dclass(
-                                source="google_fit",
-                                start_time=int(d.start_time) / 10**6,
-                                end_time=int(d.end_time) / 10**6,
-                                manual_entry=d.manual_entry,
-                                source_device=None,
-                                value=d.value,
-                            ).to_dict()
-                        )
+                start_times = [int(d.start_time) / 10**6 for d in data]
+                end_times = [int(d.end_time) / 10**6 for d in data]
+                columns = {
+                    "start_time": start_times,
+                    "end_time": end_times,
+                    "manual_entry": [d.manual_entry for d in data],
+                }
+                if data_key == "sleep":
+                    columns["sleep_type"] = [_get_sleep_type(d.value) for d in data]
+                    columns["value"] = [
+                        end_time - start_time
+                        for start_time, end_time in zip(start_times, end_times)
+                    ]
+                else:
+                    columns["value"] = [d.value for d in data]
+                fitness_data[data_key].extend(
+                    batch_to_dict(
+                        dclass,
+                        columns,
+                        {"source": "google_fit", "source_device": None},
+                    )
+                )
 
             if not fitness_data:
                 return
@@ -2,17 +2,52 @@ import base64
 import hashlib
 import hmac
 
+from django.core.files.uploadhandler import FileUploadHandler
+
 
 def get_hash(data):
     return hashlib.sha256(str(data).encode("utf-8")).hexdigest()
 
 
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Upload handler that computes the hash of the uploaded files while their
+    bytes are received. It only observes the data, so it must be placed before
+    the handlers that store the files.
+
+    The hashes are available in `hashes` keyed by the form field name.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.hashes = {}
+        self._sha = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._sha = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._sha.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.hashes[self.field_name] = self._sha.hexdigest()
+        # let the next handler build the file object
+        return None
+
+
 def get_webhook_signature(request_body, client_secret):
+    """
+    Signs the request body, which is either a str or the exact bytes sent
+    """
+    if isinstance(request_body, str):
+        request_body = request_body.encode("utf-8")
     signing_key = client_secret + "&"
     encoded_body = base64.b64encode(
         hmac.new(
             signing_key.encode("utf-8"),
-            request_body.encode("utf-8"),
+            request_body,
             hashlib.sha1,
         ).digest()
     )
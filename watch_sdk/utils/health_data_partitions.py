@@ -0,0 +1,110 @@
+# Maintenance of the monthly partitions of HealthDataEntry.
+#
+# The table is partitioned by range of start_time, one partition per month
+# (UTC) named watch_sdk_healthdataentry_pYYYY_MM, see migration 0065. Rows
+# that don't fall in any partition go to the default partition.
+
+import datetime
+import logging
+
+from celery import shared_task
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+TABLE = "watch_sdk_healthdataentry"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+def _month_start(day, months=0):
+    month = day.year * 12 + day.month - 1 + months
+    return datetime.datetime(
+        month // 12, month % 12 + 1, 1, tzinfo=datetime.timezone.utc
+    )
+
+
+def _get_partitions(cursor):
+    """
+    Returns the name and upper bound of every partition, the bound is None for
+    the default partition
+    """
+    cursor.execute(
+        r"""
+        SELECT c.relname,
+               substring(pg_get_expr(c.relpartbound, c.oid) from 'TO \(''([^'']+)''\)')::timestamptz
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        """,
+        [TABLE],
+    )
+    return cursor.fetchall()
+
+
+def _create_partition(cursor, start, end):
+    """
+    Creates the partition for [start, end). Rows of that range which went to
+    the default partition are moved to the new partition.
+    """
+    name = f"{TABLE}_p{start:%Y_%m}"
+    with transaction.atomic():
+        cursor.execute(
+            f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION}
+                WHERE start_time >= %s AND start_time < %s
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """,
+            [start, end],
+        )
+        if cursor.rowcount:
+            logger.info(f"moved {cursor.rowcount} rows from the default partition")
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+            [start, end],
+        )
+    logger.info(f"created health data partition {name}")
+
+
+@shared_task
+def create_health_data_partitions():
+    """
+    Creates the partitions of the current month and of the next
+    `HEALTH_DATA_PARTITIONS_AHEAD` months if they don't exist
+    """
+    today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+    with connection.cursor() as cursor:
+        existing = {bound for _, bound in _get_partitions(cursor)}
+        for months in range(settings.HEALTH_DATA_PARTITIONS_AHEAD + 1):
+            start = _month_start(today, months)
+            end = _month_start(today, months + 1)
+            if end in existing:
+                continue
+            _create_partition(cursor, start, end)
+
+
+@shared_task
+def drop_expired_health_data_partitions():
+    """
+    Drops the partitions whose data is all older than
+    `HEALTH_DATA_RETENTION_MONTHS`, data is not deleted row by row
+    """
+    if settings.HEALTH_DATA_RETENTION_MONTHS is None:
+        return
+
+    today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+    cutoff = _month_start(today, -settings.HEALTH_DATA_RETENTION_MONTHS)
+    with connection.cursor() as cursor:
+        for name, bound in _get_partitions(cursor):
+            if bound is None or bound > cutoff:
+                continue
+            # detaching first keeps the lock on the parent table short
+            cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+            logger.info(f"dropped health data partition {name}, data before {bound}")
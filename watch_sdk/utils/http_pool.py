@@ -0,0 +1,63 @@
+# Per worker pool of persistent http sessions, keyed by host, so that repeated
+# requests to the same customer endpoint reuse keep-alive connections instead of
+# paying for DNS, TCP and TLS handshakes on every request.
+
+import collections
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+
+# host -> (session, last used time)
+_sessions = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.WEBHOOK_POOL_SIZE,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _evict_sessions(now):
+    """
+    Drops sessions which have not been used for a while, and the least
+    recently used ones if we are over the max number of hosts.
+
+    Evicted sessions are not closed, as delivery threads may still be sending
+    requests with them. Their connections are closed once the last of them is
+    done and the session is garbage collected.
+    """
+    for host, (_, last_used) in list(_sessions.items()):
+        if now - last_used > settings.WEBHOOK_POOL_IDLE_TIMEOUT:
+            del _sessions[host]
+
+    while len(_sessions) > settings.WEBHOOK_POOL_MAX_HOSTS:
+        _sessions.popitem(last=False)
+
+
+def get_session(url):
+    """
+    Returns the pooled session for the host of the given url
+    """
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    now = time.monotonic()
+    with _lock:
+        if host in _sessions:
+            session, _ = _sessions.pop(host)
+        else:
+            session = _new_session()
+        # most recently used hosts are kept at the end
+        _sessions[host] = (session, now)
+        _evict_sessions(now)
+
+    return session
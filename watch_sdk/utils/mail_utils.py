@@ -124,19 +124,19 @@ Metric Health Team""",
 
 
 @shared_task
-def send_email_on_webhook_disabled(app_id, webhook_url):
+def send_email_on_webhook_paused(app_id, webhook_url):
     app = UserApp.objects.get(id=app_id)
     access_users = app.access_users.all().values_list("email", flat=True)
-    subject = f"[Metric Backend] Webhook disabled due to 5 consecutive errors"
+    subject = f"[Metric Backend] Webhook paused due to consecutive errors"
     to = [app.user.email, *access_users]
     body = f"""
 Dear {app.name} team,
 
-We have disabled your webhook due to 5 consecutive errors. Please check your webhook and make sure it is working correctly.
+We have paused sending data to your webhook due to consecutive errors. Please check your webhook and make sure it is working correctly.
 
 Webhook Url: {webhook_url}
 
-If you have fixed the issue, you can re-enable the webhook by going to app.metric.health and updating the webhook url.
+Your data is kept safe in the meantime. We will check your webhook periodically and resume sending the data automatically once it is working again.
 
 If you feel that the webhook is working correctly, please make sure that you return a 200 status code.
 You can reach out to us at contact@metric.health or reply to this email if you have any questions.
@@ -0,0 +1,273 @@
+# Delivery metrics are counted in redis and written to the database in bulk
+# by a periodic flush, so that delivering a chunk doesn't write to the
+# database.
+#
+# Synced totals are kept per minute in a hash keyed by app, platform and data
+# type, once a minute is over they are flushed as DataSyncMetric rows.
+#
+# The connections of an app which received data on a day are counted in a
+# HyperLogLog sketch, which takes at most 12KB whatever the number of users.
+# Sketches are persisted to UserActivitySketch periodically and merged to get
+# the number of distinct users over any number of days. Active users are
+# counted on a best-effort basis, deliveries made while redis is unavailable
+# are not counted.
+
+import datetime
+import logging
+import time
+import uuid
+
+from celery import shared_task
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from watch_sdk.models import DataSyncMetric, DataType, Platform, UserActivitySketch
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SECONDS = 60
+# counters which could not be flushed for this long are dropped
+COUNTER_TTL = 60 * 60 * 24
+BUCKETS_KEY = "delivery_metrics:buckets"
+# sketches are persisted long before they expire, the ones of past days are
+# read from the database
+SKETCH_TTL = 60 * 60 * 24 * 3
+# app and days whose sketch changed since it was last persisted
+PENDING_SKETCHES_KEY = "user_activity:pending"
+# max number of days the active users can be asked for at once
+MAX_ACTIVITY_RANGE_DAYS = 366
+
+
+def _totals_key(bucket):
+    return f"delivery_metrics:totals:{bucket}"
+
+
+def _sketch_key(app_id, day):
+    return f"user_activity:{app_id}:{day.isoformat()}"
+
+
+def _get_chunk_totals(chunk):
+    totals = {}
+    for data_type, data in chunk.items():
+        total = 0
+        for d in data:
+            # downsampled samples carry the total of their bucket in sum
+            total += d.get("sum", d.get("value", 0))
+        totals[data_type] = total
+    return totals
+
+
+def _store_metrics(app_id, platform_name, totals):
+    platform = Platform.objects.get(name=platform_name)
+    data_types = dict(
+        DataType.objects.filter(name__in=totals.keys()).values_list("name", "id")
+    )
+    DataSyncMetric.objects.bulk_create(
+        [
+            DataSyncMetric(
+                app_id=app_id,
+                value=total,
+                data_type_id=data_types[data_type],
+                platform=platform,
+            )
+            for data_type, total in totals.items()
+            if data_type in data_types
+        ]
+    )
+
+
+def record_delivery_metrics(app_id, connection_id, platform_name, chunk):
+    """
+    Counts the data of a chunk which was delivered to the webhook of the app,
+    and the connection as active today. The synced totals are written to the
+    database right away if redis is unavailable.
+
+    Counting active users is best-effort: the sketches only live in redis
+    until they are persisted, so a connection whose deliveries all happen
+    while redis is unavailable is not counted as active that day.
+    """
+    totals = _get_chunk_totals(chunk)
+    now = time.time()
+    bucket = int(now // BUCKET_SECONDS)
+    today = datetime.datetime.fromtimestamp(now, tz=datetime.timezone.utc).date()
+    try:
+        pipeline = get_redis_connection("default").pipeline(transaction=False)
+        for data_type, total in totals.items():
+            pipeline.hincrbyfloat(
+                _totals_key(bucket), f"{app_id}|{platform_name}|{data_type}", total
+            )
+        pipeline.expire(_totals_key(bucket), COUNTER_TTL)
+        pipeline.sadd(BUCKETS_KEY, bucket)
+        pipeline.pfadd(_sketch_key(app_id, today), connection_id)
+        pipeline.expire(_sketch_key(app_id, today), SKETCH_TTL)
+        pipeline.sadd(PENDING_SKETCHES_KEY, f"{app_id}|{today.isoformat()}")
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"unable to count delivery metrics for app {app_id}: {e}")
+        _store_metrics(app_id, platform_name, totals)
+
+
+def _pop_bucket(redis, bucket):
+    """
+    Reads and clears the counters of the bucket atomically, so that they are
+    flushed once even if flushes overlap
+    """
+    pipeline = redis.pipeline(transaction=True)
+    pipeline.hgetall(_totals_key(bucket))
+    pipeline.delete(_totals_key(bucket))
+    pipeline.srem(BUCKETS_KEY, bucket)
+    totals, _, _ = pipeline.execute()
+    return totals
+
+
+def _restore_bucket(redis, bucket, totals):
+    pipeline = redis.pipeline(transaction=False)
+    for field, total in totals.items():
+        pipeline.hincrbyfloat(_totals_key(bucket), field, float(total))
+    pipeline.expire(_totals_key(bucket), COUNTER_TTL)
+    pipeline.sadd(BUCKETS_KEY, bucket)
+    pipeline.execute()
+
+
+@shared_task
+def flush_delivery_metrics():
+    """
+    Writes the counters of the minutes which are over to the database as
+    rollup rows, one DataSyncMetric per app, platform and data type
+    """
+    redis = get_redis_connection("default")
+    current_bucket = int(time.time() // BUCKET_SECONDS)
+    buckets = sorted(int(b) for b in redis.smembers(BUCKETS_KEY))
+    platforms = dict(Platform.objects.values_list("name", "id"))
+    data_types = dict(DataType.objects.values_list("name", "id"))
+    flushed = 0
+    for bucket in buckets:
+        if bucket >= current_bucket:
+            continue
+        totals = _pop_bucket(redis, bucket)
+        sync_metrics = []
+        try:
+            for field, total in totals.items():
+                app_id, platform_name, data_type = field.decode("utf-8").split("|")
+                if data_type not in data_types or platform_name not in platforms:
+                    logger.warning(
+                        f"skipping delivery metrics of unknown platform {platform_name} or data type {data_type}"
+                    )
+                    continue
+                sync_metrics.append(
+                    DataSyncMetric(
+                        app_id=int(app_id),
+                        value=float(total),
+                        data_type_id=data_types[data_type],
+                        platform_id=platforms[platform_name],
+                    )
+                )
+            DataSyncMetric.objects.bulk_create(sync_metrics)
+        except Exception:
+            _restore_bucket(redis, bucket, totals)
+            raise
+        flushed += len(sync_metrics)
+
+    logger.info(f"[CRON] Flushed {flushed} delivery metrics")
+
+
+@shared_task
+def persist_user_activity_sketches():
+    """
+    Saves the sketches which changed since they were last persisted. The
+    persisted sketch is merged into the one in redis first, so that activity
+    counted before redis lost the sketch is kept.
+    """
+    lock_id = "persist_user_activity_sketches"
+    lock = cache.lock(lock_id, timeout=60 * 10)
+    if not lock.acquire(blocking=False):
+        logger.info("user activity sketches are already being persisted")
+        return
+    try:
+        _persist_user_activity_sketches()
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            logger.info(f"error while releasing lock for {lock_id}: {e}")
+
+
+def _persist_user_activity_sketches():
+    redis = get_redis_connection("default")
+    persisted = 0
+    for member in redis.smembers(PENDING_SKETCHES_KEY):
+        # activity counted from now on marks the sketch as pending again
+        redis.srem(PENDING_SKETCHES_KEY, member)
+        app_id, day = member.decode("utf-8").split("|")
+        day = datetime.date.fromisoformat(day)
+        key = _sketch_key(app_id, day)
+        saved = (
+            UserActivitySketch.objects.filter(app_id=app_id, date=day)
+            .values_list("sketch", flat=True)
+            .first()
+        )
+        pipeline = redis.pipeline(transaction=False)
+        if saved is not None:
+            saved_key = f"{key}:saved"
+            pipeline.set(saved_key, bytes(saved), ex=60)
+            pipeline.pfmerge(key, key, saved_key)
+            pipeline.delete(saved_key)
+        pipeline.expire(key, SKETCH_TTL)
+        pipeline.get(key)
+        sketch = pipeline.execute()[-1]
+        try:
+            UserActivitySketch.objects.update_or_create(
+                app_id=app_id, date=day, defaults={"sketch": sketch}
+            )
+        except Exception:
+            redis.sadd(PENDING_SKETCHES_KEY, member)
+            raise
+        persisted += 1
+
+    logger.info(f"[CRON] Persisted {persisted} user activity sketches")
+
+
+def get_active_users(app_id, start_date, end_date):
+    """
+    Returns the number of distinct connections of the app which received data
+    over the range of days, and for every day of the range the ones which
+    received data on that day (dau), over the 7 days (wau) and the 30 days
+    (mau) ending on it. Counts are estimates, with a standard error of 0.81%.
+    """
+    days = [
+        start_date + datetime.timedelta(days=i)
+        for i in range(-29, (end_date - start_date).days + 1)
+    ]
+    saved = dict(
+        UserActivitySketch.objects.filter(
+            app_id=app_id, date__gte=days[0], date__lte=end_date
+        ).values_list("date", "sketch")
+    )
+    redis = get_redis_connection("default")
+
+    # the sketches of every day are merged with the ones in redis, which are
+    # more recent, in temporary keys
+    prefix = f"user_activity_query:{uuid.uuid4().hex}"
+    keys = [f"{prefix}:{day.isoformat()}" for day in days]
+    pipeline = redis.pipeline(transaction=False)
+    for day, key in zip(days, keys):
+        if day in saved:
+            pipeline.set(key, bytes(saved[day]), ex=60)
+        pipeline.pfmerge(key, key, _sketch_key(app_id, day))
+        pipeline.expire(key, 60)
+    pipeline.execute()
+
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.pfcount(*keys[29:])
+    for i in range(29, len(days)):
+        pipeline.pfcount(keys[i])
+        pipeline.pfcount(*keys[i - 6 : i + 1])
+        pipeline.pfcount(*keys[i - 29 : i + 1])
+    pipeline.delete(*keys)
+    counts = pipeline.execute()
+
+    daily = []
+    for i, day in enumerate(days[29:]):
+        dau, wau, mau = counts[1 + i * 3 : 4 + i * 3]
+        daily.append({"date": day.isoformat(), "dau": dau, "wau": wau, "mau": mau})
+    return {"active_users": counts[0], "days": daily}
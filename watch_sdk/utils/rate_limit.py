@@ -0,0 +1,138 @@
+# Per app rate limiting of outbound webhook calls, shared by all the workers.
+#
+# Every app has a token bucket in redis which is refilled at the rate limit of
+# the app, a webhook call takes a token. When the webhook of an app responds
+# with 429 the bucket is paused for the duration asked for in Retry-After.
+
+import email.utils
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# Takes a token from the bucket if there is one. Returns 0 when a token was
+# taken, otherwise the number of milliseconds after which to try again.
+#
+# KEYS[1]: bucket, a hash of the tokens left and the time they were counted at
+# KEYS[2]: set with the Retry-After of the webhook as its expiry
+# ARGV[1]: tokens added per second
+# ARGV[2]: max tokens in the bucket
+TAKE_TOKEN_SCRIPT = """
+local retry_after = redis.call('PTTL', KEYS[2])
+if retry_after > 0 then
+    return retry_after
+end
+
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+_take_token = None
+
+
+def get_webhook_rate_limit(user_app):
+    """
+    Returns the number of webhook calls per second allowed for the app
+    """
+    if user_app.webhook_rate_limit:
+        return user_app.webhook_rate_limit
+    return settings.WEBHOOK_RATE_LIMITS.get(
+        user_app.payment_plan, settings.WEBHOOK_RATE_LIMITS["free"]
+    )
+
+
+def get_webhook_token_wait(app_id, rate):
+    """
+    Takes a token for a webhook call of the app. Returns 0 when the call can
+    be made right away, otherwise the number of seconds to wait before trying
+    again. Calls are allowed if redis is unavailable.
+
+    :param rate: webhook calls per second allowed for the app
+    """
+    global _take_token
+    try:
+        if _take_token is None:
+            _take_token = get_redis_connection("default").register_script(
+                TAKE_TOKEN_SCRIPT
+            )
+        capacity = max(1, rate * settings.WEBHOOK_RATE_LIMIT_BURST)
+        wait = _take_token(
+            keys=[f"webhook_tokens_{app_id}", f"webhook_retry_after_{app_id}"],
+            args=[rate, capacity],
+        )
+    except Exception as e:
+        logger.warning(f"unable to rate limit webhook of app {app_id}: {e}")
+        return 0
+
+    return wait / 1000
+
+
+def wait_for_webhook_token(app_id, rate):
+    """
+    Blocks until a token is taken for a webhook call of the app. Returns False
+    if that would take more than `WEBHOOK_RATE_LIMIT_MAX_WAIT` seconds.
+    """
+    waited = 0
+    while True:
+        wait = get_webhook_token_wait(app_id, rate)
+        if wait <= 0:
+            return True
+        if waited + wait > settings.WEBHOOK_RATE_LIMIT_MAX_WAIT:
+            return False
+        time.sleep(wait)
+        waited += wait
+
+
+def get_retry_after(response):
+    """
+    Returns the number of seconds asked for in the Retry-After header of the
+    response, which is either a number of seconds or a http date
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return settings.WEBHOOK_DEFAULT_RETRY_AFTER
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(
+            0, email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        )
+    except (TypeError, ValueError):
+        return settings.WEBHOOK_DEFAULT_RETRY_AFTER
+
+
+def set_webhook_retry_after(app_id, seconds):
+    """
+    Pauses the webhook calls of the app for the given number of seconds
+    """
+    seconds = min(seconds, settings.WEBHOOK_MAX_RETRY_AFTER)
+    if seconds <= 0:
+        return
+    try:
+        get_redis_connection("default").set(
+            f"webhook_retry_after_{app_id}", 1, px=int(seconds * 1000)
+        )
+    except Exception as e:
+        logger.warning(f"unable to store retry after for app {app_id}: {e}")
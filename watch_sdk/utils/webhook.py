@@ -1,24 +1,42 @@
+import collections
+import contextlib
 import datetime
+import functools
 import logging
-import random
-import requests
 import json
+import threading
 from celery import shared_task
 
 from watch_sdk.models import (
-    DataSyncMetric,
-    DataType,
     DebugWebhookLogs,
     Platform,
     UnprocessedData,
-    UserActivityMetric,
 )
+from watch_sdk.utils.circuit_breaker import allow_webhook_call, record_webhook_result
+from watch_sdk.utils.compression import ENCODINGS, compress
 from watch_sdk.utils.hash_utils import get_webhook_signature
+from watch_sdk.utils.http_pool import get_session
+from watch_sdk.utils.metrics import record_delivery_metrics
+from watch_sdk.utils.rate_limit import (
+    get_retry_after,
+    get_webhook_rate_limit,
+    get_webhook_token_wait,
+    set_webhook_retry_after,
+    wait_for_webhook_token,
+)
+from watch_sdk.utils.webhook_fanout import (
+    BLOCKED,
+    DELIVERED,
+    FAILED,
+    MAX_THROTTLED_RETRIES,
+    THROTTLED,
+    WebhookFanout,
+)
 from watch_sdk.utils.mail_utils import (
-    send_email_on_webhook_disabled,
     send_email_on_webhook_error,
+    send_email_on_webhook_paused,
 )
-from django.core.cache import cache
+from django.conf import settings
 
 try:
     from zoneinfo import ZoneInfo
@@ -26,78 +44,50 @@ except ImportError:
     from backports.zoneinfo import ZoneInfo
 
 
-FAILURE_THRESHOLD = 5
 logger = logging.getLogger(__name__)
 
+MAX_CHUNK_SAMPLES = 500
+# smallest max request size an app can ask for
+MIN_WEBHOOK_REQUEST_BYTES = 10 * 1024
+# size of the body around the data of a chunk, `{"data": {}, "uuid": ""}` and
+# the uuid of the user
+CHUNK_OVERHEAD_BYTES = 256
 
-def _store_data_sync_metric(user_app, chunk, platform_name):
-    for data_type, data in chunk.items():
-        total = 0
-        for d in data:
-            total += d.get("value", 0)
+# holds the active concurrent delivery of the thread, if any
+_local = threading.local()
 
-        DataSyncMetric.objects.create(
-            app=user_app,
-            value=total,
-            data_type=DataType.objects.get(name=data_type),
-            platform=Platform.objects.get(name=platform_name),
-        )
 
-
-def _store_user_activity_metric(user_app, watch_connection):
-    UserActivityMetric.objects.create(
-        app=user_app,
-        connection=watch_connection,
-    )
+def _get_max_request_bytes(user_app):
+    return user_app.webhook_max_request_bytes or settings.WEBHOOK_MAX_REQUEST_BYTES
 
 
-def _store_metrics(watch_connection, app, chunk, platform_name):
+def _split_data_into_chunks(fitness_data, max_bytes):
     """
-    Stores the metrics for the data that was successfully sent to the webhook
+    Packs the samples of all the data types in chunks, every chunk is sent as
+    a single request. A chunk holds at most `MAX_CHUNK_SAMPLES` samples and
+    its json body stays under `max_bytes`, unless it is a single sample which
+    is bigger than that on its own.
     """
-    _store_data_sync_metric(app, chunk, platform_name)
-    _store_user_activity_metric(app, watch_connection)
-
-
-def _split_data_into_chunks(fitness_data):
-    chunk_size = 500
     data_chunks = []
+    chunk, size, count = {}, CHUNK_OVERHEAD_BYTES, 0
     for data_type, data in fitness_data.items():
-        for i in range(0, len(data), chunk_size):
-            data_chunks.append({data_type: data[i : i + chunk_size]})
-    return data_chunks
-
+        # `"data_type": [], ` around the samples of every data type
+        type_size = len(json.dumps(data_type)) + 6
+        for sample in data:
+            # every sample is followed by `, `
+            sample_size = len(json.dumps(sample)) + 2
+            added_size = sample_size if data_type in chunk else sample_size + type_size
+            if count and (size + added_size > max_bytes or count >= MAX_CHUNK_SAMPLES):
+                data_chunks.append(chunk)
+                chunk, size, count = {}, CHUNK_OVERHEAD_BYTES, 0
+                added_size = sample_size + type_size
+            chunk.setdefault(data_type, []).append(sample)
+            size += added_size
+            count += 1
 
-def _disable_webhook_for_app(user_app):
-    send_email_on_webhook_disabled(user_app.id, user_app.webhook_url)
-    user_app.webhook_url = None
-    user_app.save()
-
-
-def _update_failure_count_for_webhook(user_app, success):
-    """
-    Updates a global redis cache with lock to keep track of the number of times
-    a webhook has failed. If the number of failures exceeds a threshold, we
-    disable the webhook for the app.
-    """
-    # Only update the count 30% of the time in case of failure and 10% of the
-    # time in case of success
-    # This is done to reduce the number of times we update the cache, reducing load on redis
-    if random.random() < 0.3 and not success:
-        return
-    if random.random() < 0.1 and success:
-        return
-    with cache.lock(f"webhook_failure_lock_{user_app.id}", timeout=10):
-        if success:
-            cache.set(f"webhook_failure_count_{user_app.id}", 0)
-        else:
-            count = cache.get(f"webhook_failure_count_{user_app.id}", 0)
-            if count == FAILURE_THRESHOLD:
-                _disable_webhook_for_app(user_app)
-                # Reset the count since we disabled the webhook
-                cache.set(f"webhook_failure_count_{user_app.id}", 0)
-            else:
-                cache.set(f"webhook_failure_count_{user_app.id}", count + 1)
+    if count:
+        data_chunks.append(chunk)
+    return data_chunks
 
 
 def _save_unprocessed_data(connection, fitness_data, platform_name):
@@ -114,27 +104,179 @@ def _save_unprocessed_data(connection, fitness_data, platform_name):
     )
 
 
-def _post_chunk(webhook_url, chunk, user_uuid, key):
+# where and how the chunks of an app are sent, see `_get_webhook`
+Webhook = collections.namedtuple("Webhook", ["url", "key", "compression"])
+
+
+def _get_webhook(user_app):
+    return Webhook(
+        url=user_app.webhook_url,
+        key=user_app.key,
+        compression=user_app.webhook_compression,
+    )
+
+
+def _send_chunk(app_id, webhook, chunk, user_uuid):
     try:
-        body = json.dumps({"data": chunk, "uuid": user_uuid})
-        signature = get_webhook_signature(body, key)
-        response = requests.post(
-            webhook_url,
-            headers={
-                "Content-Type": "application/json",
-                "X-Heka-Signature": signature,
-            },
+        body = json.dumps({"data": chunk, "uuid": user_uuid}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if webhook.compression in ENCODINGS:
+            body = compress(body, webhook.compression)
+            headers["Content-Encoding"] = webhook.compression
+        # the signature is computed over the exact bytes we send, so that it
+        # can be verified before decompressing the body
+        headers["X-Heka-Signature"] = get_webhook_signature(body, webhook.key)
+        response = get_session(webhook.url).post(
+            webhook.url,
+            headers=headers,
             data=body,
             timeout=10,
         )
+        if response.status_code == 429:
+            # the webhook is up but we are sending too fast, pause the calls
+            # to the app for as long as it asks for
+            retry_after = get_retry_after(response)
+            logger.info(f"[webhook throttled] app {app_id}, retry after {retry_after}s")
+            set_webhook_retry_after(app_id, retry_after)
+            return THROTTLED
         if response.status_code > 202 or response.status_code < 200:
             logger.warning("[webhook fail] status code: %s" % response.status_code)
-            return False
+            return FAILED
     except Exception as e:
         logger.warning("[webhook fail] error: %s" % e)
-        return False
+        return FAILED
+
+    return DELIVERED
+
+
+def _post_chunk(app_id, webhook, chunk, user_uuid):
+    """
+    Posts a chunk to the webhook unless its circuit is open, returns
+    DELIVERED, FAILED, THROTTLED or BLOCKED
+    """
+    allowed, probe = allow_webhook_call(app_id)
+    if not allowed:
+        return BLOCKED
+
+    result = _send_chunk(app_id, webhook, chunk, user_uuid)
+    # a throttled webhook is up, it doesn't count as a failure
+    if record_webhook_result(app_id, result != FAILED, probe):
+        send_email_on_webhook_paused.delay(app_id, webhook.url)
+    return result
+
+
+def _apply_delivery_results(
+    chunks, results, user_app, platform, watch_connection, on_complete=None
+):
+    """
+    Stores the metrics for the chunks that were delivered, and saves the
+    failed chunks along with the ones that were not sent for later.
 
-    return True
+    :param results: list of results of the chunks that were posted, in order.
+        Chunks after the last result were not sent.
+    :param on_complete: optional callable, called with the list of chunks that
+        were not delivered and whether any chunk was attempted, ie. not
+        throttled or blocked. The chunks are not saved as unprocessed data
+        when it is given.
+    """
+    unsent = []
+    for chunk, result in zip(chunks, results):
+        if result == DELIVERED:
+            record_delivery_metrics(user_app.id, watch_connection.id, platform, chunk)
+            if user_app.debug_store_webhook_logs:
+                store_webhook_log.delay(user_app.id, watch_connection.user_uuid, chunk)
+        else:
+            unsent.append(chunk)
+    unsent.extend(chunks[len(results) :])
+
+    if on_complete is not None:
+        on_complete(
+            unsent,
+            any(result not in (THROTTLED, BLOCKED) for result in results),
+        )
+    else:
+        for chunk in unsent:
+            _save_unprocessed_data(watch_connection, chunk, platform)
+
+    return not unsent
+
+
+class _ConcurrentDelivery:
+    """
+    Collects the deliveries made within `concurrent_webhook_delivery` and
+    sends them through a WebhookFanout. Results are applied in the thread
+    which made the deliveries since they write to the database.
+    """
+
+    def __init__(self):
+        self.fanout = WebhookFanout(
+            _post_chunk,
+            max_concurrency=settings.WEBHOOK_MAX_CONCURRENCY,
+            max_concurrency_per_app=settings.WEBHOOK_MAX_CONCURRENCY_PER_APP,
+            max_pending=settings.WEBHOOK_MAX_PENDING_DELIVERIES,
+            max_throttle_wait=settings.WEBHOOK_RATE_LIMIT_MAX_WAIT,
+        )
+        self.pending = []
+
+    def submit(self, chunks, user_app, platform, watch_connection, on_complete):
+        future = self.fanout.submit(
+            (watch_connection.id, platform),
+            user_app.id,
+            _get_webhook(user_app),
+            watch_connection.user_uuid,
+            chunks,
+            throttle=functools.partial(
+                get_webhook_token_wait, user_app.id, get_webhook_rate_limit(user_app)
+            ),
+        )
+        self.pending.append(
+            (future, (chunks, user_app, platform, watch_connection, on_complete))
+        )
+        self.apply_results(wait=False)
+
+    def apply_results(self, wait):
+        still_pending = []
+        for future, delivery in self.pending:
+            if not wait and not future.done():
+                still_pending.append((future, delivery))
+                continue
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f"[webhook fail] delivery error: {e}", exc_info=True)
+                results = []
+            chunks, user_app, platform, watch_connection, on_complete = delivery
+            _apply_delivery_results(
+                chunks, results, user_app, platform, watch_connection, on_complete
+            )
+        self.pending = still_pending
+
+
+@contextlib.contextmanager
+def concurrent_webhook_delivery():
+    """
+    Webhook deliveries made within this context are sent concurrently instead
+    of one after the other, `send_data_to_webhook` returns once the data is
+    queued. All deliveries are complete when the context exits.
+
+    Concurrency is capped globally and per app, and the chunks of a user are
+    still sent in order, later chunks are not sent once one of them fails.
+    Nested contexts share the outermost delivery.
+    """
+    if getattr(_local, "delivery", None) is not None:
+        yield
+        return
+
+    delivery = _ConcurrentDelivery()
+    _local.delivery = delivery
+    try:
+        yield
+    finally:
+        _local.delivery = None
+        try:
+            delivery.apply_results(wait=True)
+        finally:
+            delivery.fanout.close()
 
 
 def send_data_to_webhook(
@@ -142,35 +284,50 @@ def send_data_to_webhook(
     user_app,
     platform,
     watch_connection,
+    on_complete=None,
 ):
+    """
+    Sends the data to the webhook of the app in chunks. Chunks which could not
+    be delivered are saved as unprocessed data, unless `on_complete` is given
+    (see `_apply_delivery_results`).
+    """
     user_uuid = watch_connection.user_uuid
     webhook_url = user_app.webhook_url
     # TODO: we can add a check here to see if the webhook url is valid
     if not webhook_url:
         logger.info(f"Webhook url not set for {user_app} storing offline")
-        _save_unprocessed_data(watch_connection, fitness_data, platform)
+        if on_complete is not None:
+            on_complete([fitness_data], False)
+        else:
+            _save_unprocessed_data(watch_connection, fitness_data, platform)
         return False
-    chunks = _split_data_into_chunks(fitness_data)
+    chunks = _split_data_into_chunks(fitness_data, _get_max_request_bytes(user_app))
     logger.info(f"got {len(chunks)} chunks for {user_uuid}, app {user_app}, {platform}")
-    request_succeeded = True
-    skip_sending_due_to_error = False
+
+    delivery = getattr(_local, "delivery", None)
+    if delivery is not None:
+        delivery.submit(chunks, user_app, platform, watch_connection, on_complete)
+        return True
+
+    webhook = _get_webhook(user_app)
+    rate = get_webhook_rate_limit(user_app)
+    results = []
     for chunk in chunks:
-        if skip_sending_due_to_error:
-            _save_unprocessed_data(watch_connection, chunk, platform)
-        else:
-            request_succeeded = _post_chunk(webhook_url, chunk, user_uuid, user_app.key)
-            _update_failure_count_for_webhook(user_app, request_succeeded)
-
-            if request_succeeded:
-                _store_metrics(watch_connection, user_app, chunk, platform)
-                if user_app.debug_store_webhook_logs:
-                    store_webhook_log.delay(user_app.id, user_uuid, chunk)
-            else:
-                _save_unprocessed_data(watch_connection, chunk, platform)
-                # dont send future chunks if this one failed
-                skip_sending_due_to_error = True
-
-    return request_succeeded
+        result = THROTTLED
+        for _ in range(MAX_THROTTLED_RETRIES + 1):
+            if not wait_for_webhook_token(user_app.id, rate):
+                break
+            result = _post_chunk(user_app.id, webhook, chunk, user_uuid)
+            if result != THROTTLED:
+                break
+        results.append(result)
+        if result != DELIVERED:
+            # dont send future chunks if this one failed
+            break
+
+    return _apply_delivery_results(
+        chunks, results, user_app, platform, watch_connection, on_complete
+    )
 
 
 @shared_task
@@ -0,0 +1,152 @@
+# Concurrent delivery of webhook chunks.
+#
+# An asyncio event loop runs in a background thread and posts the chunks of many
+# deliveries at once, the blocking http calls are run in a thread pool so that
+# they can use the pooled keep-alive sessions. Concurrency is capped globally
+# and per app, and the chunks of a user are always sent in order: once a chunk
+# fails, the later chunks of that user are not sent.
+#
+# Deliveries can be throttled, in which case the loop waits for the throttle
+# without holding a concurrency slot, so other apps are not slowed down.
+
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# results of posting a chunk
+DELIVERED = "delivered"
+FAILED = "failed"
+# the webhook asked us to slow down, or we could not get a rate limit token
+# in time, the chunk was not delivered
+THROTTLED = "throttled"
+# the circuit of the webhook is open, the chunk was not sent
+BLOCKED = "blocked"
+
+# number of times a chunk is posted again after the webhook responded with 429
+MAX_THROTTLED_RETRIES = 3
+
+
+class WebhookFanout:
+    """
+    Posts the chunks of submitted deliveries concurrently. Every delivery is a
+    list of chunks for a single user, deliveries with the same key are sent one
+    after the other in the order they were submitted.
+
+    :param post: callable taking (app_id, webhook, chunk, user_uuid) and
+        returning DELIVERED, FAILED, THROTTLED or BLOCKED, where `webhook` is
+        passed as is from `submit`
+    :param max_concurrency: max number of chunks being posted at once
+    :param max_concurrency_per_app: max number of chunks being posted at once
+        to the webhook of an app
+    :param max_pending: max number of deliveries in flight, `submit` blocks
+        once it is reached
+    :param max_throttle_wait: max number of seconds to wait for the throttle
+        of a delivery before giving up on a chunk
+    """
+
+    def __init__(
+        self,
+        post,
+        max_concurrency,
+        max_concurrency_per_app,
+        max_pending,
+        max_throttle_wait,
+    ):
+        self._post = post
+        self._max_throttle_wait = max_throttle_wait
+        self._max_concurrency_per_app = max_concurrency_per_app
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="webhook"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        # asyncio primitives have to be created on the loop they are used in
+        asyncio.run_coroutine_threadsafe(
+            self._setup(max_concurrency), self._loop
+        ).result()
+
+    async def _setup(self, max_concurrency):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._app_semaphores = collections.defaultdict(
+            lambda: asyncio.Semaphore(self._max_concurrency_per_app)
+        )
+        self._key_locks = collections.defaultdict(asyncio.Lock)
+        self._failed_keys = set()
+
+    def submit(self, key, app_id, webhook, user_uuid, chunks, throttle=None):
+        """
+        Schedules the chunks for delivery. Returns a concurrent future which
+        resolves to the list of results of the chunks that were posted, in
+        order. Chunks after the last result were not sent.
+
+        :param throttle: optional callable which is called before posting a
+            chunk, returns 0 when the chunk can be posted or the number of
+            seconds to wait before calling it again
+        """
+        self._slots.acquire()
+        future = asyncio.run_coroutine_threadsafe(
+            self._deliver(key, app_id, webhook, user_uuid, chunks, throttle),
+            self._loop,
+        )
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    async def _wait_for_throttle(self, throttle):
+        """
+        Returns False if the throttle asks to wait for longer than the max
+        throttle wait
+        """
+        if throttle is None:
+            return True
+        loop = asyncio.get_running_loop()
+        waited = 0
+        while True:
+            wait = await loop.run_in_executor(self._executor, throttle)
+            if wait <= 0:
+                return True
+            if waited + wait > self._max_throttle_wait:
+                return False
+            await asyncio.sleep(wait)
+            waited += wait
+
+    async def _deliver(self, key, app_id, webhook, user_uuid, chunks, throttle):
+        loop = asyncio.get_running_loop()
+        results = []
+        # the lock is fair, so deliveries of a key are sent in submission order
+        async with self._key_locks[key]:
+            for chunk in chunks:
+                if key in self._failed_keys:
+                    break
+                result = THROTTLED
+                for _ in range(MAX_THROTTLED_RETRIES + 1):
+                    if not await self._wait_for_throttle(throttle):
+                        break
+                    async with self._app_semaphores[app_id], self._semaphore:
+                        result = await loop.run_in_executor(
+                            self._executor,
+                            self._post,
+                            app_id,
+                            webhook,
+                            chunk,
+                            user_uuid,
+                        )
+                    if result != THROTTLED:
+                        break
+                results.append(result)
+                if result != DELIVERED:
+                    # dont send future chunks of the user if this one failed
+                    self._failed_keys.add(key)
+
+        return results
+
+    def close(self):
+        """
+        Stops the event loop, deliveries should be waited for before closing
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown(wait=True)
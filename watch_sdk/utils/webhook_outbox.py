@@ -0,0 +1,242 @@
+# Outbox of data waiting to be delivered to the webhooks of apps.
+#
+# Data is added to the outbox in the same transaction as it is stored, and is
+# drained by dedicated delivery workers consuming the `webhook_delivery` queue.
+# Provider syncs hence never wait on customer endpoints, and delivery can be
+# scaled and paused on its own.
+#
+# The outbox is split in partitions by connection id, a partition is drained by
+# a single task at a time so that the data of a user is delivered in order.
+# Entries are also claimed while they are delivered, so that a drain started
+# after the lock of a slow one expired doesn't deliver them twice.
+#
+# While the webhook circuit of an app is open its data stays in the outbox, and
+# is delivered once the circuit closes.
+
+import datetime
+import functools
+import logging
+import time
+
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min, Q, Value
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from watch_sdk.models import Platform, UnprocessedData, WebhookOutbox
+from watch_sdk.utils.circuit_breaker import is_webhook_circuit_open
+from watch_sdk.utils.webhook import concurrent_webhook_delivery, send_data_to_webhook
+
+logger = logging.getLogger(__name__)
+
+DRAIN_BATCH_SIZE = 100
+# a drain task gives up its partition after this many seconds and queues
+# itself again, so that a large backlog doesn't hold a worker forever
+DRAIN_TIME_LIMIT = 60 * 5
+# entries claimed by a drain are not read by other drains for this long. Their
+# delivery can wait for the deliveries queued before them and be throttled and
+# retried, so this is well above the time limit.
+CLAIM_TIMEOUT = datetime.timedelta(minutes=30)
+PAUSED_CACHE_KEY = "webhook_delivery_paused"
+
+
+def _get_partition(connection_id):
+    return connection_id % settings.WEBHOOK_OUTBOX_PARTITIONS
+
+
+def _kick_partition(partition):
+    # a single drain task is queued at a time for a partition, the flag is
+    # cleared by the task as soon as it starts
+    try:
+        if cache.add(f"webhook_outbox_kicked_{partition}", 1, timeout=60):
+            drain_webhook_outbox.delay(partition)
+    except Exception as e:
+        # the cron picks up the partition in that case
+        logger.warning(f"unable to queue webhook outbox drain for {partition}: {e}")
+
+
+def enqueue_webhook_delivery(fitness_data, platform_name, watch_connection):
+    """
+    Adds the data to the outbox, it is delivered to the webhook of the app
+    once the current transaction commits
+
+    :param fitness_data: dict
+    :param platform_name: str
+    :param watch_connection: WatchConnection
+    """
+    WebhookOutbox.objects.create(
+        data=fitness_data,
+        connection=watch_connection,
+        platform=Platform.objects.get(name=platform_name),
+    )
+    partition = _get_partition(watch_connection.id)
+    transaction.on_commit(lambda: _kick_partition(partition))
+
+
+def pause_webhook_delivery():
+    """
+    Stops delivering the outbox, data keeps being added to it meanwhile
+    """
+    cache.set(PAUSED_CACHE_KEY, True, timeout=None)
+
+
+def resume_webhook_delivery():
+    cache.delete(PAUSED_CACHE_KEY)
+    for partition in range(settings.WEBHOOK_OUTBOX_PARTITIONS):
+        _kick_partition(partition)
+
+
+def is_webhook_delivery_paused():
+    return bool(cache.get(PAUSED_CACHE_KEY))
+
+
+def _save_unprocessed_data(entry, chunks):
+    with transaction.atomic():
+        for chunk in chunks:
+            UnprocessedData.objects.create(
+                data=chunk, connection=entry.connection, platform=entry.platform
+            )
+        entry.delete()
+
+
+def _claim_entries(partition, last_id):
+    """
+    Returns the next entries of the partition after `last_id` which are not
+    claimed by another drain, and claims them
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            WebhookOutbox.objects.annotate(
+                partition=Mod(
+                    "connection_id", Value(settings.WEBHOOK_OUTBOX_PARTITIONS)
+                )
+            )
+            .filter(partition=partition, id__gt=last_id)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+            .select_related("connection__app", "platform")
+            .select_for_update(skip_locked=True, of=("self",))
+            .order_by("id")[:DRAIN_BATCH_SIZE]
+        )
+        WebhookOutbox.objects.filter(id__in=[entry.id for entry in entries]).update(
+            claimed_until=now + CLAIM_TIMEOUT
+        )
+    return entries
+
+
+def _release_entries(entries):
+    WebhookOutbox.objects.filter(id__in=[entry.id for entry in entries]).update(
+        claimed_until=None
+    )
+
+
+def _drain_partition(partition):
+    """
+    Delivers the outbox entries of the partition in order until all of them
+    were gone through or the time limit is reached. Returns the number of
+    entries delivered and whether entries may be left.
+
+    Entries of apps whose webhook circuit is open, or which could not be sent
+    at all, are kept in the outbox for the next drain. Data which failed to
+    be delivered is moved to the unprocessed data to be retried.
+    """
+    started = time.monotonic()
+    delivered = 0
+    has_more = True
+    last_id = 0
+
+    def _on_complete(entry, unsent, attempted):
+        nonlocal delivered
+        if unsent and not attempted:
+            _release_entries([entry])
+            return
+        if unsent:
+            _save_unprocessed_data(entry, unsent)
+        else:
+            entry.delete()
+        delivered += 1
+
+    with concurrent_webhook_delivery():
+        while time.monotonic() - started < DRAIN_TIME_LIMIT:
+            if is_webhook_delivery_paused():
+                has_more = False
+                break
+
+            entries = _claim_entries(partition, last_id)
+            if not entries:
+                has_more = False
+                break
+            last_id = entries[-1].id
+
+            open_circuits = {}
+            blocked = []
+            for entry in entries:
+                app = entry.connection.app
+                if not app.webhook_url:
+                    logger.info(f"Webhook url not set for {app} storing offline")
+                    _save_unprocessed_data(entry, [entry.data])
+                    continue
+                if app.id not in open_circuits:
+                    open_circuits[app.id] = is_webhook_circuit_open(app.id)
+                if open_circuits[app.id]:
+                    blocked.append(entry)
+                    continue
+                send_data_to_webhook(
+                    entry.data,
+                    app,
+                    entry.platform.name,
+                    entry.connection,
+                    on_complete=functools.partial(_on_complete, entry),
+                )
+            _release_entries(blocked)
+
+    # entries are removed as their deliveries complete, which they all are
+    # once the context exits
+    return delivered, has_more
+
+
+@shared_task
+def drain_webhook_outbox(partition):
+    cache.delete(f"webhook_outbox_kicked_{partition}")
+    if is_webhook_delivery_paused():
+        logger.info(f"webhook delivery is paused, skipping partition {partition}")
+        return
+
+    lock_id = f"webhook_outbox_drain_{partition}"
+    lock = cache.lock(lock_id, timeout=DRAIN_TIME_LIMIT + 60)
+    if not lock.acquire(blocking=False):
+        return
+    started = time.monotonic()
+    try:
+        delivered, has_more = _drain_partition(partition)
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            logger.info(f"error while releasing lock for {lock_id}: {e}")
+
+    if delivered:
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"delivered {delivered} webhook outbox entries from partition {partition} in {elapsed:.1f}s"
+        )
+    if has_more:
+        _kick_partition(partition)
+
+
+@shared_task
+def drain_webhook_outbox_cron():
+    backlog = WebhookOutbox.objects.aggregate(oldest=Min("created_at"))
+    if backlog["oldest"]:
+        logger.info(
+            f"[CRON] webhook outbox backlog: {WebhookOutbox.objects.count()} entries, oldest from {(timezone.now() - backlog['oldest']).total_seconds():.0f}s ago"
+        )
+    if is_webhook_delivery_paused():
+        logger.info("[CRON] webhook delivery is paused")
+        return
+
+    for partition in range(settings.WEBHOOK_OUTBOX_PARTITIONS):
+        _kick_partition(partition)
@@ -1,51 +1,84 @@
-import collections
-from datetime import datetime
+import hashlib
 import json
 import logging
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import transaction
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from watch_sdk.models import (
     ConnectedPlatformMetadata,
     DebugIosData,
     EnabledPlatform,
-    IOSDataHashLog,
-    Platform,
-    UnprocessedData,
+    HealthkitUploadJob,
+    HealthkitUploadPart,
+    HealthkitUploadSession,
     UserApp,
     WatchConnection,
 )
 
 from watch_sdk.permissions import ValidKeyPermission
-from watch_sdk.constants import apple_healthkit
-from watch_sdk.utils.data_process import process_health_data
-from watch_sdk.utils.hash_utils import get_hash
+from watch_sdk.serializers import (
+    HealthkitUploadJobSerializer,
+    HealthkitUploadSessionSerializer,
+)
+from watch_sdk.utils.apple_healthkit import (
+    MAX_UPLOAD_BATCH_SIZE,
+    forget_upload_hash,
+    get_enabled_data_types,
+    get_sync_anchors,
+    is_columnar_upload,
+    process_healthkit_upload,
+    process_healthkit_upload_job,
+    record_upload_hash,
+    store_upload_for_processing,
+)
+from watch_sdk.utils.compression import open_decompressed
+from watch_sdk.utils.hash_utils import HashingUploadHandler
 
 
 logger = logging.getLogger(__name__)
 
-SYNC_SLEEP_TYPES = set(["awake", "light", "deep", "rem", "unspecified"])
+UPLOAD_READ_CHUNK_SIZE = 64 * 2**10
 
 
-def _get_sleep_type(d):
-    if d["value"] == 0:
-        return "in_bed"
-    if d["value"] == 1:
-        return "asleep"
-    if d["value"] == 2:
-        return "awake"
-    if d["value"] == 3:
-        return "light"
-    if d["value"] == 4:
-        return "deep"
-    if d["value"] == 5:
-        return "rem"
+def _get_upload_file(request):
+    """
+    Returns the uploaded data as a file along with the hash of its raw bytes.
+    The data can either be sent as the `data` file of a multipart request or
+    as the raw request body, in which case the body is spooled to a temporary
+    file. The hash is computed while the bytes are read from the request.
 
-    return "unspecified"
+    Uploads compressed with gzip or zstd are returned as is and decompressed
+    while they are parsed.
+    """
+    if request.content_type.startswith("multipart/form-data"):
+        hashing_handler = HashingUploadHandler(request)
+        request.upload_handlers.insert(0, hashing_handler)
+        data_file = request.FILES.get("data")
+        return data_file, hashing_handler.hashes.get("data")
 
+    stream = request.stream
+    if stream is None:
+        return None, None
+    sha = hashlib.sha256()
+    data_file = TemporaryUploadedFile("data", request.content_type, 0, None)
+    while True:
+        chunk = stream.read(UPLOAD_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        sha.update(chunk)
+        data_file.write(chunk)
+    data_file.size = data_file.tell()
+    data_file.seek(0)
+    return data_file, sha.hexdigest()
 
-@api_view(["POST"])
-@permission_classes([ValidKeyPermission])
-def upload_health_data_using_json_file(request):
+
+def _get_connected_metadata(request):
+    """
+    Validates that the user of the request is connected to apple healthkit and
+    returns a tuple of (ConnectedPlatformMetadata, error response)
+    """
     key = (
         request.query_params.get("key")
         if request.query_params.get("key")
@@ -55,14 +88,12 @@ def upload_health_data_using_json_file(request):
     app = UserApp.objects.get(key=key)
 
     try:
-        enabled_platform = EnabledPlatform.objects.get(
-            user_app=app, platform__name="apple_healthkit"
-        )
+        EnabledPlatform.objects.get(user_app=app, platform__name="apple_healthkit")
     except:
         logger.warn(
             f"getting apple healthkit data for app {app} which is not enabled and user {user_uuid}"
         )
-        return Response(
+        return None, Response(
             {"error": "Apple healthkit not enabled for this app"}, status=400
         )
 
@@ -72,7 +103,9 @@ def upload_health_data_using_json_file(request):
         logger.warn(
             f"getting apple healthkit data for user {user_uuid} which is not connected to app {app}"
         )
-        return Response({"error": "No connection exists for this user"}, status=400)
+        return None, Response(
+            {"error": "No connection exists for this user"}, status=400
+        )
 
     try:
         connected_metadata = ConnectedPlatformMetadata.objects.get(
@@ -82,100 +115,272 @@ def upload_health_data_using_json_file(request):
         logger.warn(
             f"getting apple healthkit data for user {user_uuid} which is not connected to app {app}"
         )
-        return Response({"error": "No connection exists for this user"}, status=400)
+        return None, Response(
+            {"error": "No connection exists for this user"}, status=400
+        )
 
     if connected_metadata.logged_in is False:
         # we don't process data for a disconnected user
-        return Response({"error": "User not connected"}, status=400)
+        return None, Response({"error": "User not connected"}, status=400)
+
+    return connected_metadata, None
+
+
+@api_view(["POST"])
+@permission_classes([ValidKeyPermission])
+def upload_health_data_using_json_file(request):
+    connected_metadata, error_response = _get_connected_metadata(request)
+    if error_response:
+        return error_response
+    connection = connected_metadata.connection
+    app = connection.app
+    user_uuid = connection.user_uuid
 
     logger.info(f"Apple data received for {user_uuid} of {app}")
-    fitness_data = collections.defaultdict(list)
-    if "data" not in request.FILES:
+    data_file, hash = _get_upload_file(request)
+    if data_file is None:
         logger.error(
             f"No data file found for {user_uuid} and app {app} on upload for apple healthkit"
         )
         return Response({"error": "No data file found"}, status=400)
-    # read over a json file passed with the request and build fitness_data
-    data = request.FILES["data"].read()
-    data = json.loads(data)
-    if app.id == 40 or app.id == 101:
+    # reject duplicate uploads before doing any parsing
+    if not record_upload_hash(connection, hash):
+        logger.warn("Already processed this data")
+        return Response({"success": True}, status=200)
+
+    if (app.id == 40 or app.id == 101) and not is_columnar_upload(data_file):
         DebugIosData.objects.create(
             uuid=user_uuid,
-            data=data,
+            data=json.load(open_decompressed(data_file)),
         )
-    hash = get_hash(data)
-    if IOSDataHashLog.objects.filter(hash=hash, connection=connection).exists():
-        logger.warn("Already processed this data")
-        return Response({"success": True}, status=200)
-    else:
-        IOSDataHashLog.objects.create(hash=hash, connection=connection)
-    total = 0
-    enabled_datatypes = app.enabled_data_types.all()
-    max_last_sync = 0
-    for enabled in enabled_datatypes:
-        data_type = apple_healthkit.DB_DATA_TYPE_KEY_MAP.get(enabled.name)
-        if data_type is None:
-            # skip this data type as it's not supported on apple
-            continue
-        key, dclass = apple_healthkit.DATATYPE_NAME_CLASS_MAP.get(
-            data_type, (None, None)
+        data_file.seek(0)
+
+    # in async mode we only store the upload here and process it in a celery
+    # task, so that slow webhooks don't keep the client waiting
+    if request.query_params.get("async") == "true":
+        job = store_upload_for_processing(data_file, connection, hash)
+        process_healthkit_upload_job.delay(job.id)
+        return Response({"success": True, "job_id": str(job.uuid)}, status=202)
+
+    data_file.seek(0)
+    try:
+        process_healthkit_upload(data_file, app, connection, connected_metadata)
+    except ValidationError as e:
+        # a malformed upload is rejected before any of it is processed
+        forget_upload_hash(connection, hash)
+        return Response({"error": " ".join(e.messages)}, status=400)
+    except Exception:
+        # the client retries the upload, it must not be taken for a duplicate
+        forget_upload_hash(connection, hash)
+        raise
+    return Response({"success": True}, status=200)
+
+
+@api_view(["GET"])
+@permission_classes([ValidKeyPermission])
+def healthkit_upload_job_status(request):
+    """
+    Returns the status of an apple healthkit upload submitted in async mode
+
+    Request params:
+      - job_id: the job id returned by the upload api
+    """
+    key = (
+        request.query_params.get("key")
+        if request.query_params.get("key")
+        else request.META.get("HTTP_KEY")
+    )
+    job_id = request.query_params.get("job_id")
+    if not job_id:
+        return Response({"error": "job_id is required"}, status=400)
+
+    try:
+        job = HealthkitUploadJob.objects.get(uuid=job_id, connection__app__key=key)
+    except (HealthkitUploadJob.DoesNotExist, ValidationError):
+        return Response({"error": "Invalid job id"}, status=400)
+
+    return Response(
+        {"success": True, "data": HealthkitUploadJobSerializer(job).data}, status=200
+    )
+
+
+@api_view(["GET"])
+@permission_classes([ValidKeyPermission])
+def healthkit_upload_manifest(request):
+    """
+    Returns what the SDK should upload for a user from apple healthkit
+
+    Request params:
+      - user_uuid: the uuid of the user
+
+    Response:
+
+    {
+        "success": true,
+        "data": {
+            # apple data types enabled for the app
+            "data_types": ["steps", "heart_rate"],
+            # end time (in milliseconds since epoch) of the latest sample
+            # uploaded for each data type, only newer samples should be sent
+            "anchors": {"steps": 1696703400000, "heart_rate": null},
+            "sync_manual_entries": false,
+            # maximum number of samples to send in a single upload
+            "max_batch_size": 50000
+        }
+    }
+    """
+    key = (
+        request.query_params.get("key")
+        if request.query_params.get("key")
+        else request.META.get("HTTP_KEY")
+    )
+    user_uuid = request.query_params.get("user_uuid")
+    app = UserApp.objects.get(key=key)
+
+    try:
+        enabled_platform = EnabledPlatform.objects.get(
+            user_app=app, platform__name="apple_healthkit"
+        )
+    except EnabledPlatform.DoesNotExist:
+        return Response(
+            {"error": "Apple healthkit not enabled for this app"}, status=400
+        )
+
+    connected_metadata = ConnectedPlatformMetadata.objects.filter(
+        connection__app=app,
+        connection__user_uuid=user_uuid,
+        platform__name="apple_healthkit",
+    ).first()
+    anchors = get_sync_anchors(connected_metadata)
+    data_types = list(get_enabled_data_types(app).keys())
+
+    return Response(
+        {
+            "success": True,
+            "data": {
+                "data_types": data_types,
+                "anchors": {
+                    data_type: anchors.get(data_type) for data_type in data_types
+                },
+                "sync_manual_entries": enabled_platform.sync_manual_entries,
+                "max_batch_size": MAX_UPLOAD_BATCH_SIZE,
+            },
+        },
+        status=200,
+    )
+
+
+@api_view(["POST"])
+@permission_classes([ValidKeyPermission])
+def create_healthkit_upload_session(request):
+    """
+    Starts a resumable apple healthkit upload. The client splits the data into
+    numbered parts, each part being a complete upload (json or columnar) on
+    its own, and uploads them to `healthkit_upload_session/<session_id>/part/<n>`.
+    Parts are processed as they arrive, and on a retry only the parts missing
+    from the session status have to be sent again.
+
+    Request body:
+      - total_parts: (optional) the number of parts the upload is split into
+    """
+    connected_metadata, error_response = _get_connected_metadata(request)
+    if error_response:
+        return error_response
+
+    total_parts = request.data.get("total_parts")
+    if total_parts is not None and (
+        not isinstance(total_parts, int) or total_parts <= 0
+    ):
+        return Response({"error": "Invalid total_parts"}, status=400)
+
+    session = HealthkitUploadSession.objects.create(
+        connection=connected_metadata.connection,
+        total_parts=total_parts,
+    )
+    return Response(
+        {"success": True, "data": HealthkitUploadSessionSerializer(session).data},
+        status=200,
+    )
+
+
+@api_view(["POST"])
+@permission_classes([ValidKeyPermission])
+def upload_healthkit_session_part(request, session_id, part_number):
+    """
+    Uploads a part of a resumable apple healthkit upload, the part is sent the
+    same way as for `upload_health_data_as_json`. Parts which were already
+    received are acknowledged without being processed again, unless their
+    processing failed.
+    """
+    connected_metadata, error_response = _get_connected_metadata(request)
+    if error_response:
+        return error_response
+    connection = connected_metadata.connection
+
+    try:
+        session = HealthkitUploadSession.objects.get(
+            uuid=session_id, connection=connection
         )
-        if not key or not dclass:
-            continue
-        for d in data.get(data_type, []):
-            total += 1
-            start_time = d["date_from"]
-            end_time = d["date_to"]
-            manual_entry = (
-                d.get("source_name") == "Health"
-                or d.get("source_id") == "com.apple.Health"
-            )
-            if manual_entry and not enabled_platform.sync_manual_entries:
-                continue
-            if data_type == "sleep_analysis":
-                value = d["date_to"] - d["date_from"]
-                sleep_type = _get_sleep_type(d)
-                if sleep_type not in SYNC_SLEEP_TYPES:
-                    continue
-                fitness_data[key].append(
-                    dclass(
-                        value=value,
-                        start_time=start_time,
-                        end_time=end_time,
-                        source="apple_healthkit",
-                        source_device=d.get("source_name"),
-                        manual_entry=manual_entry,
-                        sleep_type=sleep_type,
-                    ).to_dict()
-                )
-            else:
-                value = d["value"]
-                fitness_data[key].append(
-                    dclass(
-                        value=value,
-                        start_time=start_time,
-                        end_time=end_time,
-                        source="apple_healthkit",
-                        source_device=d.get("source_name"),
-                        manual_entry=manual_entry,
-                    ).to_dict()
-                )
-
-            max_last_sync = max(max_last_sync, end_time)
-
-    if fitness_data:
-        logger.info(
-            f"processing {len(fitness_data)} points from apple healthkit for {user_uuid}"
+    except HealthkitUploadSession.DoesNotExist:
+        return Response({"error": "Invalid session id"}, status=400)
+
+    if session.total_parts is not None and not (0 < part_number <= session.total_parts):
+        return Response({"error": "Invalid part number"}, status=400)
+
+    data_file, hash = _get_upload_file(request)
+    if data_file is None:
+        return Response({"error": "No data file found"}, status=400)
+
+    with transaction.atomic():
+        # the part is locked so that concurrent re-sends of a failed part
+        # don't both process it
+        part, created = (
+            HealthkitUploadPart.objects.select_for_update(of=("self",))
+            .select_related("job")
+            .get_or_create(session=session, number=part_number)
         )
-        process_health_data(
-            fitness_data,
-            connection,
-            app,
-            "apple_healthkit",
+        failed = not created and part.job is not None and part.job.status == "failed"
+        if failed:
+            # the failed job forgot the hash of the part, it is recorded again
+            # so that an identical upload isn't processed a second time
+            record_upload_hash(connection, hash)
+            queued = True
+        else:
+            # identical data could have been uploaded outside of the session
+            # too, in which case we acknowledge the part without processing it
+            queued = created and record_upload_hash(connection, hash)
+        if queued:
+            part.job = store_upload_for_processing(data_file, connection, hash)
+            part.save()
+            job_id = part.job.id
+            transaction.on_commit(lambda: process_healthkit_upload_job.delay(job_id))
+
+    return Response(
+        {"success": True, "data": HealthkitUploadSessionSerializer(session).data},
+        status=202 if created or queued else 200,
+    )
+
+
+@api_view(["GET"])
+@permission_classes([ValidKeyPermission])
+def healthkit_upload_session_status(request, session_id):
+    """
+    Returns the parts received for a resumable apple healthkit upload along
+    with the processing status of each part
+    """
+    key = (
+        request.query_params.get("key")
+        if request.query_params.get("key")
+        else request.META.get("HTTP_KEY")
+    )
+    try:
+        session = HealthkitUploadSession.objects.get(
+            uuid=session_id, connection__app__key=key
         )
+    except HealthkitUploadSession.DoesNotExist:
+        return Response({"error": "Invalid session id"}, status=400)
 
-    # update last sync time on server
-    # TODO: we should rather update data type wise last sync
-    connected_metadata.last_sync = datetime.fromtimestamp(max_last_sync / 1000)
-    connected_metadata.save()
-    return Response({"success": True}, status=200)
+    return Response(
+        {"success": True, "data": HealthkitUploadSessionSerializer(session).data},
+        status=200,
+    )
@@ -1,7 +1,6 @@
 # APIs to return health data stored on our servers
 
 import datetime
-from zoneinfo import ZoneInfo
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django.db.models import Sum
@@ -9,7 +8,9 @@ from watch_sdk.data_providers.google_fit import GoogleFitConnection
 
 from watch_sdk.models import (
     ConnectedPlatformMetadata,
+    DataType,
     HealthDataEntry,
+    Platform,
     UserApp,
     WatchConnection,
 )
@@ -30,6 +31,9 @@ def aggregated_data_for_timerange(request):
       - data_type: the name of data type (eg. steps, calories, etc.)
       - start_time: the start time of the range (in milliseconds since epoch)
       - end_time: the end time of the range (in milliseconds since epoch)
+
+    Returns a 400 error for an unknown platform or data type. The total used
+    to be null in that case.
     """
     key = request.META.get("HTTP_KEY")
     uuid = request.query_params.get("user_uuid")
@@ -77,17 +81,29 @@ def aggregated_data_for_timerange(request):
     except Exception:
         return Response({"error": "Invalid end time"}, status=400)
 
+    # resolved beforehand so that the query is answered by
+    # healthdataentry_lookup_idx without joins
+    try:
+        platform_id = Platform.objects.get(name=platform).id
+    except Platform.DoesNotExist:
+        return Response({"error": "Invalid platform"}, status=400)
+
+    try:
+        data_type_id = DataType.objects.get(name=data_type).id
+    except DataType.DoesNotExist:
+        return Response({"error": "Invalid data type"}, status=400)
+
     total = HealthDataEntry.objects.filter(
         user_connection=connection,
-        source_platform__name=platform,
-        data_type__name=data_type,
+        source_platform_id=platform_id,
+        data_type_id=data_type_id,
         start_time__gte=start_time,
+        # implied by the end time, but lets the partitions of the table which
+        # start after the range be skipped
+        start_time__lte=end_time,
         end_time__lte=end_time,
     ).aggregate(Sum("value"))
 
-    print_synced_uuids()
-    _show_date_wise_data(connection, platform, data_type)
-
     return Response({"total": total["value__sum"]})
 
 
@@ -245,41 +261,3 @@ def get_menstruation_data(request):
         return Response({"data": entries})
     else:
         return Response({"error": "Platform not supported"}, status=400)
-
-
-def _show_date_wise_data(connection, platform, data_type):
-    fr = datetime.datetime.now() - datetime.timedelta(days=4)
-    to = datetime.datetime.now()
-    data = {}
-
-    while fr <= to:
-        start = datetime.datetime(
-            fr.year, fr.month, fr.day, 0, 0, 0, tzinfo=ZoneInfo("Asia/Kolkata")
-        )
-        end = datetime.datetime(
-            fr.year, fr.month, fr.day, 23, 59, 59, tzinfo=ZoneInfo("Asia/Kolkata")
-        )
-        total = HealthDataEntry.objects.filter(
-            user_connection=connection,
-            source_platform__name=platform,
-            data_type__name=data_type,
-            start_time__gte=start,
-            end_time__lte=end,
-        ).aggregate(Sum("value"))
-        data[fr.isoformat()] = total["value__sum"]
-        fr += datetime.timedelta(days=1)
-
-    print(data)
-
-
-def print_synced_uuids():
-    # get the unique uuids which have a health data entry object stored
-    unique_uuids = (
-        HealthDataEntry.objects.all()
-        .values_list("user_connection", flat=True)
-        .distinct()
-    )
-
-    for u in unique_uuids:
-        wc = WatchConnection.objects.get(id=u)
-        print(wc.user_uuid, wc.app)
@@ -0,0 +1,83 @@
+# APIs to return the activity of the users of an app
+
+import datetime
+import logging
+
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from watch_sdk.models import UserApp
+from watch_sdk.permissions import ValidKeyPermission
+from watch_sdk.utils.metrics import MAX_ACTIVITY_RANGE_DAYS, get_active_users
+
+logger = logging.getLogger(__name__)
+
+
+@api_view(["GET"])
+@permission_classes([ValidKeyPermission])
+def active_users(request):
+    """
+    Returns the number of users of the app who received data over a time
+    range, along with the daily, weekly and monthly active users of every day
+    (UTC) in the range. Weekly and monthly active users are counted over the
+    7 and 30 days ending on the day. The counts are approximate, and users
+    whose data was delivered while redis was unavailable are not counted.
+
+    Request params:
+      - start_time: the start time of the range (in milliseconds since epoch)
+      - end_time: the end time of the range (in milliseconds since epoch)
+
+    Response:
+
+    {
+        "active_users": 1200,
+        "days": [
+            {
+                "date": "2023-01-31",
+                "dau": 800,
+                "wau": 1000,
+                "mau": 1150
+            },
+            ...
+        ]
+    }
+    """
+    key = (
+        request.query_params.get("key")
+        if request.query_params.get("key")
+        else request.META.get("HTTP_KEY")
+    )
+    app = UserApp.objects.get(key=key)
+
+    start_time = request.query_params.get("start_time")
+    end_time = request.query_params.get("end_time")
+    if not all([start_time, end_time]):
+        return Response({"error": "Missing parameters"}, status=400)
+
+    try:
+        start_date = datetime.datetime.fromtimestamp(
+            int(start_time) / 10**3, tz=datetime.timezone.utc
+        ).date()
+    except Exception:
+        return Response({"error": "Invalid start time"}, status=400)
+
+    try:
+        end_date = datetime.datetime.fromtimestamp(
+            int(end_time) / 10**3, tz=datetime.timezone.utc
+        ).date()
+    except Exception:
+        return Response({"error": "Invalid end time"}, status=400)
+
+    if end_date < start_date:
+        return Response({"error": "End time is before start time"}, status=400)
+    if (end_date - start_date).days >= MAX_ACTIVITY_RANGE_DAYS:
+        return Response(
+            {"error": f"Range is longer than {MAX_ACTIVITY_RANGE_DAYS} days"},
+            status=400,
+        )
+
+    try:
+        return Response(get_active_users(app.id, start_date, end_date))
+    except Exception as e:
+        logger.warning(f"unable to count active users of app {app.id}: {e}")
+        return Response({"error": "Active users are unavailable"}, status=503)